@@ -0,0 +1,110 @@
+import csv
+import os
+import random
+from typing import Optional
+
+ACTION = """type: action
+metadata:
+  description: Synthetic action {strategy}.{action}
+  degree: orienting
+  action_id: action_{strategy}_{action}
+threshold: {threshold}
+{condition}
+generate_suggestion_content:
+  args: [ctx]
+  load: |
+    return ({{'attribute': 'value_{attribute}', 'value': ctx.value_{attribute}}}, 'Synthetic {strategy}.{action}', 'value_{attribute} exceeds {threshold}')
+accept:
+  args: [suggestion, ctx, delta]
+  load: |
+    self.threshold += 1
+    self.suggested = False
+reject:
+  args: [suggestion, ctx, delta]
+  load: |
+    self.suggested = False
+"""
+
+PYTHON_CONDITION = """is_applicable:
+  args: [ctx, delta]
+  load: |
+    return ctx.value_{attribute} > self.threshold and ctx.enabled and not self.suggested"""
+
+DECLARATIVE_CONDITION = """is_applicable:
+  when:
+    - ctx.value_{attribute} > self.threshold
+    - ctx.enabled
+    - not self.suggested"""
+
+STRATEGY = """metadata:
+  strategy: Synthetic {strategy}
+  strategy_id: strategy_{strategy}
+  degree: orienting
+{actions}
+determine_applicability:
+  args: [ctx, delta]
+  load: |
+    return ctx.enabled
+"""
+
+GENERATE_ACTIONS = """generate_actions:
+  type: function
+  args: []
+  load: |
+    return [{actions}]
+"""
+
+
+def generate(directory: str, strategies: int = 10, actions: int = 1, attributes: int = 20, rows: int = 1000,
+             declarative: bool = False, columnar: bool = False, seed: Optional[int] = 0) -> str:
+    """
+    Writes a synthetic guidance setup: `strategies` strategies with `actions` actions each, a state vector with
+    `attributes` numeric attributes `value_0` ... and an `enabled` flag, and a data table with `rows` rows.
+
+    Each action is applicable once its attribute exceeds its threshold, so that benchmarks can make a known number of
+    actions applicable by updating the state.
+
+    :param declarative: Whether actions declare `is_applicable` with `when` rather than python
+    :param columnar: Whether to load the data as `type: columnar` rather than `type: from_csv`
+    :return: The directory
+    """
+    rng = random.Random(seed)
+    strategy_path = os.path.join(directory, 'strategies')
+    state_path = os.path.join(directory, 'state')
+    os.makedirs(os.path.join(strategy_path, 'actions'), exist_ok=True)
+    os.makedirs(state_path, exist_ok=True)
+
+    for s in range(strategies):
+        names = []
+        for a in range(actions):
+            attribute = (s * actions + a) % attributes
+            condition = DECLARATIVE_CONDITION if declarative else PYTHON_CONDITION
+            with open(os.path.join(strategy_path, 'actions', f'action_{s}_{a}.yaml'), 'w') as f:
+                f.write(ACTION.format(strategy=s, action=a, attribute=attribute, threshold=rng.randint(50, 100),
+                                      condition=condition.format(attribute=attribute)))
+            names.append('action' if actions == 1 else f'action_{a}')
+        entries = ''.join(f"{name}:\n  file_path: actions/action_{s}_{i}.yaml\n" for i, name in enumerate(names))
+        if actions > 1:
+            entries += GENERATE_ACTIONS.format(actions=', '.join(f'self.{name}' for name in names))
+        with open(os.path.join(strategy_path, f'strategy_{s}.yaml'), 'w') as f:
+            f.write(STRATEGY.format(strategy=s, actions=entries))
+
+    with open(os.path.join(directory, 'data.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['station', 'date', 'humidity', 'pressure'])
+        for i in range(rows):
+            writer.writerow([f'station_{i % 100}', f'2015-{i % 12 + 1:02d}-28', round(rng.uniform(0, 100), 2),
+                             rng.randint(900, 1100)])
+
+    with open(os.path.join(state_path, 'vector.yaml'), 'w') as f:
+        f.write("enabled: true\nmonth: '2015-01-28'\n")
+        f.write(''.join(f"value_{i}: 0\n" for i in range(attributes)))
+        if columnar:
+            f.write("data:\n  type: columnar\n  file_path: ../data.csv\n  indexes:\n    date: hash\n")
+            f.write("get_current_month:\n  type: function\n  args: []\n  load: |\n"
+                    "    return self.data.select(date=self.month).records()\n")
+        else:
+            f.write("data:\n  type: from_csv\n  file_path: ../data.csv\n")
+            f.write("get_current_month:\n  type: function\n  args: []\n  load: |\n"
+                    "    return list(filter(lambda p: p['date'] == self.month, self.data))\n")
+    return directory
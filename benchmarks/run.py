@@ -0,0 +1,244 @@
+"""
+Benchmarks the guidance engine on synthetic strategy libraries, in-process and through the FastAPI app with simulated
+websocket clients. Run `python -m benchmarks.run --help` from the repository root for options.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+os.environ.setdefault('LOTSE_LOG_LEVEL', 'WARNING')
+
+from fastapi.testclient import TestClient
+
+from lotse.app.guidance_engine.loader import StrategyLoader
+from lotse.app.guidance_engine.lotse_engine import LotseEngine
+from lotse.app.guidance_engine.socket_manager import ConnectionManager
+from lotse.app.main import app
+from lotse.suggestion import Suggestion, SuggestionContent, SuggestionModel
+from .generate import generate
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def _summary(name: str, samples: List[float]) -> Dict[str, float]:
+    """
+    :return: Mean, median and 95th percentile of the samples in milliseconds
+    """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]
+    return {f'{name}_mean_ms': statistics.fmean(samples) * 1000, f'{name}_p50_ms': statistics.median(samples) * 1000,
+            f'{name}_p95_ms': p95 * 1000}
+
+
+def bench_startup(directory: str) -> Dict[str, float]:
+    strategies, state = os.path.join(directory, 'strategies'), os.path.join(directory, 'state')
+    cache = os.path.join(directory, 'cache')
+    start = time.perf_counter()
+    LotseEngine(strategies, state, 'meta.yaml', loader=StrategyLoader(cache))
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    LotseEngine(strategies, state, 'meta.yaml', loader=StrategyLoader(cache))
+    cached = time.perf_counter() - start
+    # memory is traced separately, as tracing slows down loading
+    tracemalloc.start()
+    engine = LotseEngine(strategies, state, 'meta.yaml', loader=StrategyLoader())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del engine
+    return {'startup_cold_ms': cold * 1000, 'startup_cached_ms': cached * 1000,
+            'startup_peak_memory_mb': peak / 2 ** 20}
+
+
+async def _ticks(engine: LotseEngine, attributes: int, ticks: int, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    await engine.evaluate_strategies()
+    durations, suggestions = [], 0
+    for _ in range(ticks):
+        engine.update_state({f'value_{rng.randrange(attributes)}': rng.randint(0, 120)})
+        start = time.perf_counter()
+        await engine.retract_suggestions()
+        new = await engine.generate_suggestions()
+        durations.append(time.perf_counter() - start)
+        suggestions += len(new)
+        # accept everything so that actions can suggest again
+        for suggestion in new:
+            await engine.accept_suggestion(suggestion.suggestion.id)
+    return {**_summary('tick', durations), 'tick_suggestions': suggestions}
+
+
+def bench_ticks(directory: str, attributes: int, ticks: int, seed: int) -> Dict[str, float]:
+    engine = LotseEngine(os.path.join(directory, 'strategies'), os.path.join(directory, 'state'), 'meta.yaml')
+    try:
+        return asyncio.run(_ticks(engine, attributes, ticks, seed))
+    finally:
+        engine.executor.shutdown()
+
+
+def bench_api(directory: str, attributes: int, clients: int, rounds: int) -> Dict[str, float]:
+    """
+    Updates the state through the REST interface and waits for the resulting suggestions on all websocket clients,
+    then accepts or rejects them.
+    """
+    app.setup_engine(os.path.join(directory, 'strategies'), os.path.join(directory, 'state'), max_queue_size=100000,
+                     strategy_cache=False)
+    engine = app.lotse_engine
+    first, complete, accept, reject = [], [], [], []
+    with TestClient(app) as client:
+        client.post('/state/update', json={'updates': {}, 're_evaluate_strategies': True})
+        sockets = [client.websocket_connect(f'/channels/client_{i}') for i in range(clients)]
+        connections = [socket.__enter__() for socket in sockets]
+        try:
+            for r in range(rounds):
+                attribute = f'value_{r % attributes}'
+                start = time.perf_counter()
+                client.post('/state/update', json={'updates': {attribute: 1000}})
+                if not engine.suggestions:
+                    continue
+                expected = len(engine.suggestions)
+                for i, connection in enumerate(connections):
+                    for j in range(expected):
+                        connection.receive_text()
+                        if i == 0 and j == 0:
+                            first.append(time.perf_counter() - start)
+                complete.append(time.perf_counter() - start)
+                for i, suggestion in enumerate(list(engine.suggestions)):
+                    payload = json.loads(suggestion.json(exclude={'action'}))  # as sent over the websocket
+                    payload['action'] = None
+                    start = time.perf_counter()
+                    client.post('/accept' if i % 2 == 0 else '/reject', json=payload)
+                    (accept if i % 2 == 0 else reject).append(time.perf_counter() - start)
+                client.post('/state/update', json={'updates': {attribute: 0}, 're_evaluate_actions': False})
+        finally:
+            for socket in sockets:
+                socket.__exit__(None, None, None)
+    engine.executor.shutdown()
+    return {**_summary('update_to_first_suggestion', first), **_summary('update_to_all_clients', complete),
+            **_summary('accept', accept), **_summary('reject', reject)}
+
+
+class SimulatedWebSocket:
+    """
+    Stands in for a connected client that reads every message immediately.
+    """
+
+    def __init__(self):
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        self.received += 1
+
+    async def send_bytes(self, data: bytes):
+        self.received += 1
+
+    async def close(self):
+        pass
+
+
+async def _broadcast(clients: int, messages: int) -> Dict[str, float]:
+    manager = ConnectionManager(max_queue_size=messages)
+    sockets = [SimulatedWebSocket() for _ in range(clients)]
+    for i, socket in enumerate(sockets):
+        await manager.connect(socket, f'client_{i}')
+    suggestion = SuggestionModel(suggestion=Suggestion(
+        id='benchmark', title='Benchmark', description='A synthetic suggestion', degree='orienting',
+        event=SuggestionContent(action_id='benchmark', value={'values': list(range(20))}), strategy='benchmark'),
+        action=None)
+    start = time.perf_counter()
+    for _ in range(messages):
+        await manager.broadcast(suggestion)
+    while any(socket.received < messages for socket in sockets):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    for socket in sockets:
+        await manager.disconnect(socket)
+    return {'broadcast_messages_per_second': clients * messages / elapsed}
+
+
+def bench_broadcast(clients: int, messages: int) -> Dict[str, float]:
+    return asyncio.run(_broadcast(clients, messages))
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """
+    :return: Descriptions of all metrics that regressed by more than `tolerance` (relative) against the baseline.
+    Metrics ending in `_per_second` are better when higher, all others when lower.
+    """
+    regressions = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if not reference or name == 'tick_suggestions':
+            continue
+        change = (reference - value) / reference if name.endswith('_per_second') else (value - reference) / reference
+        if change > tolerance:
+            regressions.append(f"{name}: {value:.3f} vs. baseline {reference:.3f} ({change:+.0%})")
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--strategies', type=int, default=50, help='Number of synthetic strategies')
+    parser.add_argument('--actions', type=int, default=2, help='Actions per strategy')
+    parser.add_argument('--attributes', type=int, default=20, help='Numeric attributes of the state vector')
+    parser.add_argument('--rows', type=int, default=10000, help='Rows of the synthetic data table')
+    parser.add_argument('--declarative', action='store_true', help='Declare conditions with `when`')
+    parser.add_argument('--columnar', action='store_true', help='Load data as `type: columnar`')
+    parser.add_argument('--ticks', type=int, default=200, help='Evaluation passes of the in-process benchmark')
+    parser.add_argument('--clients', type=int, default=10, help='Simulated websocket clients')
+    parser.add_argument('--rounds', type=int, default=10, help='Update rounds through the REST interface')
+    parser.add_argument('--messages', type=int, default=200, help='Messages of the broadcast benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='NAME', help='Save the results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME', help='Compare the results against baseline NAME')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Relative slowdown against the baseline reported as regression')
+    args = parser.parse_args(argv)
+
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        generate(directory, args.strategies, args.actions, args.attributes, args.rows, args.declarative,
+                 args.columnar, args.seed)
+        results.update(bench_startup(directory))
+        results.update(bench_ticks(directory, args.attributes, args.ticks, args.seed))
+        results.update(bench_api(directory, args.attributes, args.clients, args.rounds))
+    results.update(bench_broadcast(args.clients, args.messages))
+
+    for name, value in results.items():
+        print(f"{name:40} {value:12.3f}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'tolerance')}
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, f'{args.save}.json'), 'w') as f:
+            json.dump({'config': config, 'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+        print(f"Saved baseline {args.save}")
+    if args.compare:
+        with open(os.path.join(BASELINES, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print(f"Warning: baseline {args.compare} was recorded with different options: {baseline['config']}")
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against baseline {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import logging
 import uuid
 from typing import Callable, Union
 
@@ -6,6 +7,9 @@ from .strategy import Strategy
 from .suggestion import SuggestionContent, Suggestion, SuggestionModel
 
 
+logger = logging.getLogger(__name__)
+
+
 class ConditionalGuidanceAction:
     """
     Conditional guidance action class.
@@ -100,12 +104,28 @@ class ConditionalGuidanceAction:
         try:
             content, title, desc = self.generate_suggestion_content(context)
         except Exception as e:
-            print(str(e))
-            print("did not get enough suggestion content, return none")
+            logger.warning("Action %s did not return suggestion content (%s), no suggestion generated",
+                           self.metadata.get('action_id', ''), e)
+            return None
+        return self.build_suggestion(content, title, desc)
+
+    async def generate_suggestions_async(self, context: ContextVector) -> Union[None, SuggestionModel]:
+        """
+        Like `generate_suggestions`, for actions whose `generate_suggestion_content` is declared `async`.
+        """
+        try:
+            content, title, desc = await self.generate_suggestion_content(context)
+        except Exception as e:
+            logger.warning("Action %s did not return suggestion content (%s), no suggestion generated",
+                           self.metadata.get('action_id', ''), e)
             return None
+        return self.build_suggestion(content, title, desc)
 
-        print('generating new sugg')
-        print(content, title, desc)
+    def build_suggestion(self, content, title: str, desc: str) -> SuggestionModel:
+        """
+        Wraps the content generated by `generate_suggestion_content` into a new suggestion.
+        """
+        logger.debug("Generating suggestion %s: %s %s", title, content, desc)
         content = SuggestionContent(action_id=self.metadata.get('action_id', ''), value=content)
         suggestion = Suggestion(title=title,
                                 description=desc,
@@ -0,0 +1,150 @@
+import heapq
+import math
+import time
+import weakref
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# weight of the latest duration in the moving average of an action's content generation time
+COST_SMOOTHING = 0.3
+
+
+def _metadata(action: Any) -> dict:
+    return getattr(action, 'metadata', None) or {}
+
+
+class ActionQueue:
+    """
+    The actions due for evaluation, highest priority first. Only the actions taken from the queue are sorted.
+    """
+
+    def __init__(self, entries: List[Tuple[float, int, Hashable]]):
+        self.heap = entries
+        heapq.heapify(self.heap)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        while self.heap:
+            yield heapq.heappop(self.heap)[-1]
+
+    def remaining(self) -> List[Hashable]:
+        """
+        Removes and returns all actions not taken from the queue yet, in no particular order.
+        """
+        remaining, self.heap = [entry[-1] for entry in self.heap], []
+        return remaining
+
+
+class GuidanceBudget:
+    """
+    Limits the work and the number of suggestions of each evaluation pass. Declared as `budget` in `meta.yaml`, e.g. ::
+
+        budget:
+          max_suggestions: 2   # suggestions per pass
+          max_seconds: 0.05    # duration of a pass, in seconds
+          rate: 10             # suggestions per `period` seconds
+          period: 60
+
+    Actions are evaluated in the order of their `priority` (metadata, higher first, default 0). Once `max_suggestions`
+    applicable actions are found, the rate limit is reached or the time is used up, the remaining actions are deferred
+    to a later pass without being evaluated. Content is only generated for actions whose expected `cost` (metadata, in
+    seconds, defaults to the measured duration of previous calls) fits into the time that is left.
+
+    The budget applies per engine, i.e. per client if sessions are isolated.
+    """
+
+    def __init__(self, max_suggestions: int = None, max_seconds: float = None, rate: float = None,
+                 period: float = 60):
+        """
+        :param max_suggestions: The maximum number of suggestions per pass
+        :param max_seconds: The time a pass may take, in seconds. Callbacks that were already started are not
+        interrupted.
+        :param rate: The maximum number of suggestions per `period` seconds. Unused suggestions accumulate up to `rate`.
+        :param period: The period of `rate`, in seconds
+        """
+        self.max_suggestions = max_suggestions
+        self.max_seconds = max_seconds
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate) if rate is not None else 0.0
+        self.refilled = time.time()
+        self.started = time.perf_counter()
+        self.costs: 'weakref.WeakKeyDictionary[Any, float]' = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_meta(cls, meta_strategy: Any) -> Optional['GuidanceBudget']:
+        """
+        :return: The budget declared by the meta strategy, or None if it does not declare one
+        """
+        budget = getattr(meta_strategy, 'budget', None)
+        if not isinstance(budget, dict):
+            return None
+        return cls(**budget)
+
+    def _refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(float(self.rate), self.tokens + (now - self.refilled) * self.rate / self.period)
+        self.refilled = now
+
+    def begin(self, now: float = None) -> Optional[int]:
+        """
+        Starts an evaluation pass.
+
+        :return: The number of suggestions the pass may make, or None if it is not limited
+        """
+        self._refill(time.time() if now is None else now)
+        self.started = time.perf_counter()
+        limits = [] if self.max_suggestions is None else [self.max_suggestions]
+        if self.rate is not None:
+            limits.append(max(0, math.floor(self.tokens)))
+        return min(limits, default=None)
+
+    def remaining_seconds(self) -> float:
+        if self.max_seconds is None:
+            return math.inf
+        return self.max_seconds - (time.perf_counter() - self.started)
+
+    def exhausted(self) -> bool:
+        return self.remaining_seconds() <= 0
+
+    def spend(self, suggestions: int):
+        if self.rate is not None:
+            self.tokens -= suggestions
+
+    def next_available(self, now: float = None) -> float:
+        """
+        :return: When the rate limit allows the next suggestion, as unix timestamp
+        """
+        now = time.time() if now is None else now
+        self._refill(now)
+        if self.rate is None or self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) * self.period / self.rate
+
+    @staticmethod
+    def priority(action: Any) -> float:
+        return _metadata(action).get('priority', 0)
+
+    def queue(self, actions: Iterable[Hashable], order: Dict[Hashable, int]) -> ActionQueue:
+        """
+        :param order: Position of each action, to break ties between actions of the same priority
+        """
+        return ActionQueue([(-self.priority(action), order[action], action) for action in actions])
+
+    def cost(self, action: Any) -> float:
+        """
+        :return: The expected duration of the action's `generate_suggestion_content`, in seconds
+        """
+        cost = _metadata(action).get('cost')
+        if cost is not None:
+            return cost
+        return self.costs.get(action, 0.0)
+
+    def affordable(self, action: Any) -> bool:
+        return self.cost(action) <= self.remaining_seconds()
+
+    def observe(self, action: Any, seconds: float):
+        """
+        Records how long the action took to generate its suggestion.
+        """
+        previous = self.costs.get(action)
+        self.costs[action] = seconds if previous is None else \
+            COST_SMOOTHING * seconds + (1 - COST_SMOOTHING) * previous
@@ -0,0 +1,234 @@
+import ast
+import time
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple, Union
+
+from .dependencies import ALL, DELTA, record_reads
+
+# names available in declarative conditions besides `ctx`, `self`, `delta` and `now`
+FUNCTIONS = {'abs': abs, 'len': len, 'min': min, 'max': max, 'round': round}
+ALLOWED_NODES = (ast.Expression, ast.Compare, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Attribute, ast.Subscript,
+                 ast.Name, ast.Constant, ast.List, ast.Tuple, ast.Set, ast.Call, ast.Load, ast.operator, ast.unaryop,
+                 ast.boolop, ast.cmpop)
+
+
+class Condition:
+    """
+    A condition declared in the yaml files with `when` instead of a python `load`, e.g. ::
+
+        is_applicable:
+          when:
+            - now - ctx.last_interaction > self.timeout
+            - not self.suggested
+
+    `when` is an expression, a list of expressions that must all hold, or a nested structure of `all`, `any` and
+    `not`. The engine compiles conditions into its `ConditionNetwork` to share their evaluation.
+    """
+
+    def __init__(self, spec: Union[str, list, dict], owner: Any):
+        """
+        :param spec: The content of `when`
+        :param owner: The action or strategy declaring the condition, available as `self` in expressions
+        """
+        self.spec = spec
+        self.owner = owner
+        compile_spec(spec)
+
+
+class Expression:
+    """
+    A compiled atomic expression and what it reads.
+    """
+
+    def __init__(self, source: str):
+        tree = ast.parse(source.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(f"{type(node).__name__} is not supported in condition '{source}', use a python "
+                                 f"`load` callback instead")
+            if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS):
+                raise ValueError(f"Only {', '.join(FUNCTIONS)} can be called in condition '{source}'")
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in ('ctx', 'self', 'delta',
+                                                                                            'now'):
+                raise ValueError(f"Unknown name {node.id} in condition '{source}'")
+        self.source = ast.unparse(tree)
+        self.code = compile(tree, f"<condition {self.source}>", 'eval')
+        names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+        attributes = [node for node in ast.walk(tree)
+                      if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'ctx']
+        # `ctx` used other than to access one of its attributes, e.g. `len(ctx.__dict__)`
+        bare = sum(isinstance(node, ast.Name) and node.id == 'ctx' for node in ast.walk(tree)) > len(attributes)
+        # attributes of the context vector this expression depends on
+        self.reads: Set[str] = {ALL} if bare else {node.attr for node in attributes}
+        if 'delta' in names:
+            self.reads.add(DELTA)
+        self.uses_self = 'self' in names
+        self.uses_clock = 'now' in names
+        # expressions reading the owner, the clock or the delta can change without any context vector update
+        self.volatile = self.uses_self or self.uses_clock or 'delta' in names
+
+    def evaluate(self, context: Any, delta: Any, owner: Any, now: float) -> Any:
+        return eval(self.code, {'__builtins__': FUNCTIONS},
+                    {'ctx': context, 'self': owner, 'delta': delta, 'now': now})
+
+
+# (kind, children) for `all`, `any` and `not`, or ('test', expression)
+Spec = Tuple[str, Any]
+
+
+@lru_cache(maxsize=None)
+def _expression(source: str) -> Expression:
+    return Expression(source)
+
+
+def compile_spec(spec: Union[str, list, dict]) -> Spec:
+    """
+    Normalizes a `when` declaration into a tree of `all`, `any`, `not` and `test` nodes. Boolean operators within
+    expressions are split into nodes as well, so that their operands can be shared.
+
+    :raises ValueError: If the declaration or one of its expressions is invalid
+    """
+    if isinstance(spec, bool):
+        spec = str(spec)
+    if isinstance(spec, str):
+        return _split(ast.parse(spec.strip(), mode='eval').body)
+    if isinstance(spec, list):
+        return 'all', tuple(compile_spec(s) for s in spec)
+    if isinstance(spec, dict) and len(spec) == 1:
+        kind, children = next(iter(spec.items()))
+        if kind == 'not':
+            return 'not', compile_spec(children)
+        if kind in ('all', 'any') and isinstance(children, list):
+            return kind, tuple(compile_spec(s) for s in children)
+    raise ValueError(f"Invalid condition {spec}. Use an expression, a list or one of `all`, `any` and `not`.")
+
+
+def _split(node: ast.expr) -> Spec:
+    if isinstance(node, ast.BoolOp):
+        return 'all' if isinstance(node.op, ast.And) else 'any', tuple(_split(v) for v in node.values)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return 'not', _split(node.operand)
+    return 'test', _expression(ast.unparse(node))
+
+
+class Node:
+    """
+    A node of the condition network. Test nodes evaluate a single expression, join nodes combine their children.
+    """
+
+    def __init__(self, kind: str, children: Tuple['Node', ...] = (), expression: Expression = None, owner: Any = None):
+        self.kind = kind
+        self.children = children
+        self.expression = expression
+        self.owner = owner
+        self.reads: Set[str] = set(expression.reads) if expression else set().union(*(c.reads for c in children))
+        self.uses_clock = expression.uses_clock if expression else any(c.uses_clock for c in children)
+        # the value of test nodes that only depend on the context vector is kept until one of its reads changes
+        self.value = None
+        self.valid = False
+        self.evaluated_in = -1
+
+
+class Rule:
+    """
+    The compiled root node of a declared condition.
+    """
+
+    def __init__(self, root: Node):
+        self.root = root
+        # evaluating the rule never calls the clock unless `now` is used
+        self.time_based = root.uses_clock
+
+
+class ConditionNetwork:
+    """
+    Compiles declared conditions into a network of nodes in the spirit of the Rete algorithm: identical expressions are
+    compiled into a single node shared by all actions and strategies using them (unless they read `self`), and the
+    value of each node is kept until one of the context vector attributes it reads changes. Within an evaluation pass,
+    every node is evaluated at most once.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[Hashable, Node] = {}
+        self.rules: Dict[Condition, Rule] = {}
+        # inverted index from context vector attributes to the nodes reading them
+        self.dependents: Dict[str, Set[Node]] = {}
+        self.pass_id = 0
+        self.now = time.time()
+        self.evaluations = 0
+
+    def rule(self, condition: Condition) -> Rule:
+        rule = self.rules.get(condition)
+        if rule is None:
+            rule = self.rules[condition] = Rule(self._node(compile_spec(condition.spec), condition.owner))
+        return rule
+
+    def _node(self, spec: Spec, owner: Any) -> Node:
+        kind, content = spec
+        if kind == 'test':
+            key = (kind, content.source, owner if content.uses_self else None)
+            node = self.nodes.get(key)
+            if node is None:
+                node = self.nodes[key] = Node(kind, expression=content, owner=owner if content.uses_self else None)
+                for attribute in node.reads:
+                    self.dependents.setdefault(attribute, set()).add(node)
+            return node
+        children = (self._node(content, owner),) if kind == 'not' else tuple(self._node(c, owner) for c in content)
+        key = (kind, children)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = Node(kind, children)
+        return node
+
+    def begin_pass(self):
+        """
+        Starts an evaluation pass. `now` is fixed for the duration of the pass.
+        """
+        self.pass_id += 1
+        self.now = time.time()
+
+    def mark_changed(self, keys: Optional[Iterable[str]]):
+        """
+        Invalidates all nodes reading the given context vector attributes. `None` invalidates all nodes.
+        """
+        if keys is None:
+            for node in self.nodes.values():
+                node.valid = False
+            return
+        for attribute in list(keys) + [ALL]:
+            for node in self.dependents.get(attribute, ()):
+                node.valid = False
+
+    def bind(self, condition: Condition) -> Callable:
+        """
+        :return: A callback evaluating the condition, to be called with the context vector and delta
+        """
+        callback = partial(self.evaluate, condition)
+        # lets the dependency tracker know whether the condition depends on the current time
+        callback.time_based = self.rule(condition).time_based
+        return callback
+
+    def evaluate(self, condition: Condition, context: Any, delta: Any) -> bool:
+        """
+        Evaluates the declared condition, reusing node values computed earlier in this pass or, for nodes that only read
+        unchanged context vector attributes, in earlier passes.
+        """
+        rule = self.rule(condition)
+        # report everything the rule may read, as cached nodes do not access the context vector
+        record_reads(context, rule.root.reads)
+        return bool(self._evaluate(rule.root, context, delta))
+
+    def _evaluate(self, node: Node, context: Any, delta: Any) -> Any:
+        if node.kind == 'test':
+            if node.evaluated_in == self.pass_id or (node.valid and not node.expression.volatile):
+                return node.value
+            self.evaluations += 1
+            node.value = node.expression.evaluate(context, delta, node.owner, self.now)
+            node.valid = True
+            node.evaluated_in = self.pass_id
+            return node.value
+        if node.kind == 'not':
+            return not self._evaluate(node.children[0], context, delta)
+        if node.kind == 'all':
+            return all(self._evaluate(child, context, delta) for child in node.children)
+        return any(self._evaluate(child, context, delta) for child in node.children)
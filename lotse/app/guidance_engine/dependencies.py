@@ -0,0 +1,270 @@
+import types
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+# Pseudo-dependency recorded when a callback reads something we cannot attribute to a single attribute, e.g. the whole
+# `__dict__` of the context vector or one of its helper functions.
+ALL = '*'
+# Pseudo-dependency recorded when a callback reads the delta passed to it. Every state update changes the delta.
+DELTA = '__delta__'
+# Pseudo-dependency recorded when a callback queries something that changes as time passes, e.g. a time window of the
+# state history.
+CLOCK = '__clock__'
+
+CLOCK_NAMES = {'time', 'datetime', 'monotonic', 'perf_counter', 'now', 'today'}
+
+
+class TrackingContext:
+    """
+    Read-through proxy around the context vector that records the names of all attributes a callback accesses.
+    Writes are passed through to the wrapped context vector.
+    """
+    __slots__ = ('_target', '_reads')
+
+    def __init__(self, target: Any, reads: Set[str]):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_reads', reads)
+
+    def __getattr__(self, name: str):
+        value = getattr(self._target, name)
+        # objects such as the state history record reads on their own
+        track_reads = getattr(type(value), 'track_reads', None)
+        if track_reads is not None:
+            return track_reads(value, self._reads)
+        # helper functions and direct `__dict__` access can read anything, so we cannot narrow the dependencies down
+        if name == '__dict__' or callable(value):
+            self._reads.add(ALL)
+        else:
+            self._reads.add(name)
+        return value
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self._target, name, value)
+
+    def __repr__(self):
+        return repr(self._target)
+
+
+class TrackingDelta(dict):
+    """
+    Copy of a delta dictionary that records whether the callback it was passed to looked at it.
+    """
+
+    def __init__(self, delta: dict, reads: Set[str]):
+        super().__init__(delta)
+        self._reads = reads
+
+    def __getitem__(self, key):
+        self._reads.add(DELTA)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._reads.add(DELTA)
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self._reads.add(DELTA)
+        return super().__iter__()
+
+    def __len__(self):
+        self._reads.add(DELTA)
+        return super().__len__()
+
+    def get(self, key, default=None):
+        self._reads.add(DELTA)
+        return super().get(key, default)
+
+    def keys(self):
+        self._reads.add(DELTA)
+        return super().keys()
+
+    def values(self):
+        self._reads.add(DELTA)
+        return super().values()
+
+    def items(self):
+        self._reads.add(DELTA)
+        return super().items()
+
+
+def tracked(context: Any, delta: Any, reads: Set[str]) -> Tuple[TrackingContext, Any]:
+    """
+    Wraps context vector and delta so that all reads are recorded in `reads`.
+
+    :param context: The current context vector
+    :param delta: The current delta. Can be None.
+    :param reads: The set in which read attributes are recorded.
+    :return: (context, delta) to be passed to the callback instead of the originals
+    """
+    if delta is None:
+        return TrackingContext(context, reads), None
+    if isinstance(delta, dict):
+        return TrackingContext(context, reads), TrackingDelta(delta, reads)
+    # we cannot observe reads on arbitrary objects returned from callbacks, so assume they are used
+    reads.add(DELTA)
+    return TrackingContext(context, reads), delta
+
+
+def record_reads(context: Any, names: Iterable[str]):
+    """
+    Records reads on behalf of a callback that obtained values of the context vector without accessing it, e.g. from a
+    cache. Does nothing if the context is not tracked.
+    """
+    if isinstance(context, TrackingContext):
+        context._reads.update(names)
+
+
+def _code_names(fn: Any, depth: int = 0) -> Set[str]:
+    while isinstance(fn, partial) or hasattr(fn, '__wrapped__'):
+        fn = fn.func if isinstance(fn, partial) else fn.__wrapped__
+    if isinstance(fn, types.MethodType):
+        fn = fn.__func__
+    code = getattr(fn, '__code__', None)
+    if code is None or depth > 3:
+        return set()
+    names = set()
+    codes = [code]
+    while codes:
+        current = codes.pop()
+        names.update(current.co_names)
+        codes.extend(const for const in current.co_consts if isinstance(const, types.CodeType))
+    # yaml callbacks are compiled into small lambdas that call the actual function from the module globals
+    for name in list(names):
+        referenced = fn.__globals__.get(name)
+        if isinstance(referenced, types.FunctionType) and referenced is not fn:
+            names.update(_code_names(referenced, depth + 1))
+    return names
+
+
+def reads_clock(callback: Callable) -> bool:
+    """
+    Heuristically determines whether the callback depends on the current time, in which case its result can change
+    without any change to the context vector. Callbacks can declare this themselves with a `time_based` attribute.
+    """
+    time_based = getattr(callback, 'time_based', None)
+    if time_based is not None:
+        return bool(time_based)
+    return not CLOCK_NAMES.isdisjoint(_code_names(callback))
+
+
+class DependencyTracker:
+    """
+    Remembers which context vector attributes a callback read when it was last evaluated, and decides whether it must
+    be evaluated again given the attributes that changed in the meantime.
+
+    Callbacks are re-evaluated if
+    - they have never been evaluated or were invalidated,
+    - they read an attribute that changed since the last evaluation pass,
+    - they depend on the current time (detected from their code or recorded as a read of `CLOCK`), or
+    - they returned a truthy value last time (e.g. actions that were applicable update their own state).
+
+    An inverted index from attributes to dependent keys allows finding the keys due for evaluation in time proportional
+    to the number of affected keys.
+    """
+
+    def __init__(self):
+        self.dependencies: Dict[Hashable, Set[str]] = {}
+        self.dependents: Dict[str, Set[Hashable]] = {}
+        self.results: Dict[Hashable, bool] = {}
+        self.time_based: Dict[Hashable, bool] = {}
+        # keys that have to be evaluated in every pass, and keys that have to be evaluated in the next pass
+        self.always: Set[Hashable] = set()
+        self.unevaluated: Set[Hashable] = set()
+        # keys that were due but skipped to stay within a budget, evaluated in a later pass
+        self.deferred: Set[Hashable] = set()
+        self.changed: Set[str] = set()
+
+    def mark_changed(self, keys: Optional[Iterable[str]]):
+        """
+        Records that the given context vector attributes changed. `None` marks all attributes as changed.
+        """
+        if keys is None:
+            self.changed.add(ALL)
+        else:
+            self.changed.update(keys)
+        self.changed.add(DELTA)
+
+    def invalidate(self, key: Hashable):
+        """
+        Forces re-evaluation of the given key in the next pass, e.g. after its action was accepted or rejected.
+        """
+        self.unevaluated.add(key)
+
+    def defer(self, keys: Iterable[Hashable]):
+        """
+        Keeps keys that were due but not evaluated in the current pass due in later passes. Unlike invalidated keys,
+        deferred keys do not require an immediate pass.
+        """
+        keys = set(keys)
+        self.deferred.update(keys)
+        self.unevaluated.difference_update(keys)
+
+    def needs_evaluation(self, key: Hashable) -> bool:
+        if key in self.unevaluated or key in self.deferred or key in self.always or key not in self.dependencies:
+            return True
+        if ALL in self.changed:
+            return True
+        return not self.dependencies[key].isdisjoint(self.changed)
+
+    def due(self) -> Set[Hashable]:
+        """
+        :return: All keys that need to be evaluated in the current pass.
+        """
+        if ALL in self.changed:
+            return set(self.dependencies) | self.unevaluated | self.deferred
+        due = self.unevaluated | self.deferred | self.always
+        for attribute in self.changed:
+            due.update(self.dependents.get(attribute, ()))
+        return due
+
+    def record(self, key: Hashable, reads: Set[str], result: Any, callback: Callable, time_based: bool = None):
+        """
+        Stores the result of evaluating `callback` for `key`, together with the attributes it read.
+
+        :param time_based: Overrides the automatic detection of callbacks that depend on the current time.
+        """
+        self._unindex(key)
+        self.dependencies[key] = reads
+        for attribute in reads:
+            self.dependents.setdefault(attribute, set()).add(key)
+        self.results[key] = bool(result)
+        if key not in self.time_based:
+            self.time_based[key] = reads_clock(callback) if time_based is None else bool(time_based)
+        if self.time_based[key] or self.results[key] or ALL in reads or CLOCK in reads:
+            self.always.add(key)
+        self.unevaluated.discard(key)
+        self.deferred.discard(key)
+
+    def consume(self):
+        """
+        Ends an evaluation pass. All changes recorded so far have been taken into account.
+        """
+        self.changed = set()
+
+    def forget(self, key: Hashable):
+        self._unindex(key)
+        self.dependencies.pop(key, None)
+        self.results.pop(key, None)
+        self.time_based.pop(key, None)
+        self.unevaluated.discard(key)
+        self.deferred.discard(key)
+
+    def retain(self, keys: Iterable[Hashable]):
+        """
+        Sets the keys to track. Keys not contained in `keys` are forgotten, new keys are evaluated in the next pass.
+        """
+        keys = set(keys)
+        for key in [k for k in self.dependencies if k not in keys]:
+            self.forget(key)
+        self.unevaluated = {k for k in self.unevaluated if k in keys}
+        self.deferred = {k for k in self.deferred if k in keys}
+        self.unevaluated.update(k for k in keys if k not in self.dependencies)
+
+    def _unindex(self, key: Hashable):
+        for attribute in self.dependencies.get(key, ()):
+            dependents = self.dependents.get(attribute)
+            if dependents is not None:
+                dependents.discard(key)
+                if not dependents:
+                    del self.dependents[attribute]
+        self.always.discard(key)
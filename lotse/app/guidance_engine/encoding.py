@@ -0,0 +1,147 @@
+import json
+import zlib
+from typing import Any, Dict, Literal, Optional, Union
+
+from pydantic import BaseModel
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Encoding = Literal['json', 'msgpack']
+Compression = Literal['none', 'deflate']
+Frame = Union[str, bytes]
+
+ENCODINGS = ('json', 'msgpack')
+COMPRESSIONS = ('none', 'deflate')
+
+
+def available_encodings():
+    return tuple(e for e in ENCODINGS if e != 'msgpack' or msgpack is not None)
+
+
+def encode(data: Any, encoding: Encoding = 'json', compression: Compression = 'none', text: str = None) -> Frame:
+    """
+    Serializes a message for a websocket client. Uncompressed JSON is sent as text frame, everything else as binary
+    frame.
+
+    :param text: The message already serialized as JSON, if available
+    """
+    if encoding == 'msgpack':
+        if msgpack is None:
+            raise ValueError("MessagePack encoding requires the msgpack package: pip install lotse[msgpack]")
+        payload = msgpack.packb(data, use_bin_type=True)
+    else:
+        payload = text if text is not None else json.dumps(data, separators=(',', ':'))
+        if compression == 'none':
+            return payload
+        payload = payload.encode('utf-8')
+    if compression == 'deflate':
+        # raw deflate, as in permessage-deflate, so that browsers can inflate it with DecompressionStream
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        payload = compressor.compress(payload) + compressor.flush()
+    return payload
+
+
+def decode(frame: Frame, encoding: Encoding = 'json', compression: Compression = 'none') -> Any:
+    """
+    Deserializes a message received from a websocket client. Text frames are always JSON, binary frames use the
+    client's encoding and compression.
+    """
+    if isinstance(frame, str):
+        return json.loads(frame)
+    if compression == 'deflate':
+        frame = zlib.decompress(frame, wbits=-zlib.MAX_WBITS)
+    if encoding == 'msgpack':
+        return msgpack.unpackb(frame, raw=False)
+    return json.loads(frame)
+
+
+def merge_patch(base: Any, target: Any) -> Any:
+    """
+    Computes a JSON merge patch (RFC 7386) that turns `base` into `target`. Lists are replaced as a whole.
+    """
+    if not isinstance(base, dict) or not isinstance(target, dict):
+        return target
+    patch = {}
+    for key in base:
+        if key not in target:
+            patch[key] = None
+    for key, value in target.items():
+        if key not in base:
+            patch[key] = value
+        elif base[key] != value:
+            patch[key] = merge_patch(base[key], value)
+    return patch
+
+
+def apply_merge_patch(base: Any, patch: Any) -> Any:
+    """
+    Applies a JSON merge patch (RFC 7386) to `base`, as clients receiving deltas have to.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(base) if isinstance(base, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+class OutgoingMessage:
+    """
+    A message queued for one or more clients. It is serialized once per encoding, however many clients receive it.
+    """
+
+    def __init__(self, message: BaseModel = None, text: str = None):
+        """
+        :param message: The message to send
+        :param text: The message serialized as JSON, e.g. when it was received from another worker
+        """
+        self.text = text if message is None else message.json(exclude={'action'})
+        self._data = None
+        self.frames: Dict[tuple, Frame] = {}
+        if message is None:
+            suggestion = self.data.get('suggestion') or {}
+            self.key: Optional[str] = suggestion.get('id')
+            self.action_id: Optional[str] = (suggestion.get('event') or {}).get('action_id')
+            self.interaction: Optional[str] = self.data.get('interaction')
+            return
+        suggestion = getattr(message, 'suggestion', None)
+        self.key = getattr(suggestion, 'id', None)
+        self.action_id = getattr(getattr(suggestion, 'event', None), 'action_id', None)
+        self.interaction = getattr(message, 'interaction', None)
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = json.loads(self.text)
+        return self._data
+
+    def frame(self, encoding: Encoding, compression: Compression) -> Frame:
+        key = (encoding, compression)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = encode(self.data if encoding != 'json' else None, encoding, compression,
+                                              self.text if encoding == 'json' else None)
+        return frame
+
+    def delta(self, base: dict) -> Optional[dict]:
+        """
+        :param base: The `suggestion` of a message previously sent to the client
+        :return: A message patching `base` into this message's suggestion, or None if the patch is not smaller than the
+        suggestion itself
+        """
+        suggestion = self.data.get('suggestion')
+        patch = merge_patch(base, suggestion)
+        # merge patches cannot set values to null
+        if apply_merge_patch(base, patch) != suggestion:
+            return None
+        delta = {'type': self.data.get('type'), 'interaction': self.interaction, 'base': base.get('id'),
+                 'patch': patch}
+        if len(json.dumps(delta, separators=(',', ':'))) >= len(self.text):
+            return None
+        return delta
@@ -0,0 +1,130 @@
+import asyncio
+import inspect
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Literal, Optional
+
+logger = logging.getLogger(__name__)
+
+ExecutorKind = Literal['thread', 'inline']
+
+
+class CallbackTimeout(Exception):
+    """
+    Raised when a callback defined in a yaml file does not finish within its timeout.
+    """
+    pass
+
+
+def is_async(callback: Callable) -> bool:
+    """
+    :return: Whether the callback is a coroutine function, e.g. declared with `async: true` in the yaml, also if it is
+    wrapped, e.g. bound to its action or cached
+    """
+    for _ in range(8):
+        if inspect.iscoroutinefunction(callback):
+            return True
+        if isinstance(callback, partial):
+            callback = callback.func
+        elif hasattr(callback, '__wrapped__'):
+            callback = callback.__wrapped__
+        else:
+            return False
+    return False
+
+
+class CallbackExecutor:
+    """
+    Runs callbacks defined in the yaml files (`is_applicable`, `generate_suggestion_content`, state callbacks, ...)
+    without blocking the event loop, so that a slow callback does not stall websockets and REST requests.
+
+    Callbacks that exceed their timeout are abandoned and the action or strategy they belong to is marked as degraded.
+    Degraded actions and strategies are skipped by the engine until `degraded_cooldown` seconds have passed.
+    Note that python threads cannot be killed: an abandoned callback keeps running in the background until it returns.
+
+    Callbacks declared `async` run on the event loop instead, at most `max_concurrency` at once. They are cancelled when
+    they exceed their timeout.
+    """
+
+    def __init__(self, kind: ExecutorKind = 'thread', max_workers: int = 4, timeout: Optional[float] = None,
+                 timeouts: Dict[str, float] = None, degraded_cooldown: float = 60, max_concurrency: int = 16):
+        """
+        :param kind: `thread` to run callbacks in a thread pool, `inline` to run them on the event loop
+        :param max_workers: The number of threads in the pool
+        :param timeout: The default timeout in seconds for all callbacks. None to wait indefinitely.
+        :param timeouts: Timeouts overriding the default for individual callbacks, by callback name
+        :param degraded_cooldown: Seconds for which actions and strategies are skipped after a timeout
+        :param max_concurrency: The number of `async` callbacks awaited at once
+        """
+        self.kind = kind
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.degraded_cooldown = degraded_cooldown
+        self.degraded: Dict[Hashable, float] = {}
+        self.max_concurrency = max(1, max_concurrency)
+        # created on first use, within the event loop
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lotse-callback') \
+            if kind == 'thread' else None
+
+    def timeout_for(self, name: str, timeout: Optional[float] = None) -> Optional[float]:
+        if timeout is not None:
+            return timeout
+        return self.timeouts.get(name, self.timeout)
+
+    def is_degraded(self, key: Hashable) -> bool:
+        until = self.degraded.get(key)
+        if until is None:
+            return False
+        if time.monotonic() >= until:
+            del self.degraded[key]
+            return False
+        return True
+
+    def remaining(self, key: Hashable) -> float:
+        """
+        :return: Seconds until the key is no longer degraded
+        """
+        return max(0.0, self.degraded[key] - time.monotonic()) if key in self.degraded else 0.0
+
+    def degrade(self, key: Hashable):
+        self.degraded[key] = time.monotonic() + self.degraded_cooldown
+
+    def restore(self, key: Hashable):
+        self.degraded.pop(key, None)
+
+    async def run(self, key: Hashable, name: str, callback: Callable, *args, timeout: Optional[float] = None,
+                  **kwargs) -> Any:
+        """
+        Runs the callback and returns its result.
+
+        :param key: The action or strategy the callback belongs to. Marked as degraded if the callback times out.
+        :param name: The name of the callback, used to look up its timeout
+        :param timeout: Overrides the configured timeouts for this call
+        :raises CallbackTimeout: If the callback did not finish in time
+        """
+        timeout = self.timeout_for(name, timeout)
+        if is_async(callback):
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            async with self.semaphore:
+                return await self._wait(key, name, callback(*args, **kwargs), timeout)
+        if self.pool is None:
+            return callback(*args, **kwargs)
+        future = asyncio.get_running_loop().run_in_executor(self.pool, partial(callback, *args, **kwargs))
+        return await self._wait(key, name, future, timeout)
+
+    async def _wait(self, key: Hashable, name: str, awaitable, timeout: Optional[float]) -> Any:
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            if key is not None:
+                self.degrade(key)
+            logger.warning(f"Callback {name} of {key} did not finish within {timeout}s and was abandoned")
+            raise CallbackTimeout(f"Callback {name} did not finish within {timeout}s")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,325 @@
+import bisect
+import itertools
+import sys
+import time
+import weakref
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from .dependencies import ALL, CLOCK
+
+MISSING = object()
+
+# the number of elements of a collection whose size is measured to estimate the size of the collection
+SAMPLE_SIZE = 8
+
+
+def estimate_size(value: Any, depth: int = 3) -> int:
+    """
+    Estimates the bytes held by a value, e.g. a dataset loaded into the context vector. NumPy arrays and columnar data
+    report their size, the size of other collections is extrapolated from a few of their elements.
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    size = sys.getsizeof(value, 0)
+    if depth <= 0 or isinstance(value, (str, bytes, bytearray)):
+        return size
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), SAMPLE_SIZE))
+        sampled = sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1) for k, v in items)
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        items = list(itertools.islice(value, SAMPLE_SIZE))
+        sampled = sum(estimate_size(item, depth - 1) for item in items)
+    else:
+        return size
+    return size + (sampled * len(value) // len(items) if items else 0)
+
+
+class Snapshot:
+    """
+    The context vector as it was at a version of the `StateHistory`. Attributes of the snapshot are read from the
+    history, so taking a snapshot copies nothing. Versions referenced by live snapshots are not compacted.
+    """
+
+    def __init__(self, history: 'StateHistory', version: int, time: float):
+        object.__setattr__(self, '_history', history)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'time', time)
+
+    def __getattr__(self, name: str):
+        value = self._history.value_at(name, self.version)
+        if value is MISSING:
+            raise AttributeError(f"The context vector had no attribute {name} at version {self.version}")
+        return value
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError("Snapshots are read-only")
+
+    def __repr__(self):
+        return f"Snapshot(version={self.version})"
+
+
+class StateHistory:
+    """
+    Records every change to the context vector as a new version holding only the changed attributes. Values are not
+    copied: unchanged attributes are shared by all versions, and changed ones by all versions until their next change.
+    Attributes modified in place rather than re-assigned are therefore not versioned.
+
+    The history keeps at most `max_versions` versions and, if `max_age` is set, versions of the last `max_age` seconds.
+    If `max_bytes` is set, the oldest versions are also dropped while the estimated size of the values they hold exceeds
+    it, so that replaced datasets are not kept alive by the history. Older versions are compacted into the base state,
+    unless a live snapshot still refers to them.
+
+    The engine makes the history available to callbacks as `ctx.history`, e.g. ::
+
+        is_applicable:
+          args: [ctx, delta]
+          load: |
+            return not ctx.history.changed('selection', within=30)
+    """
+
+    def __init__(self, state: Any, max_versions: int = 100, max_age: float = None, max_bytes: int = None):
+        """
+        :param state: The context vector whose attributes form the initial version
+        :param max_versions: The number of versions to keep
+        :param max_age: Seconds after which versions are compacted. None to only limit the number of versions.
+        :param max_bytes: The estimated size of the values held by the retained versions, see `estimate_size`. The
+        latest version is always kept. None to not limit the size.
+        """
+        self.max_versions = max(1, max_versions)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        # state before the first retained version
+        self.base: Dict[str, Any] = {name: value for name, value in vars(state).items() if name != 'history'}
+        self.offset = 1
+        # (time, changes) of each retained version, starting at version `offset`
+        self.entries: Deque[Tuple[float, Dict[str, Any]]] = deque()
+        # the estimated size of the values of each retained version, and their sum
+        self.sizes: Deque[int] = deque()
+        self.bytes = 0
+        # for each attribute, the retained versions in which it changed
+        self.index: Dict[str, List[int]] = {}
+        self.snapshots: 'weakref.WeakSet[Snapshot]' = weakref.WeakSet()
+        # snapshots taken when a suggestion preview started, by suggestion id
+        self.previews: Dict[str, Snapshot] = {}
+        # the client that started each preview
+        self.previewers: Dict[str, Optional[str]] = {}
+
+    def rebase(self, state: Any):
+        """
+        Replaces the state before the first version with the current attributes of the context vector, e.g. after it
+        was initialized.
+        """
+        self.base = {name: value for name, value in vars(state).items() if name != 'history'}
+
+    @property
+    def version(self) -> int:
+        return self.offset + len(self.entries) - 1
+
+    def record(self, changes: Dict[str, Any], now: float = None) -> int:
+        """
+        Records the changed attributes as a new version.
+
+        :return: The new version
+        """
+        changes = {name: value for name, value in changes.items() if name != 'history'}
+        if not changes:
+            return self.version
+        now = time.time() if now is None else now
+        self.entries.append((now, changes))
+        if self.max_bytes is not None:
+            size = sum(estimate_size(value) for value in changes.values())
+            self.sizes.append(size)
+            self.bytes += size
+        version = self.version
+        for name in changes:
+            self.index.setdefault(name, []).append(version)
+        self.compact(now)
+        return version
+
+    def record_reassigned(self, before: Dict[str, Any], state: Any, now: float = None) -> int:
+        """
+        Records all attributes of the context vector that were assigned a different object than in `before`, a shallow
+        copy of its attributes.
+        """
+        changes = {name: value for name, value in vars(state).items() if before.get(name, MISSING) is not value}
+        return self.record(changes, now)
+
+    def compact(self, now: float = None):
+        """
+        Merges versions exceeding `max_versions` or `max_bytes` or older than `max_age` into the base state.
+        """
+        keep = max(self.offset, self.version - self.max_versions + 1)
+        if self.max_age is not None:
+            now = time.time() if now is None else now
+            while keep - self.offset < len(self.entries) and self.entries[keep - self.offset][0] < now - self.max_age:
+                keep += 1
+        if self.max_bytes is not None:
+            size = self.bytes - sum(itertools.islice(self.sizes, 0, keep - self.offset))
+            while keep < self.version and size > self.max_bytes:
+                size -= self.sizes[keep - self.offset]
+                keep += 1
+        pinned = [snapshot.version + 1 for snapshot in self.snapshots]
+        keep = min([keep] + pinned)
+        if keep <= self.offset:
+            return
+        changed: Set[str] = set()
+        while self.offset < keep:
+            _, changes = self.entries.popleft()
+            if self.sizes:
+                self.bytes -= self.sizes.popleft()
+            self.base.update(changes)
+            changed.update(changes)
+            self.offset += 1
+        for name in changed:
+            versions = self.index[name]
+            del versions[:bisect.bisect_left(versions, self.offset)]
+            if not versions:
+                del self.index[name]
+
+    def value_at(self, name: str, version: int) -> Any:
+        """
+        :return: The value of the attribute at the given version, or MISSING
+        """
+        if version < self.offset - 1:
+            raise LookupError(f"Version {version} has been compacted, the oldest version is {self.offset - 1}")
+        versions = self.index.get(name, ())
+        i = bisect.bisect_right(versions, version)
+        if i == 0:
+            return self.base.get(name, MISSING)
+        return self.entries[versions[i - 1] - self.offset][1][name]
+
+    def snapshot(self) -> Snapshot:
+        """
+        :return: A read-only view of the current context vector. Taking a snapshot is O(1).
+        """
+        snapshot = Snapshot(self, self.version, time.time())
+        self.snapshots.add(snapshot)
+        return snapshot
+
+    def _since(self, within: Optional[float], since: Optional[Snapshot]) -> int:
+        """
+        :return: The first version in the window
+        """
+        if since is not None:
+            return since.version + 1
+        if within is None:
+            return self.offset
+        start = time.time() - within
+        first = self.version + 1
+        # versions are ordered by time, so search from the newest
+        for i in range(len(self.entries) - 1, -1, -1):
+            if self.entries[i][0] < start:
+                break
+            first = self.offset + i
+        return first
+
+    def changed(self, name: str, within: float = None, since: Snapshot = None) -> bool:
+        """
+        :return: Whether the attribute changed in the last `within` seconds or since the snapshot
+        """
+        versions = self.index.get(name, ())
+        return bool(versions) and versions[-1] >= self._since(within, since)
+
+    def values(self, name: str, within: float = None, since: Snapshot = None) -> List[Tuple[float, Any]]:
+        """
+        :return: (time, value) of each change of the attribute in the last `within` seconds or since the snapshot,
+        oldest first
+        """
+        versions = self.index.get(name, ())
+        first = bisect.bisect_left(versions, self._since(within, since))
+        return [(self.entries[v - self.offset][0], self.entries[v - self.offset][1][name]) for v in versions[first:]]
+
+    def deltas(self, within: float = None, since: Snapshot = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        :return: (time, changed attributes) of each version in the last `within` seconds or since the snapshot, oldest
+        first
+        """
+        first = self._since(within, since) - self.offset
+        return [self.entries[i] for i in range(max(0, first), len(self.entries))]
+
+    def changes(self, within: float = None, since: Snapshot = None) -> Dict[str, Any]:
+        """
+        :return: The latest value of each attribute that changed in the last `within` seconds or since the snapshot
+        """
+        merged = {}
+        for _, changes in self.deltas(within, since):
+            merged.update(changes)
+        return merged
+
+    def start_preview(self, suggestion_id: str, client_id: Optional[str] = None) -> Snapshot:
+        """
+        Takes the snapshot of a suggestion preview. It keeps the versions since from being compacted until the preview
+        ends or its client disconnects.
+        """
+        snapshot = self.previews[suggestion_id] = self.snapshot()
+        self.previewers[suggestion_id] = client_id
+        return snapshot
+
+    def end_preview(self, suggestion_id: str):
+        self.previews.pop(suggestion_id, None)
+        self.previewers.pop(suggestion_id, None)
+
+    def release_previews(self, client_id: Optional[str]) -> int:
+        """
+        Ends the previews started by the client, e.g. when it disconnected without ending them.
+
+        :return: The number of previews ended
+        """
+        ended = [suggestion_id for suggestion_id, previewer in self.previewers.items() if previewer == client_id]
+        for suggestion_id in ended:
+            self.end_preview(suggestion_id)
+        if ended:
+            self.compact()
+        return len(ended)
+
+    def preview(self, suggestion: Any) -> Optional[Snapshot]:
+        """
+        :return: The snapshot taken when the preview of the suggestion started, if it is being previewed
+        """
+        suggestion_id = getattr(getattr(suggestion, 'suggestion', None), 'id', suggestion)
+        return self.previews.get(suggestion_id)
+
+    def track_reads(self, reads: Set[str]) -> 'TrackedHistory':
+        return TrackedHistory(self, reads)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TrackedHistory:
+    """
+    The history as seen by callbacks whose reads are tracked. Queries record the attributes they depend on and, for
+    time windows, that the result can change as time passes.
+    """
+
+    def __init__(self, history: StateHistory, reads: Set[str]):
+        self._history = history
+        self._reads = reads
+
+    def _record(self, names: Iterable[str], within: Optional[float]):
+        self._reads.update(names)
+        if within is not None:
+            self._reads.add(CLOCK)
+
+    def changed(self, name: str, within: float = None, since: Snapshot = None) -> bool:
+        self._record([name], within)
+        return self._history.changed(name, within, since)
+
+    def values(self, name: str, within: float = None, since: Snapshot = None) -> List[Tuple[float, Any]]:
+        self._record([name], within)
+        return self._history.values(name, within, since)
+
+    def deltas(self, within: float = None, since: Snapshot = None) -> List[Tuple[float, Dict[str, Any]]]:
+        self._record([ALL], within)
+        return self._history.deltas(within, since)
+
+    def changes(self, within: float = None, since: Snapshot = None) -> Dict[str, Any]:
+        self._record([ALL], within)
+        return self._history.changes(within, since)
+
+    def __getattr__(self, name: str):
+        # snapshots and everything else are passed through without tracking
+        self._reads.add(ALL)
+        return getattr(self._history, name)
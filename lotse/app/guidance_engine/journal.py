@@ -0,0 +1,498 @@
+import asyncio
+import contextlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import quote
+
+from lotse.action import ConditionalGuidanceAction
+from lotse.strategy import Strategy
+from lotse.suggestion import SuggestionModel
+from .loader import LazyAction, runtime_state
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# length and crc32 of each record in the journal
+HEADER = struct.Struct('>II')
+
+# attributes of the context vector that are not persisted
+LOCAL_ATTRIBUTES = {'history'}
+
+# identifies a strategy by its file relative to the strategy path, and an action by its strategy file and attribute
+OwnerRef = Tuple[str, ...]
+
+_MISSING = object()
+
+# writes the snapshots of all journals one after the other, in the order they were taken
+WRITER = ThreadPoolExecutor(1, thread_name_prefix='lotse-journal')
+
+
+def _picklable(values: Dict[str, Any], owner: str) -> Dict[str, Any]:
+    try:
+        pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+        return values
+    except Exception:
+        pass
+    picklable = {}
+    for name, value in values.items():
+        try:
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug("Attribute %s of %s cannot be persisted", name, owner)
+            continue
+        picklable[name] = value
+    return picklable
+
+
+def _records(path: str) -> Iterator[tuple]:
+    """
+    Reads the records of a journal, up to the first incomplete or corrupt one, e.g. one written while the process died.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                return
+            if len(header) == HEADER.size:
+                length, checksum = HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) == length and zlib.crc32(data) == checksum:
+                    yield pickle.loads(data)
+                    continue
+            logger.warning("Ignoring the incomplete end of journal %s", path)
+            return
+
+
+class EngineJournal:
+    """
+    Persists the runtime state of an engine: changes to its context vector, the suggestions it made and removed, the
+    runtime state of its actions and strategies (e.g. their `suggested` flag, or parameters adapted in `accept` and
+    `reject`) and which strategies are applicable. Events are appended to a journal, which is compacted into a snapshot
+    every `snapshot_every` records, in the background when journaled from the event loop. `restore` applies the
+    snapshot and the journal written since.
+
+    Updates made by callbacks of the state vector are journaled as the call and executed again on restore, rows appended
+    to data sources as the appended rows. Attributes of the state vector that `accept`, `reject`, `retract` and the
+    preview callbacks reassign are journaled as values; modifications of their values in place are only persisted by the
+    next snapshot.
+    """
+
+    def __init__(self, engine: Any, path: str, snapshot_every: int = 1000, sync: bool = False):
+        """
+        :param engine: The `LotseEngine` to persist
+        :param path: The path of the journal and snapshot files, without extension
+        :param snapshot_every: The number of records after which the journal is compacted into a snapshot
+        :param sync: Whether to fsync every record, to survive a crash of the machine rather than only of the process
+        """
+        self.engine = engine
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.seq = 0
+        self.pending = 0
+        # when each live suggestion was made, to restore its expiry
+        self.made_at: Dict[str, float] = {}
+        self.file = None
+        # the snapshot being written in the background, see `schedule_checkpoint`
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def journal_file(self) -> str:
+        return self.path + '.journal'
+
+    @property
+    def snapshot_file(self) -> str:
+        return self.path + '.snapshot'
+
+    def _ref(self, owner: Any) -> Optional[OwnerRef]:
+        engine = self.engine
+        strategy = owner.strategy if isinstance(owner, ConditionalGuidanceAction) else owner
+        source = engine.loader.source(strategy)
+        if source is None:
+            return None
+        file = os.path.relpath(source.path, engine.strategy_path)
+        if strategy is owner:
+            return file,
+        for name, value in vars(strategy).items():
+            if value is owner:
+                return file, name
+        return None
+
+    def _resolve(self, ref: OwnerRef) -> Any:
+        strategies = self._strategies()
+        strategy = strategies.get(ref[0])
+        if strategy is None or len(ref) == 1:
+            return strategy
+        action = vars(strategy).get(ref[1])
+        if isinstance(action, LazyAction):
+            action = strategy.__dict__[ref[1]] = action.load(strategy)
+        return action if isinstance(action, ConditionalGuidanceAction) else None
+
+    def _strategies(self) -> Dict[str, Strategy]:
+        strategies = {}
+        for strategy in self.engine.strategies:
+            ref = self._ref(strategy)
+            if ref is not None:
+                strategies[ref[0]] = strategy
+        return strategies
+
+    def _state(self, owner: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        :return: The runtime state of the action or strategy, and the yaml declarations of the persisted attributes
+        """
+        return self._declared(_picklable(runtime_state(owner), type(owner).__name__), self.engine.loader.source(owner))
+
+    @staticmethod
+    def _declared(state: Dict[str, Any], source: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        declarations = source.data if source is not None else {}
+        return state, {name: declarations[name] for name in state if name in declarations}
+
+    def _restore_state(self, owner: Any, state: Dict[str, Any], declared: Dict[str, Any]):
+        # like `StrategyLoader.carry`, attributes whose declaration changed since they were persisted are not restored
+        source = self.engine.loader.source(owner)
+        declarations = source.data if source is not None else {}
+        for name, value in state.items():
+            if name in declarations:
+                if declared.get(name, _MISSING) != declarations[name]:
+                    continue
+            elif name in declared:
+                continue
+            owner.__dict__[name] = value
+
+    def _context(self) -> Dict[str, Any]:
+        context = self.engine.current_state
+        shared = set(getattr(context, 'shared_attributes', None) or [])
+        # attributes listed in `shared_attributes` are large, read-only data loaded from the yaml
+        return {name: value for name, value in vars(context).items()
+                if name not in LOCAL_ATTRIBUTES and name not in shared and not callable(value)}
+
+    def _append(self, kind: str, payload: Any):
+        if self.file is None:
+            return
+        try:
+            data = pickle.dumps((self.seq + 1, kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.warning("Could not journal %s record", kind, exc_info=True)
+            return
+        self.seq += 1
+        self.file.write(HEADER.pack(len(data), zlib.crc32(data)) + data)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.pending += 1
+        if self.pending >= self.snapshot_every and not self.schedule_checkpoint():
+            self.checkpoint()
+
+    def updated(self, updates: Dict[str, Any]):
+        """
+        Records values assigned to attributes of the context vector.
+        """
+        updates = {name: value for name, value in updates.items() if name not in LOCAL_ATTRIBUTES}
+        if updates:
+            self._append('update', _picklable(updates, 'the state vector'))
+
+    def called(self, callback: str, params: Dict[str, Any]):
+        """
+        Records the execution of a callback of the context vector, which is repeated on restore.
+        """
+        self._append('callback', (callback, params))
+
+    def appended(self, attribute: str, rows: Any):
+        """
+        Records rows appended to a data source of the context vector.
+        """
+        self._append('append', (attribute, rows))
+
+    def adapted(self, owners: Iterable[Any]):
+        """
+        Records the runtime state of actions or strategies.
+        """
+        for owner in owners:
+            ref = self._ref(owner)
+            if ref is not None:
+                self._append('state', (ref, *self._state(owner)))
+
+    def made(self, suggestions: Iterable[SuggestionModel]):
+        now = time.time()
+        for suggestion in suggestions:
+            ref = self._ref(suggestion.action)
+            if ref is None:
+                continue
+            self.made_at[suggestion.suggestion.id] = now
+            self._append('make', (json.loads(suggestion.json()), ref, now))
+
+    def removed(self, suggestion_id: str):
+        if self.made_at.pop(suggestion_id, None) is not None:
+            self._append('remove', suggestion_id)
+
+    def applicable(self, strategies: Iterable[Strategy]):
+        self._append('applicable', [ref[0] for ref in map(self._ref, strategies) if ref is not None])
+
+    @contextlib.contextmanager
+    def observe(self, action: ConditionalGuidanceAction):
+        """
+        Records the attributes of the context vector reassigned while the block is executed, and the state of the action
+        and its strategy afterwards.
+        """
+        before = dict(vars(self.engine.current_state))
+        yield
+        self.updated({name: value for name, value in vars(self.engine.current_state).items()
+                      if before.get(name, _MISSING) is not value})
+        self.adapted([action, action.strategy])
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """
+        :return: The snapshot of the engine, referring to the values of its context vector and runtime state rather than
+        copying them. Values that cannot be pickled are only left out when it is written.
+        """
+        engine = self.engine
+        owners = []
+        for strategy in engine.strategies:
+            owners.append(strategy)
+            owners.extend(value for value in vars(strategy).values() if isinstance(value, ConditionalGuidanceAction))
+        return {
+            'version': SNAPSHOT_VERSION,
+            'seq': self.seq,
+            'context': self._context(),
+            'owners': [(ref, runtime_state(owner), type(owner).__name__, engine.loader.source(owner))
+                       for ref, owner in ((self._ref(o), o) for o in owners) if ref is not None],
+            'applicable': [ref[0] for ref in map(self._ref, engine.applicable_strategies) if ref is not None],
+            'suggestions': [(json.loads(s.json()), self._ref(s.action), self.made_at.get(s.suggestion.id, time.time()))
+                            for s in engine.suggestions if self._ref(s.action) is not None],
+        }
+
+    def _write(self, snapshot: Dict[str, Any]):
+        snapshot['context'] = _picklable(snapshot['context'], 'the state vector')
+        snapshot['owners'] = [(ref, *self._declared(_picklable(state, owner), source))
+                              for ref, state, owner, source in snapshot['owners']]
+        temporary = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary, self.snapshot_file)
+
+    def _truncate(self, seq: int):
+        # records up to `seq` are part of the snapshot, and skipped on restore if truncating fails. Records journaled
+        # while the snapshot was written are kept until the next snapshot.
+        if self.seq != seq and self.file is not None:
+            self.pending = self.seq - seq
+            return
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_file, 'wb')
+        self.pending = 0
+
+    def checkpoint(self):
+        """
+        Writes a snapshot of the engine and truncates the journal.
+        """
+        snapshot = self._snapshot()
+        WRITER.submit(self._write, snapshot).result()
+        self._truncate(snapshot['seq'])
+
+    async def checkpoint_async(self):
+        """
+        Writes a snapshot like `checkpoint`, but pickles and writes it in a thread, so that the event loop keeps serving
+        requests and other engines. The engine's lock is held meanwhile, so that its context vector is not modified
+        while it is pickled.
+        """
+        async with self.engine.lock:
+            if self.file is None:
+                # closed in the meantime, with a final snapshot
+                return
+            snapshot = self._snapshot()
+            await asyncio.get_running_loop().run_in_executor(WRITER, self._write, snapshot)
+            if self.file is not None:
+                self._truncate(snapshot['seq'])
+
+    def schedule_checkpoint(self) -> bool:
+        """
+        Writes a snapshot with `checkpoint_async` if called from the event loop, unless one is being written already.
+
+        :return: Whether the snapshot is written in the background. Otherwise, call `checkpoint`.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._checkpoint_in_background())
+        return True
+
+    async def _checkpoint_in_background(self):
+        try:
+            await self.checkpoint_async()
+        except OSError:
+            logger.exception("Could not write snapshot %s", self.snapshot_file)
+
+    def restore(self) -> bool:
+        """
+        Restores the engine from the snapshot and the journal, and starts journaling. Strategies and actions that no
+        longer exist are skipped, as are the suggestions of removed actions.
+
+        :return: Whether there was anything to restore
+        """
+        start = time.perf_counter()
+        engine = self.engine
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            snapshot = None
+        except Exception:
+            logger.exception("Could not read snapshot %s, restoring from the journal only", self.snapshot_file)
+            snapshot = None
+        if snapshot is not None and snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning("Ignoring snapshot %s written by an incompatible version", self.snapshot_file)
+            snapshot = None
+        applicable = None
+        records = 0
+        if snapshot is not None:
+            self.seq = snapshot['seq']
+            engine.current_state.__dict__.update(snapshot['context'])
+            for ref, state, declared in snapshot['owners']:
+                self._apply('state', (ref, state, declared))
+            applicable = snapshot['applicable']
+            for suggestion in snapshot['suggestions']:
+                self._apply('make', suggestion)
+        for seq, kind, payload in _records(self.journal_file):
+            if seq <= self.seq:
+                continue
+            self.seq = seq
+            records += 1
+            if kind == 'applicable':
+                applicable = payload
+            else:
+                self._apply(kind, payload)
+        if snapshot is None and not records:
+            self.checkpoint()
+            return False
+        if applicable is not None:
+            strategies = self._strategies()
+            engine.applicable_strategies = [strategies[file] for file in applicable if file in strategies]
+        engine.generate_conditional_actions()
+        engine.history.rebase(engine.current_state)
+        engine.mark_changed(None)
+        # compact right away, which also drops an incomplete record at the end of the journal
+        self.checkpoint()
+        logger.info("Restored %s and %d journal records with %d suggestions in %.1fms", self.snapshot_file, records,
+                    len(engine.suggestions), (time.perf_counter() - start) * 1000)
+        return True
+
+    def _apply(self, kind: str, payload: Any):
+        engine = self.engine
+        if kind == 'update':
+            engine.current_state.__dict__.update(payload)
+        elif kind == 'callback':
+            callback, params = payload
+            try:
+                result = getattr(engine.current_state, callback)(**params)
+                if inspect.iscoroutine(result):
+                    # `async` callbacks, restore may be called while the engine's event loop is running
+                    with ThreadPoolExecutor(1) as thread:
+                        result = thread.submit(asyncio.run, result).result()
+                engine.record_delta(result)
+            except Exception:
+                logger.exception("Could not repeat callback %s of the state vector", callback)
+        elif kind == 'append':
+            attribute, rows = payload
+            try:
+                engine.append_rows(attribute, rows)
+            except Exception:
+                logger.exception("Could not append rows to %s of the state vector", attribute)
+        elif kind == 'state':
+            ref, state, declared = payload
+            owner = self._resolve(ref)
+            if owner is not None:
+                self._restore_state(owner, state, declared)
+        elif kind == 'make':
+            data, ref, made = payload
+            action = self._resolve(ref)
+            if action is None:
+                logger.debug("Dropping suggestion %s, its action %s no longer exists", data['suggestion']['id'], ref)
+                return
+            suggestion = SuggestionModel(**data, action=action)
+            self.made_at[suggestion.suggestion.id] = made
+            for removed in engine.suggestions.add(suggestion, now=made):
+                self.made_at.pop(removed.suggestion.id, None)
+        elif kind == 'remove':
+            self.made_at.pop(payload, None)
+            engine.suggestions.remove(payload)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class JournalStore:
+    """
+    Keeps a journal and snapshot per engine in a directory, so that engines resume where they left off after a restart.
+    Workers sharing the directory can take over each other's engines.
+    """
+
+    def __init__(self, directory: str, snapshot_every: int = 1000, sync: bool = False):
+        """
+        :param directory: Where to keep the journals and snapshots
+        :param snapshot_every: The number of records after which a journal is compacted into a snapshot
+        :param sync: Whether to fsync every record, to survive a crash of the machine rather than only of the process
+        """
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+
+    def attach(self, engine: Any, key: str) -> EngineJournal:
+        """
+        Restores the engine from the journal with the given key, e.g. the client id of its session, and journals its
+        changes from now on.
+        """
+        journal = EngineJournal(engine, os.path.join(self.directory, quote(key, safe='')), self.snapshot_every,
+                                self.sync)
+        try:
+            journal.restore()
+        except Exception:
+            logger.exception("Could not restore %s completely", journal.path)
+            journal.checkpoint()
+        engine.journal = journal
+        return journal
+
+    def checkpoint(self, engine: Any, background: bool = True):
+        """
+        Writes a snapshot of the engine and keeps journaling it, e.g. when the guidance engine is stopped temporarily.
+
+        :param background: Whether to write the snapshot in the background when called from the event loop
+        """
+        journal = engine.journal
+        if journal is None or background and journal.schedule_checkpoint():
+            return
+        try:
+            journal.checkpoint()
+        except OSError:
+            logger.exception("Could not write snapshot %s", journal.snapshot_file)
+
+    def detach(self, engine: Any):
+        """
+        Writes a snapshot of the engine and stops journaling it, e.g. when its session is evicted.
+        """
+        journal = engine.journal
+        if journal is None:
+            return
+        self.checkpoint(engine, background=False)
+        engine.journal = None
+        journal.close()
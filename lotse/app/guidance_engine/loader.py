@@ -0,0 +1,389 @@
+import ast
+import hashlib
+import json
+import logging
+import marshal
+import os
+import pickle
+import sys
+from functools import partial
+from typing import Any, Dict, Optional, Set, Tuple
+
+import requests
+import rickled
+import yaml
+from rickled import Rickle
+
+from lotse.action import ConditionalGuidanceAction
+from lotse.data import ColumnStore
+from lotse.strategy import Strategy
+from .conditions import Condition
+from .memo import memoize
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+
+# callbacks rickled compiles even without `type: function`
+CALLBACK_NAMES = {'condition', 'is_applicable', 'determine_applicability', 'accept', 'reject', 'preview_start',
+                  'preview_end', 'generate_suggestion_content', 'initialize', 'filter_actions'}
+# callbacks that can be declared as conditions with `when` instead of `load`
+CONDITION_NAMES = {'is_applicable', 'determine_applicability'}
+# typed entries rickled handles before looking at `file_path`
+DATA_TYPES = {'env', 'base64', 'module_import', 'from_csv', 'api_json'}
+
+# attribute holding the digest of the file an object was built from
+SOURCE = '_source'
+
+# callbacks have always been executed in the namespace of the rickled module and may rely on its imports
+CALLBACK_GLOBALS = vars(rickled)
+
+
+def _is_condition(name: str, value: Any) -> bool:
+    return name in CONDITION_NAMES and isinstance(value, dict) and 'when' in value
+
+
+def _is_callback(name: str, value: Any) -> bool:
+    return isinstance(value, dict) and (name in CALLBACK_NAMES or value.get('type') == 'function') \
+        and not _is_condition(name, value)
+
+
+def _function_source(name: str, entry: dict) -> str:
+    args = entry.get('args', None)
+    if isinstance(args, dict):
+        params = ['self'] + [f"{arg}={default!r}" for arg, default in args.items()]
+    else:
+        params = ['self'] + list(args or [])
+    body = entry['load'].replace("\n", "\n  ")
+    # callbacks declared with `async: true` are awaited by the engine
+    prefix = 'async def' if entry.get('async', False) else 'def'
+    return f"{prefix} {name}({','.join(params)}):\n  {body}"
+
+
+def _compile_function(name: str, entry: dict, path: str, line: Optional[int]):
+    """
+    Compiles the callback so that its code refers to the lines of `load` in the yaml file, e.g. in tracebacks and
+    profiles.
+
+    :param line: The line of the yaml file the code in `load` starts at
+    """
+    tree = ast.parse(_function_source(name, entry), path)
+    if line is not None:
+        # the code starts in the second line of the function source
+        ast.increment_lineno(tree, line - 2)
+    return compile(tree, path, 'exec')
+
+
+def _load_lines(node: Optional[yaml.Node]) -> Dict[str, int]:
+    """
+    :return: The line at which the code in `load` of each top-level entry starts, by entry name
+    """
+    lines = {}
+    if not isinstance(node, yaml.MappingNode):
+        return lines
+    for key, value in node.value:
+        if not isinstance(value, yaml.MappingNode):
+            continue
+        for field, code in value.value:
+            if field.value == 'load' and isinstance(code, yaml.ScalarNode):
+                # block scalars start in the line after their indicator, marks count lines from 0
+                lines[key.value] = code.start_mark.line + (2 if code.style in ('|', '>') else 1)
+    return lines
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _declarations(obj: Any, loader: 'StrategyLoader') -> dict:
+    source = loader.source(obj)
+    return source.data if source is not None else {}
+
+
+def _columnar(entry: dict, base_path: str) -> ColumnStore:
+    """
+    Loads a `type: columnar` entry from a csv or json `file_path`, or from a `url` returning a json list of records.
+    Without either, the store starts empty with the given `columns`, to be filled by appending rows.
+    """
+    indexes = entry.get('indexes', None)
+    aggregates = entry.get('aggregates', None)
+    if 'url' in entry:
+        response = requests.request(entry.get('http_verb', 'GET'), entry['url'], headers=entry.get('headers', None),
+                                    params=entry.get('params', None))
+        response.raise_for_status()
+        return ColumnStore.from_records(response.json(), indexes, aggregates)
+    if 'file_path' not in entry:
+        return ColumnStore.from_records([], indexes, aggregates, entry.get('columns', ()))
+    path = os.path.join(base_path, entry['file_path'])
+    encoding = entry.get('encoding', 'utf-8')
+    if path.endswith('.json'):
+        return ColumnStore.from_json(path, indexes, encoding, aggregates)
+    return ColumnStore.from_csv(path, indexes, entry.get('fieldnames', None), encoding, entry.get('delimiter', ','),
+                                aggregates)
+
+
+class CompiledFile:
+    """
+    A parsed yaml file together with the compiled code of the callbacks it defines.
+    """
+
+    def __init__(self, path: str, digest: str, data: dict, code: Dict[str, bytes]):
+        """
+        :param path: The absolute path of the yaml file
+        :param digest: The hash of the file content the data and code were compiled from
+        :param data: The parsed yaml
+        :param code: The marshalled code objects of all top-level callbacks, by attribute name
+        """
+        self.path = path
+        self.digest = digest
+        self.data = data
+        self.code = code
+
+
+class LazyAction:
+    """
+    Stands in for the action of a strategy until the strategy is applicable for the first time. See `resolve`.
+    """
+
+    def __init__(self, loader: 'StrategyLoader', file: CompiledFile, base_path: str):
+        self.loader = loader
+        self.file = file
+        self.base_path = base_path
+
+    def load(self, strategy) -> ConditionalGuidanceAction:
+        action = ConditionalGuidanceAction(strategy=strategy, condition=None)
+        return self.loader.build(self.file, action, self.base_path)
+
+    def __deepcopy__(self, memo):
+        # each copy of a strategy builds its own action once it needs it
+        return self
+
+
+def runtime_state(obj: Any) -> Dict[str, Any]:
+    """
+    :return: The attributes of a strategy, action or state vector that can change at runtime, i.e. all but its
+    callbacks, conditions and actions
+    """
+    return {name: value for name, value in vars(obj).items()
+            if name != SOURCE and not callable(value) and not isinstance(value, (Condition, LazyAction, Strategy,
+                                                                                 ConditionalGuidanceAction))}
+
+
+def resolve(strategy) -> Any:
+    """
+    Builds all actions of the strategy that have not been loaded yet.
+    """
+    for name, value in list(vars(strategy).items()):
+        if isinstance(value, LazyAction):
+            setattr(strategy, name, value.load(strategy))
+    return strategy
+
+
+class StrategyLoader:
+    """
+    Builds strategies, actions, the meta strategy and the state vector from their yaml files like rickled's
+    `ObjectRickler.from_rickle`, but parses each file and compiles its callbacks only when the file changed.
+
+    Parsed files and compiled code are cached in memory and, if `cache_dir` is set, on disk, keyed by the hash of the file
+    content. Entries that load data (`from_csv`, `api_json`, ...) are not cached and are loaded with rickled every time.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, lazy_actions: bool = True):
+        """
+        :param cache_dir: The directory for compiled files. None to cache in memory only.
+        :param lazy_actions: Whether to build the actions of strategies only once the strategy is first applicable
+        """
+        self.cache_dir = cache_dir
+        self.lazy_actions = lazy_actions
+        self.files: Dict[str, CompiledFile] = {}
+        self.functions: Dict[Tuple[str, str], Any] = {}
+        # every version of every file read so far, by digest, to compare objects built from older versions
+        self.sources: Dict[str, CompiledFile] = {}
+        # modification time and size of each file when it was last read, and the files it references
+        self.stats: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.references: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, file: str, cls, base_path: str, **args):
+        """
+        Creates an instance of `cls` from the yaml file.
+
+        :param file: The yaml file, relative to `base_path` or absolute
+        :param base_path: The directory relative to which files referenced in the yaml are resolved
+        :param args: Passed to the constructor of `cls`
+        """
+        compiled = self.read(self._locate(file, base_path), base_path)
+        return self.build(compiled, cls(**args), base_path)
+
+    def read(self, path: str, base_path: str) -> CompiledFile:
+        """
+        Returns the parsed and compiled yaml file, from the cache if its content did not change.
+        """
+        path = os.path.abspath(path)
+        self.stats[path] = _stat(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(b'\0'.join([str(CACHE_VERSION).encode(), sys.implementation.cache_tag.encode(),
+                                            os.path.abspath(base_path).encode(), content])).hexdigest()
+        compiled = self.files.get(path)
+        if compiled is None or compiled.digest != digest:
+            compiled = self._read_cache(path, digest)
+        if compiled is None:
+            self.misses += 1
+            compiled = self._compile(path, digest, content.decode('utf-8'), base_path)
+            self._write_cache(compiled)
+        else:
+            self.hits += 1
+        self.files[path] = compiled
+        self.sources[digest] = compiled
+        return compiled
+
+    def build(self, compiled: CompiledFile, obj, base_path: str):
+        """
+        Sets the attributes and callbacks defined in the compiled file on the object.
+        """
+        remainder = {}
+        for name, value in compiled.data.items():
+            if name in compiled.code:
+                for module in value.get('import', None) or []:
+                    exec(module if 'import' in module else f'import {module}', CALLBACK_GLOBALS)
+                attribute = name if name in CALLBACK_NAMES else value.get('name', name)
+                obj.__dict__[attribute] = memoize(partial(self._function(compiled, name), obj), value.get('cache'))
+            elif _is_condition(name, value):
+                obj.__dict__[name] = Condition(value['when'], obj)
+            elif isinstance(value, dict) and value.get('type') == 'columnar':
+                obj.__dict__[name] = _columnar(value, base_path)
+            elif isinstance(value, dict) and 'file_path' in value and value.get('type') not in DATA_TYPES \
+                    and value.get('load_as_rick', True) and not value.get('is_binary', False):
+                referenced = self.read(self._locate(value['file_path'], base_path), base_path)
+                self.references.setdefault(compiled.path, set()).add(referenced.path)
+                if referenced.data.get('type') != 'action':
+                    remainder[name] = value
+                elif self.lazy_actions and isinstance(obj, Strategy):
+                    obj.__dict__[name] = LazyAction(self, referenced, base_path)
+                else:
+                    action = ConditionalGuidanceAction(strategy=obj, condition=None)
+                    obj.__dict__[name] = self.build(referenced, action, base_path)
+            elif isinstance(value, dict) or (isinstance(value, list) and any(isinstance(v, dict) for v in value)):
+                remainder[name] = value
+            else:
+                obj.__dict__[name] = value
+        if remainder:
+            # data entries and nested structures are loaded exactly as before
+            rickle = Rickle(remainder, deep=True, load_lambda=True, path=base_path)
+            for name, value in rickle.dict().items():
+                if isinstance(value, dict) and 'type' in value.keys():
+                    continue
+                obj.__dict__[name] = value
+        obj.__dict__[SOURCE] = compiled.digest
+        return obj
+
+    def source(self, obj: Any) -> Optional[CompiledFile]:
+        """
+        :return: The version of the yaml file the object was built from
+        """
+        if isinstance(obj, LazyAction):
+            return obj.file
+        return self.sources.get(getattr(obj, SOURCE, None))
+
+    def changed(self) -> Set[str]:
+        """
+        :return: The paths of all files read so far that were modified or deleted since. Deleted files are reported once.
+        """
+        changed = set()
+        for path, stat in list(self.stats.items()):
+            current = _stat(path)
+            if current != stat:
+                changed.add(path)
+                if current is None:
+                    del self.stats[path]
+        return changed
+
+    def dependencies(self, path: str) -> Set[str]:
+        """
+        :return: All files the file references, directly or indirectly
+        """
+        dependencies, pending = set(), [os.path.abspath(path)]
+        while pending:
+            for referenced in self.references.get(pending.pop(), ()):
+                if referenced not in dependencies:
+                    dependencies.add(referenced)
+                    pending.append(referenced)
+        return dependencies
+
+    def carry(self, old: Any, new: Any):
+        """
+        Copies the runtime state of an object built from an older version of its yaml file to the object built from the
+        new version. Attributes keep their current value if their declaration did not change, e.g. parameters adapted in
+        `accept` or `reject`, and attributes set at runtime only are copied unless the new file declares them.
+        Callbacks, conditions and actions are never copied.
+        """
+        before, after = _declarations(old, self), _declarations(new, self)
+        for name, value in runtime_state(old).items():
+            if name in after:
+                if name in before and before[name] == after[name]:
+                    new.__dict__[name] = value
+            elif name not in before and name not in vars(new):
+                new.__dict__[name] = value
+
+    def _function(self, compiled: CompiledFile, name: str):
+        function = self.functions.get((compiled.digest, name))
+        if function is None:
+            namespace = {}
+            exec(marshal.loads(compiled.code[name]), CALLBACK_GLOBALS, namespace)
+            function = self.functions[(compiled.digest, name)] = namespace[name]
+        return function
+
+    def _compile(self, path: str, digest: str, content: str, base_path: str) -> CompiledFile:
+        logger.debug(f"Compiling {path}")
+        # rickled substitutes its init args in the raw yaml
+        for key, value in {'path': base_path, 'load_lambda': True, 'deep': True}.items():
+            content = content.replace(f'_|{key}|_', json.dumps(value))
+        parser = yaml.SafeLoader(content)
+        try:
+            node = parser.get_single_node()
+            data = (parser.construct_document(node) if node is not None else None) or {}
+        finally:
+            parser.dispose()
+        lines = _load_lines(node)
+        code = {name: marshal.dumps(_compile_function(name, value, path, lines.get(name)))
+                for name, value in data.items() if _is_callback(name, value)}
+        return CompiledFile(path, digest, data, code)
+
+    def _cache_file(self, path: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest() + '.pickle')
+
+    def _read_cache(self, path: str, digest: str) -> Optional[CompiledFile]:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                compiled = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+        return compiled if isinstance(compiled, CompiledFile) and compiled.digest == digest else None
+
+    def _write_cache(self, compiled: CompiledFile):
+        if self.cache_dir is None:
+            return
+        target = self._cache_file(compiled.path)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # several workers may start at once, so write to a temporary file and replace atomically
+            temporary = f"{target}.{os.getpid()}.tmp"
+            with open(temporary, 'wb') as f:
+                pickle.dump(compiled, f)
+            os.replace(temporary, target)
+        except OSError:
+            logger.warning(f"Could not write strategy cache to {self.cache_dir}", exc_info=True)
+
+    @staticmethod
+    def _locate(file: str, base_path: str) -> str:
+        # like rickled, look relative to the base path first
+        path = os.path.join(base_path, file)
+        return path if os.path.isfile(path) else file
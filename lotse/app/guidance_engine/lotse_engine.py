@@ -1,13 +1,31 @@
+import asyncio
+import contextlib
+import copy
 import logging
 import os.path
-from typing import List
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Union
 
-from rickled import ObjectRickler, Rickle
+import numpy as np
 
 from lotse.action import ConditionalGuidanceAction
+from lotse.data import AppendedRows, ColumnStore
 from lotse.strategy import Strategy
 from lotse.suggestion import SuggestionModel
 from lotse.meta_strategy import MetaStrategy
+from .budget import GuidanceBudget
+from .conditions import Condition, ConditionNetwork
+from .dependencies import DependencyTracker, tracked
+from .executor import CallbackExecutor, CallbackTimeout, is_async
+from .history import MISSING, StateHistory
+from .journal import EngineJournal
+from .memo import memoized
+from .parallel import SharedSnapshot, StrategyPool
+from .profiler import profiler
+from .metrics import ACTIONS_DEFERRED, ACTIONS_EVALUATED, CALLBACK_SECONDS, CALLBACK_TIMEOUTS, SUGGESTIONS_DEDUPLICATED, \
+    SUGGESTIONS_MADE, SUGGESTIONS_RETRACTED
+from .loader import LazyAction, StrategyLoader, resolve
+from .suggestion_store import SuggestionPolicy, SuggestionStore
 
 
 class ContextVector:
@@ -15,76 +33,833 @@ class ContextVector:
         pass
 
 
+def _metadata(owner: Any) -> dict:
+    return getattr(owner, 'metadata', None) or {}
+
+
+def _label(owner: Any) -> str:
+    """
+    :return: The id of the action or strategy, used to label metrics
+    """
+    if owner is None:
+        return 'engine'
+    metadata = _metadata(owner)
+    return str(metadata.get('action_id') or metadata.get('strategy_id') or metadata.get('strategy') or
+               type(owner).__name__)
+
+
+def _trigger(action: Any) -> Optional[dict]:
+    trigger = getattr(action, 'trigger', None)
+    return trigger if isinstance(trigger, dict) else None
+
+
+def _retracted(action: ConditionalGuidanceAction, context, delta, suggestions: List[SuggestionModel]):
+    return [s for s in suggestions if action.should_retract(context, delta, s)]
+
+
+async def _retracted_async(action: ConditionalGuidanceAction, context, delta, suggestions: List[SuggestionModel]):
+    retract = await asyncio.gather(*(action.should_retract(context, delta, s) for s in suggestions))
+    return [s for s, r in zip(suggestions, retract) if r]
+
+
 class LotseEngine:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, strategy_path: str, state_path: str, meta: str):
+    def __init__(self, strategy_path: str, state_path: str, meta: str, executor: CallbackExecutor = None,
+                 loader: StrategyLoader = None, policy: SuggestionPolicy = None, history_size: int = 100,
+                 history_age: float = None, pool: StrategyPool = None, history_bytes: Optional[int] = 64 * 2 ** 20):
         """
 
         :param strategy_path: The path from which to read the strategy config files
+        :param executor: The executor running the callbacks defined in the yaml files. Defaults to a thread pool.
+        :param loader: The loader used to parse the yaml files. Defaults to a loader caching in memory only.
+        :param policy: Limits the lifetime and number of suggestions. Defaults to deduplication only.
+        :param history_size: The number of versions of the context vector kept in its history
+        :param history_age: Seconds after which versions of the context vector are dropped from its history
+        :param history_bytes: The estimated size of the values kept in the history of the context vector, beyond which
+        its oldest versions are dropped. None to not limit the size.
+        :param pool: Worker processes evaluating the applicability of strategies in parallel. None to evaluate them in
+        the executor.
         """
+        self.executor = executor or CallbackExecutor()
+        self.loader = loader or StrategyLoader()
+        self.policy = policy or SuggestionPolicy()
+        self.history_size = history_size
+        self.history_age = history_age
+        self.history_bytes = history_bytes
+        self.pool = pool
+        # persists the engine's runtime state, see `JournalStore.attach`
+        self.journal: Optional[EngineJournal] = None
+        self.strategy_path = strategy_path
         self.strategies: List[Strategy] = []
         self.meta_strategy = MetaStrategy()
         self.applicable_strategies = []
-        rickler = ObjectRickler()
 
-        files = [file for file in os.listdir(strategy_path) if
-                 os.path.isfile(os.path.join(strategy_path, file)) and file.endswith('.yaml') and not file == 'meta.yaml']
+        files = self.strategy_files()
         self.logger.debug(f"Loading files {files}")
         for file in files:
             self.logger.debug(f"Loading file {file}")
-            rickle = Rickle(file, deep=True, load_lambda=True, path=strategy_path)
-            strat = rickler.from_rickle(rickle, Strategy)
+            strat = self.loader.load(file, Strategy, strategy_path)
             self.strategies.append(strat)
         self.logger.info(f"Guidance engine initialized {len(self.strategies)} strategies.")
 
         meta = os.path.join(strategy_path, 'meta.yaml')
         if os.path.isfile(meta):
-            rickle = Rickle(meta, deep=True, load_lambda=True, path=strategy_path)
-            self.meta_strategy = rickler.from_rickle(rickle, MetaStrategy)
-            print("Successfully loaded meta strategy.")
+            self.meta_strategy = self.loader.load(meta, MetaStrategy, strategy_path)
+            self.logger.info("Successfully loaded meta strategy.")
 
         state = os.path.join(state_path, 'vector.yaml')
-        state_vector_rick = Rickle(state, deep=True, load_lambda=True, path=state_path)
-        state_vector: ContextVector = rickler.from_rickle(state_vector_rick, ContextVector)
+        state_vector: ContextVector = self.loader.load(state, ContextVector, state_path)
         state_vector.initialize()
-        print(state_vector.__dict__)
+        self.logger.debug("Initialized state vector %s", state_vector.__dict__)
+        self.logger.info(f"Loaded {self.loader.hits} yaml files from cache, compiled {self.loader.misses}.")
 
         self.current_state = state_vector
+        self._reset()
+
+    def strategy_files(self) -> List[str]:
+        """
+        :return: The names of the strategy yaml files in the strategy path
+        """
+        return [file for file in os.listdir(self.strategy_path) if os.path.isfile(os.path.join(self.strategy_path, file))
+                and file.endswith('.yaml') and not file == 'meta.yaml']
+
+    def _reset(self):
+        """
+        Initializes everything the engine accumulates at runtime: deltas, actions, suggestions and evaluation state.
+        """
         self.last_delta = None
+        # whether `last_delta` holds updates not yet seen by an evaluation pass, which further updates are merged into
+        self.delta_pending = False
         self.conditional_actions: List[ConditionalGuidanceAction] = []
-        self.suggestions: List[SuggestionModel] = []
+        self.action_order: Dict[ConditionalGuidanceAction, int] = {}
+        # actions declaring a `trigger`, and when each trigger last fired
+        self.triggered_actions: List[ConditionalGuidanceAction] = []
+        self.trigger_fired: Dict[ConditionalGuidanceAction, float] = {}
+        self.last_action_pass = 0.0
+        self.last_strategy_pass = 0.0
+        self.suggestions = SuggestionStore(policy=self.policy)
+        # suggestions displaced by newer ones in the last pass, to be broadcast as retracted
+        self.evicted: List[SuggestionModel] = []
+        # remember which context attributes `is_applicable` and `should_retract` read to skip unaffected actions
+        self.applicability = DependencyTracker()
+        self.retraction = DependencyTracker()
+        # shared evaluation of conditions declared with `when`
+        self.conditions = ConditionNetwork()
+        # versions of the context vector, available to callbacks as `ctx.history`
+        self.history = StateHistory(self.current_state, self.history_size, self.history_age, self.history_bytes)
+        if isinstance(getattr(self.current_state, 'history', None), (StateHistory, type(None))):
+            self.current_state.history = self.history
+        else:
+            self.logger.warning("The state vector defines `history`, the state history is not available to callbacks")
+        # limits the suggestions and the duration of each action pass, if the meta strategy declares a `budget`
+        self.budget = GuidanceBudget.from_meta(self.meta_strategy)
+        # callbacks declared with `cache`, found again whenever actions are built
+        self.collect_memos()
+        # the context vector as read by the strategy pool's workers
+        self.snapshot = SharedSnapshot() if self.pool is not None else None
+        # yaml files that could not be reloaded since they last changed
+        self.failed_files: Set[str] = set()
+        # serializes evaluation passes and state updates, as callbacks run outside the event loop
+        self.lock = asyncio.Lock()
+
+    def clone(self) -> 'LotseEngine':
+        """
+        Creates an engine with its own copy of the context vector, strategies and actions without re-parsing any yaml
+        file. Callbacks are re-bound to the copies. Attributes of the context vector listed in its `shared_attributes`
+        field (e.g. large, read-only data) are shared with this engine instead of being copied. Suggestions and
+        evaluation state are not copied.
+        """
+        shared = getattr(self.current_state, 'shared_attributes', None) or []
+        memo = {id(value): value for name, value in vars(self.current_state).items() if name in shared}
+        # the clone starts its own history
+        memo[id(self.history)] = None
+        engine = LotseEngine.__new__(LotseEngine)
+        engine.executor = self.executor
+        engine.loader = self.loader
+        engine.policy = self.policy
+        engine.pool = self.pool
+        engine.journal = None
+        engine.strategy_path = self.strategy_path
+        engine.history_size, engine.history_age, engine.history_bytes = (self.history_size, self.history_age,
+                                                                          self.history_bytes)
+        engine.strategies, engine.meta_strategy, engine.applicable_strategies, engine.current_state = copy.deepcopy(
+            (self.strategies, self.meta_strategy, self.applicable_strategies, self.current_state), memo)
+        engine._reset()
+        engine.generate_conditional_actions()
+        return engine
+
+    async def reload(self, changed: Set[str]) -> List[SuggestionModel]:
+        """
+        Reloads the strategies affected by changed yaml files, loads strategy files added to the strategy path and
+        removes strategies whose file was deleted. Only changed files are parsed again. Reloaded strategies and actions
+        keep their runtime state where their yaml declaration did not change, see `StrategyLoader.carry`, and live
+        suggestions are moved to the reloaded actions. The new objects replace the old ones all at once; strategies that
+        fail to load are kept as they were. The caller must hold the engine's lock.
+
+        :param changed: Absolute paths of the modified or deleted files, see `StrategyLoader.changed`
+        :return: The suggestions retracted because their action no longer exists
+        """
+        files = {os.path.abspath(os.path.join(self.strategy_path, file)): file for file in self.strategy_files()}
+        current: Dict[str, Strategy] = {}
+        for strategy in self.strategies:
+            source = self.loader.source(strategy)
+            if source is not None:
+                current[source.path] = strategy
+        meta = os.path.abspath(os.path.join(self.strategy_path, 'meta.yaml'))
+        source = self.loader.source(self.meta_strategy)
+        if source is not None:
+            reload_meta = meta in changed or bool(self.loader.dependencies(meta) & changed)
+        else:
+            reload_meta = os.path.isfile(meta) and (meta not in self.failed_files or meta in changed)
+        removed = [strategy for path, strategy in current.items() if path not in files]
+        # files that failed to load are only retried once they change
+        affected = [path for path in files if path in changed or self.loader.dependencies(path) & changed or
+                    path not in current and path not in self.failed_files]
+        if not affected and not removed and not reload_meta:
+            return []
+
+        replaced: Dict[Strategy, Strategy] = {}
+        added: List[Strategy] = []
+        actions: Dict[ConditionalGuidanceAction, ConditionalGuidanceAction] = {}
+        for path in affected:
+            try:
+                strategy = self.loader.load(files[path], Strategy, self.strategy_path)
+            except Exception:
+                self.logger.exception("Could not reload %s, keeping the previous version", path)
+                self.failed_files.add(path)
+                continue
+            self.failed_files.discard(path)
+            old = current.get(path)
+            if old is None:
+                added.append(strategy)
+                continue
+            self.loader.carry(old, strategy)
+            for name, action in vars(old).items():
+                if not isinstance(action, ConditionalGuidanceAction):
+                    continue
+                new = vars(strategy).get(name)
+                if isinstance(new, LazyAction):
+                    new = strategy.__dict__[name] = new.load(strategy)
+                if isinstance(new, ConditionalGuidanceAction):
+                    self.loader.carry(action, new)
+                    actions[action] = new
+            replaced[old] = strategy
+        meta_strategy = self.meta_strategy
+        if reload_meta:
+            try:
+                meta_strategy = self.loader.load(meta, MetaStrategy, self.strategy_path) if os.path.isfile(meta) \
+                    else MetaStrategy()
+                self.loader.carry(self.meta_strategy, meta_strategy)
+                self.failed_files.discard(meta)
+            except Exception:
+                self.logger.exception("Could not reload %s, keeping the previous version", meta)
+                self.failed_files.add(meta)
 
-    def get_applicable_strategies(self) -> List[Strategy]:
-        return list(filter(lambda s: s.determine_applicability(self.current_state, self.last_delta), self.strategies))
+        # swap everything at once, between two evaluation passes
+        previous = self.conditional_actions
+        self.strategies = [replaced.get(s, s) for s in self.strategies if s not in removed] + added
+        self.applicable_strategies = [replaced.get(s, s) for s in self.applicable_strategies if s not in removed]
+        if meta_strategy is not self.meta_strategy:
+            self.meta_strategy = meta_strategy
+            self.budget = GuidanceBudget.from_meta(meta_strategy)
+        # conditions of the old objects must not be served from the network's cache
+        self.conditions = ConditionNetwork()
+        self.trigger_fired = {actions.get(a, a): t for a, t in self.trigger_fired.items()}
+        self.generate_conditional_actions()
+        retracted = []
+        for action in self.suggestions.actions():
+            if action in actions:
+                self.suggestions.replace_action(action, actions[action])
+            elif action not in self.action_order and (action.strategy in replaced or action.strategy in removed):
+                retracted.extend(self.suggestions.for_action(action))
+        for action in set(previous).difference(self.action_order):
+            self.retraction.forget(action)
+        for action in set(self.action_order).difference(previous):
+            self.invalidate_action(action)
+        for suggestion in retracted:
+            self.suggestions.remove(suggestion.suggestion.id)
+            await self._retract(suggestion, 'reload')
+        # added strategies are evaluated in the next pass
+        if added:
+            self.last_strategy_pass = 0.0
+        if self.journal is not None:
+            # journal records refer to strategies and actions by file and attribute, which may have changed
+            self.journal.checkpoint()
+        self.logger.info("Reloaded %d strategies, added %d and removed %d", len(replaced), len(added), len(removed))
+        return retracted
+
+    def mark_changed(self, keys: Optional[Iterable[str]]):
+        """
+        Records that the given attributes of the context vector changed, so that all actions depending on them are
+        re-evaluated in the next pass. `None` marks all attributes as changed.
+        """
+        self.applicability.mark_changed(keys)
+        self.retraction.mark_changed(keys)
+        self.conditions.mark_changed(keys)
+        if self.snapshot is not None:
+            self.snapshot.mark_changed(keys)
+        for memo in self.memos:
+            memo.invalidate(keys)
+
+    def invalidate_action(self, action: ConditionalGuidanceAction):
+        """
+        Forces re-evaluation of the action in the next pass, e.g. because its own state changed.
+        """
+        if action in self.action_order:
+            self.applicability.invalidate(action)
+        self.retraction.invalidate(action)
+        for memo in memoized([action]):
+            memo.clear()
+
+    def observe(self, action: ConditionalGuidanceAction):
+        """
+        Journals the changes the callbacks of the action executed within the block make to the context vector and the
+        action, if the engine is journaled.
+        """
+        return self.journal.observe(action) if self.journal is not None else contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def reassignments(self):
+        """
+        Marks the attributes of the context vector that the callbacks executed within the block assign or delete as
+        changed and records them in the history, e.g. when `accept` sets a filter. Attributes modified in place are not
+        detected.
+        """
+        before = dict(vars(self.current_state))
+        try:
+            yield
+        finally:
+            after = vars(self.current_state)
+            changed = [name for name, value in after.items() if before.get(name, MISSING) is not value]
+            changed += [name for name in before if name not in after]
+            if changed:
+                self.history.record_reassigned(before, self.current_state)
+                self.mark_changed(changed)
+
+    def update_state(self, updates: Dict[str, Any]):
+        """
+        Applies the key-value pairs to the context vector and records them as the latest delta.
+        """
+        self.current_state.__dict__.update(updates)
+        if self.journal is not None:
+            self.journal.updated(updates)
+        self.history.record(updates)
+        self.record_delta(updates)
+        self.mark_changed(updates.keys())
+
+    async def update_state_with_callback(self, callback: str, params: Dict[str, Any]):
+        """
+        Executes a callback defined in the state vector yaml and records its return value as the latest delta.
+        """
+        before = dict(vars(self.current_state))
+        self.record_delta(await self.call(None, callback, getattr(self.current_state, callback), **params))
+        if self.journal is not None:
+            self.journal.called(callback, params)
+        self.history.record_reassigned(before, self.current_state)
+        # callbacks can modify arbitrary attributes in place, so we cannot tell which ones changed
+        self.mark_changed(None)
+
+    def append_rows(self, attribute: str, rows: Union[List[Dict[str, Any]], Dict[str, List[Any]]]) -> int:
+        """
+        Appends rows to a data source of the context vector, a `type: columnar` store or a list of records, instead of
+        replacing it. The store's indexes and aggregates are updated incrementally. The delta reports the rows appended
+        since the last evaluation pass as `AppendedRows` under the name of the attribute.
+
+        :param rows: The rows as records, or as the values of each column for columnar stores
+        :return: The position of the first appended row
+        """
+        data = getattr(self.current_state, attribute)
+        if isinstance(data, ColumnStore):
+            start = data.append(rows)
+        elif isinstance(data, list) and isinstance(rows, list):
+            start = len(data)
+            data.extend(rows)
+        else:
+            raise TypeError(f"Cannot append rows to {attribute} of the state vector, it is neither columnar data nor a "
+                            f"list")
+        if self.journal is not None:
+            self.journal.appended(attribute, rows)
+        first = start
+        pending = self.last_delta.get(attribute) if self.delta_pending and isinstance(self.last_delta, dict) else None
+        if isinstance(pending, AppendedRows) and pending.start <= start:
+            # report the rows of all appends since the last pass
+            first = pending.start
+        appended = data.select(np.arange(first, len(data))) if isinstance(data, ColumnStore) else data[first:]
+        self.record_delta({attribute: AppendedRows(first, appended)})
+        # the data is modified in place, so there is no new value to record in the history
+        self.mark_changed([attribute])
+        return start
+
+    def record_delta(self, delta: Any):
+        """
+        Sets the latest delta. Dictionaries are merged into the delta of previous updates that have not been evaluated
+        yet, so that bursts of updates between two evaluation passes are not lost.
+        """
+        if self.delta_pending and isinstance(self.last_delta, dict) and isinstance(delta, dict):
+            self.last_delta = {**self.last_delta, **delta}
+        else:
+            self.last_delta = delta
+        self.delta_pending = True
+
+    def condition(self, owner: Any, name: str):
+        """
+        Returns the callback `name` of the action or strategy. Conditions declared with `when` are evaluated through the
+        engine's condition network.
+        """
+        callback = getattr(owner, name)
+        return self.conditions.bind(callback) if isinstance(callback, Condition) else callback
+
+    async def call(self, owner: Any, name: str, callback, *args, **kwargs):
+        """
+        Runs a callback through the engine's executor.
+
+        :param owner: The action or strategy the callback belongs to. Its metadata may define a `callback_timeout`.
+        :param name: The name of the callback
+        """
+        timeout = _metadata(owner).get('callback_timeout') if owner is not None else None
+        if profiler.active:
+            callback = profiler.wrap(owner, name, callback)
+        start = time.perf_counter()
+        try:
+            return await self.executor.run(owner, name, callback, *args, timeout=timeout, **kwargs)
+        except CallbackTimeout:
+            CALLBACK_TIMEOUTS.inc(owner=_label(owner), callback=name)
+            raise
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - start, owner=_label(owner), callback=name)
+
+    async def evaluate_strategies(self):
+        """
+        Determines the applicable strategies and regenerates the conditional actions from them.
+        """
+        self.applicable_strategies = await self.get_applicable_strategies()
+        if self.journal is not None:
+            self.journal.applicable(self.applicable_strategies)
+        self.generate_conditional_actions()
+        self.last_strategy_pass = time.time()
+
+    async def get_applicable_strategies(self) -> List[Strategy]:
+        self.conditions.begin_pass()
+        remote = await self.evaluate_in_pool()
+        strategies = [s for s in self.strategies if not self.executor.is_degraded(s)]
+        local = [s for s in strategies if remote.get(s) is None]
+        results = await self.gather(local, self.determine_applicability,
+                                    lambda s: is_async(self.condition(s, 'determine_applicability')))
+        applicable = {**remote, **dict(zip(local, results))}
+        return [strategy for strategy in strategies if applicable[strategy]]
+
+    async def determine_applicability(self, strategy: Strategy) -> bool:
+        try:
+            return await self.call(strategy, 'determine_applicability',
+                                   self.condition(strategy, 'determine_applicability'), self.current_state,
+                                   self.last_delta)
+        except CallbackTimeout:
+            return False
+
+    async def gather(self, owners: List[Any], evaluate: Callable[[Any], Awaitable], concurrent: Callable[[Any], bool]):
+        """
+        Evaluates all actions or strategies, those whose callback is `async` concurrently while the others are evaluated
+        one after the other.
+
+        :param evaluate: Evaluates one action or strategy
+        :param concurrent: Whether the action or strategy can be evaluated concurrently
+        :return: The results, in the order of `owners`
+        """
+        started = [asyncio.ensure_future(evaluate(owner)) if concurrent(owner) else None for owner in owners]
+        results = []
+        for owner, future in zip(owners, started):
+            results.append(await (future if future is not None else evaluate(owner)))
+        return results
+
+    async def evaluate_in_pool(self) -> Dict[Strategy, Optional[bool]]:
+        """
+        Evaluates the applicability of all eligible strategies in the strategy pool at once.
+
+        :return: The applicability of each strategy, None for strategies to evaluate in the engine
+        """
+        strategies = [s for s in self.strategies if not self.executor.is_degraded(s)] if self.pool is not None else []
+        strategies = [s for s in strategies if self.pool.eligible(s, self.loader)]
+        if not strategies:
+            return {}
+        ref = self.snapshot.publish(self.current_state)
+        results = await asyncio.gather(*(self._evaluate_in_pool(ref, strategy) for strategy in strategies))
+        return dict(zip(strategies, results))
+
+    async def _evaluate_in_pool(self, ref, strategy: Strategy) -> Optional[bool]:
+        timeout = self.executor.timeout_for('determine_applicability', _metadata(strategy).get('callback_timeout'))
+        start = time.perf_counter()
+        try:
+            return await self.pool.evaluate(ref, strategy, self.loader, self.last_delta, timeout)
+        except asyncio.TimeoutError:
+            self.executor.degrade(strategy)
+            CALLBACK_TIMEOUTS.inc(owner=_label(strategy), callback='determine_applicability')
+            self.logger.warning("Strategy %s did not finish within %ss in the strategy pool", _label(strategy),
+                                timeout)
+            return False
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - start, owner=_label(strategy),
+                                     callback='determine_applicability')
 
     def generate_conditional_actions(self):
         self.conditional_actions = []
         for strategy in self.applicable_strategies:
-            for action in strategy.generate_actions():
+            # actions of strategies that were never applicable are only built now
+            for action in resolve(strategy).generate_actions():
                 self.conditional_actions.append(action)
+        self.action_order = {action: i for i, action in enumerate(self.conditional_actions)}
+        self.applicability.retain(self.conditional_actions)
+        self.triggered_actions = [action for action in self.conditional_actions if _trigger(action)]
+        self.trigger_fired = {a: t for a, t in self.trigger_fired.items() if a in self.action_order}
+        self.collect_memos()
         return self.conditional_actions
 
-    def get_applicable_actions(self):
+    def collect_memos(self):
+        """
+        Finds the callbacks declared with `cache` in the context vector, meta strategy, strategies and built actions,
+        whose caches are cleared when the context vector changes.
+        """
+        owners = {id(owner): owner for owner in [self.current_state, self.meta_strategy, *self.strategies]}
+        for strategy in self.strategies:
+            owners.update((id(a), a) for a in vars(strategy).values() if isinstance(a, ConditionalGuidanceAction))
+        owners.update((id(action), action) for action in self.conditional_actions)
+        self.memos = memoized(owners.values())
+
+    def trigger_time(self, action: ConditionalGuidanceAction) -> Optional[float]:
+        """
+        Computes when the action's `trigger` is due, as a unix timestamp. Triggers are declared in the action yaml as
+        either `trigger: {every: <seconds>}` or `trigger: {after: <context attribute>, delay: <seconds>}`. In the
+        latter form, the context attribute must hold a unix timestamp and `delay` can also name an attribute of the
+        action, e.g. `trigger: {after: last_interaction, delay: timeout}`.
+
+        :return: The due time, or None if the action does not declare a trigger or its trigger has already fired.
+        """
+        trigger = _trigger(action)
+        if trigger is None:
+            return None
+        if 'every' in trigger:
+            return self.trigger_fired.get(action, 0.0) + trigger['every']
+        after = getattr(self.current_state, trigger.get('after', ''), None)
+        if after is None:
+            return None
+        delay = trigger.get('delay', 0)
+        if isinstance(delay, str):
+            delay = getattr(action, delay)
+        due = after + delay
+        # `after` triggers fire once per due time, until the action becomes applicable
+        return None if self.trigger_fired.get(action) == due else due
+
+    def next_action_due(self, poll_interval: float, changes_due: float = None) -> Optional[float]:
+        """
+        Determines when the next action evaluation pass is necessary. Time-based actions without a trigger are
+        evaluated every `poll_interval` seconds. Triggered actions whose condition was not yet met after their due time
+        are polled as well.
+
+        :param changes_due: When to evaluate changes of the state, e.g. at the end of a debounce window. None to
+        evaluate them right away.
+        :return: A unix timestamp, or None if no pass is necessary until the state changes.
+        """
+        now = time.time()
+        due = []
+        if self.applicability.changed or self.retraction.changed:
+            if changes_due is None or changes_due <= now:
+                return now
+            due.append(changes_due)
+        # suggestions are retracted in the pass after their TTL
+        expiry = self.suggestions.next_expiry()
+        if expiry is not None:
+            due.append(expiry)
+        for key in self.applicability.unevaluated | self.retraction.unevaluated:
+            due.append(now + self.executor.remaining(key))
+        polled = self.applicability.always.difference(self.triggered_actions)
+        if polled or self.retraction.always:
+            due.append(self.last_action_pass + poll_interval)
+        if self.applicability.deferred:
+            # actions skipped to stay within the budget are evaluated once the rate limit allows new suggestions
+            deferred = self.last_action_pass + poll_interval
+            due.append(deferred if self.budget is None else max(deferred, self.budget.next_available(now)))
+        for action in self.triggered_actions:
+            trigger_due = self.trigger_time(action)
+            if trigger_due is not None:
+                due.append(trigger_due if trigger_due > self.last_action_pass else self.last_action_pass + poll_interval)
+        return min(due, default=None)
+
+    def next_strategy_due(self, interval: float) -> float:
+        """
+        :param interval: The default interval between strategy evaluations, used unless strategies declare a shorter
+        interval as `trigger: {every: <seconds>}`.
+        """
+        intervals = [t['every'] for t in map(_trigger, self.strategies) if t and 'every' in t]
+        return self.last_strategy_pass + min(intervals + [interval])
+
+    async def get_applicable_actions(self):
+        now = time.time()
+        trigger_due = {}
+        for action in self.triggered_actions:
+            due = self.trigger_time(action)
+            if due is not None and due <= now:
+                trigger_due[action] = due
+                self.applicability.invalidate(action)
+        # only evaluate actions whose dependencies changed since they were last found to be not applicable
+        due = [action for action in self.applicability.due() if action in self.action_order]
         actions = []
-        for action in self.conditional_actions:
-            if action.is_applicable(self.current_state, self.last_delta):
-                actions.append(action)
-                action.suggested = True
+        self.conditions.begin_pass()
+        budget = self.budget
+        if budget is None:
+            queue, limit = sorted(due, key=self.action_order.__getitem__), None
+        else:
+            # evaluate the actions with the highest priority first, and stop once the budget is filled
+            limit = budget.begin(now)
+            queue = budget.queue(due, self.action_order)
+        pending = iter(queue)
+        # an action taken from the queue that did not fit into the previous wave
+        waiting = None
+        while True:
+            action = waiting if waiting is not None else next(pending, None)
+            waiting = None
+            if action is None:
+                break
+            if budget is not None and (limit is not None and len(actions) >= limit or budget.exhausted()):
+                deferred = [action] + queue.remaining()
+                self.applicability.defer(deferred)
+                reason = 'time' if limit is None or len(actions) < limit else 'limit'
+                ACTIONS_DEFERRED.inc(len(deferred), reason=reason)
+                break
+            # consecutive actions with `async` conditions are evaluated concurrently, without exceeding the budget
+            wave = [action]
+            size = self.executor.max_concurrency if limit is None else min(self.executor.max_concurrency,
+                                                                              limit - len(actions))
+            if self.concurrent(action):
+                while len(wave) < size:
+                    waiting = next(pending, None)
+                    if waiting is None or not self.concurrent(waiting):
+                        break
+                    wave.append(waiting)
+                    waiting = None
+            results = await asyncio.gather(*(self.is_applicable(a, trigger_due, now) for a in wave))
+            for candidate, applicable in zip(wave, results):
+                if applicable:
+                    actions.append(candidate)
+                    candidate.suggested = True
+        self.applicability.consume()
         return actions
 
-    def generate_suggestions(self) -> List[SuggestionModel]:
-        actions = self.get_applicable_actions()
-        print(f'got {len(actions)} actions to apply in the current context')
+    def concurrent(self, action: ConditionalGuidanceAction) -> bool:
+        return is_async(self.condition(action, 'is_applicable'))
+
+    async def is_applicable(self, action: ConditionalGuidanceAction, trigger_due: Dict[ConditionalGuidanceAction, float],
+                            now: float) -> bool:
+        """
+        Evaluates whether the action is applicable and records what its evaluation depended on.
+
+        :param trigger_due: The due time of the triggers that fired in this pass
+        """
+        if self.executor.is_degraded(action):
+            # evaluate again once the action is no longer degraded
+            self.applicability.invalidate(action)
+            return False
+        reads = set()
+        context, delta = tracked(self.current_state, self.last_delta, reads)
+        callback = self.condition(action, 'is_applicable')
+        try:
+            applicable = await self.call(action, 'is_applicable', callback, context, delta)
+        except CallbackTimeout:
+            self.applicability.invalidate(action)
+            return False
+        # triggered actions are evaluated when their trigger is due rather than in every pass
+        ACTIONS_EVALUATED.inc()
+        time_based = _metadata(action).get('time_based', False if _trigger(action) else None)
+        self.applicability.record(action, reads, applicable, callback, time_based)
+        if action in trigger_due and (applicable or 'every' in _trigger(action)):
+            self.trigger_fired[action] = now if 'every' in _trigger(action) else trigger_due[action]
+        return bool(applicable)
+
+    async def generate_suggestions(self) -> List[SuggestionModel]:
+        actions = applicable = await self.get_applicable_actions()
+        self.logger.debug("Got %d actions to apply in the current context", len(actions))
         if len(actions) > 0:
-            actions = self.meta_strategy.filter_actions(actions, self.current_state)
-            print(f'got {len(actions)} actions remain after meta strategy filtering.')
-        new_suggestions = [action.generate_suggestions(self.current_state) for action in actions]
-        new_suggestions = list(filter(lambda s: s is not None, new_suggestions))
-        print(f'obtained {len(new_suggestions)} new suggestions')
-        self.suggestions.extend(new_suggestions)
-        print(f'total suggestions: {len(self.suggestions)}')
+            try:
+                actions = await self.call(None, 'filter_actions', self.meta_strategy.filter_actions, actions,
+                                          self.current_state)
+                self.logger.debug("%d actions remain after meta strategy filtering", len(actions))
+            except CallbackTimeout:
+                self.logger.warning("Meta strategy timed out, using all applicable actions")
+        budget = self.budget
+
+        async def generate(action: ConditionalGuidanceAction) -> Optional[SuggestionModel]:
+            if budget is not None and not budget.affordable(action):
+                # the suggestion would not be ready within the budget, so let the action suggest in a later pass
+                action.suggested = False
+                ACTIONS_DEFERRED.inc(reason='cost')
+                return None
+            asynchronous = is_async(action.generate_suggestion_content)
+            start = time.perf_counter()
+            try:
+                suggestion = await self.call(action, 'generate_suggestion_content',
+                                             action.generate_suggestions_async if asynchronous
+                                             else action.generate_suggestions, self.current_state)
+            except CallbackTimeout:
+                # allow the action to suggest again once it is no longer degraded
+                action.suggested = False
+                return None
+            if budget is not None:
+                budget.observe(action, time.perf_counter() - start)
+            return suggestion
+
+        # the content of actions with `async` callbacks is generated concurrently
+        generated = await self.gather(actions, generate, lambda a: is_async(a.generate_suggestion_content))
+        new_suggestions = [suggestion for suggestion in generated if suggestion is not None]
+        added: Dict[str, SuggestionModel] = {}
+        for suggestion in new_suggestions:
+            if self.suggestions.duplicate(suggestion) is not None:
+                SUGGESTIONS_DEDUPLICATED.inc(strategy=suggestion.suggestion.strategy)
+                continue
+            added[suggestion.suggestion.id] = suggestion
+            self.retraction.invalidate(suggestion.action)
+            SUGGESTIONS_MADE.inc(strategy=suggestion.suggestion.strategy)
+            for evicted in self.suggestions.add(suggestion):
+                await self._retract(evicted, 'limit')
+                if evicted.suggestion.id in added:
+                    # never sent, so there is nothing to retract on the clients
+                    del added[evicted.suggestion.id]
+                else:
+                    self.evicted.append(evicted)
+        new_suggestions = list(added.values())
+        if budget is not None:
+            budget.spend(len(new_suggestions))
+        if self.journal is not None:
+            # persist the `suggested` flags along with the suggestions
+            self.journal.adapted(applicable)
+            self.journal.made(new_suggestions)
+        self.logger.debug("Obtained %d new suggestions, %d in total", len(new_suggestions), len(self.suggestions))
+        self.delta_pending = False
+        self.last_action_pass = time.time()
         return new_suggestions
 
-    def suggestions_to_retract(self) -> List[SuggestionModel]:
-        return list(filter(lambda s: s.action.should_retract(self.current_state, self.last_delta, s), self.suggestions))
+    async def suggestions_to_retract(self) -> List[SuggestionModel]:
+        async def retracted(action: ConditionalGuidanceAction) -> List[SuggestionModel]:
+            suggestions = self.suggestions.for_action(action)
+            if not suggestions:
+                self.retraction.forget(action)
+                return []
+            if self.executor.is_degraded(action):
+                self.retraction.invalidate(action)
+                return []
+            reads = set()
+            context, delta = tracked(self.current_state, self.last_delta, reads)
+            check = _retracted_async if is_async(action.should_retract) else _retracted
+            try:
+                result = await self.call(action, 'should_retract', check, action, context, delta, suggestions)
+            except CallbackTimeout:
+                self.retraction.invalidate(action)
+                return []
+            self.retraction.record(action, reads, result, action.should_retract, _metadata(action).get('time_based'))
+            return result
+
+        # only check suggestions of actions whose retraction dependencies changed
+        due = list(self.retraction.due())
+        retract = [s for result in await self.gather(due, retracted, lambda a: is_async(a.should_retract))
+                   for s in result]
+        self.retraction.consume()
+        return retract
+
+    async def retract_suggestions(self) -> List[SuggestionModel]:
+        """
+        Retracts all suggestions whose actions determine they should be retracted or whose TTL has passed, and removes
+        them from the engine.
+
+        :return: The retracted suggestions
+        """
+        retract = await self.suggestions_to_retract()
+        for suggestion in retract:
+            self.suggestions.remove(suggestion.suggestion.id)
+            await self._retract(suggestion, 'action')
+        expired = self.suggestions.expired()
+        for suggestion in expired:
+            await self._retract(suggestion, 'ttl')
+        return retract + expired
+
+    def take_evicted(self) -> List[SuggestionModel]:
+        """
+        :return: The suggestions retracted since the last call because their action or strategy made too many
+        suggestions
+        """
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    async def _retract(self, suggestion: SuggestionModel, reason: str):
+        """
+        Calls `retract` on the action of a suggestion that was removed from the engine.
+        """
+        suggestion.interaction = 'retract'
+        SUGGESTIONS_RETRACTED.inc(strategy=suggestion.suggestion.strategy, reason=reason)
+        self.history.end_preview(suggestion.suggestion.id)
+        with self.observe(suggestion.action), self.reassignments():
+            await self.call(suggestion.action, 'retract', suggestion.action.retract, self.current_state,
+                            self.last_delta, suggestion)
+        if self.journal is not None:
+            self.journal.removed(suggestion.suggestion.id)
+        # retracting typically resets the action's `suggested` flag
+        self.invalidate_action(suggestion.action)
+
+    def find_suggestion(self, suggestion_id: str) -> SuggestionModel:
+        suggestion = self.suggestions.get(suggestion_id)
+        if suggestion is None:
+            raise KeyError(f"No suggestion with id {suggestion_id}")
+        return suggestion
+
+    async def accept_suggestion(self, suggestion_id: str) -> SuggestionModel:
+        """
+        Calls `accept` on the action that generated the suggestion and removes the suggestion from the engine.
+        """
+        suggestion = self.find_suggestion(suggestion_id)
+        with self.observe(suggestion.action), self.reassignments():
+            await self.call(suggestion.action, 'accept', suggestion.action.accept, suggestion, self.current_state,
+                            self.last_delta)
+        self.invalidate_action(suggestion.action)
+        self.suggestions.remove(suggestion_id)
+        if self.journal is not None:
+            self.journal.removed(suggestion_id)
+        self.history.end_preview(suggestion_id)
+        return suggestion
+
+    async def reject_suggestion(self, suggestion_id: str) -> SuggestionModel:
+        """
+        Calls `reject` on the action that generated the suggestion and removes the suggestion from the engine.
+        """
+        suggestion = self.find_suggestion(suggestion_id)
+        with self.observe(suggestion.action), self.reassignments():
+            await self.call(suggestion.action, 'reject', suggestion.action.reject, suggestion, self.current_state,
+                            self.last_delta)
+        self.invalidate_action(suggestion.action)
+        self.suggestions.remove(suggestion_id)
+        if self.journal is not None:
+            self.journal.removed(suggestion_id)
+        self.history.end_preview(suggestion_id)
+        return suggestion
+
+    async def preview_start(self, suggestion_id: str, client_id: Optional[str] = None) -> SuggestionModel:
+        """
+        Calls `preview_start` on the action that generated the suggestion. The context vector at this time is available
+        as `ctx.history.preview(suggestion)` until the preview ends, or the client starting it disconnects.
+        """
+        suggestion = self.find_suggestion(suggestion_id)
+        self.history.start_preview(suggestion_id, client_id)
+        try:
+            with self.observe(suggestion.action), self.reassignments():
+                await self.call(suggestion.action, 'preview_start', suggestion.action.preview_start, suggestion,
+                                self.current_state, self.last_delta)
+        except BaseException:
+            self.history.end_preview(suggestion_id)
+            raise
+        self.invalidate_action(suggestion.action)
+        return suggestion
+
+    async def preview_end(self, suggestion_id: str) -> SuggestionModel:
+        suggestion = self.find_suggestion(suggestion_id)
+        with self.observe(suggestion.action), self.reassignments():
+            await self.call(suggestion.action, 'preview_end', suggestion.action.preview_end, suggestion,
+                            self.current_state, self.last_delta)
+        self.invalidate_action(suggestion.action)
+        self.history.end_preview(suggestion_id)
+        return suggestion
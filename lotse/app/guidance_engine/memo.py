@@ -0,0 +1,154 @@
+import copy
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, List, Optional, Set, Tuple
+
+from .dependencies import ALL, TrackingContext, record_reads
+from .executor import is_async
+from .metrics import MEMO_LOOKUPS
+
+DEFAULT_SIZE = 128
+
+
+class Memoized:
+    """
+    A callback whose results are cached in a bounded LRU cache, keyed by its arguments. Declared in the yaml with a
+    `cache` key listing the context vector attributes the result depends on, e.g. ::
+
+        get_current_month:
+          type: function
+          args: []
+          cache: [month, data]
+          load: |
+            return list(filter(lambda p: p['date'] == self.month, self.data))
+
+    The engine clears the cache whenever one of these attributes changes, and the caches of an action whenever its own
+    state may have changed, e.g. after its suggestion was accepted. `cache: true` caches until any attribute changes, and
+    `cache: {attributes: [month], size: 16}` also sets the number of cached results (default 128). Calls with arguments
+    that cannot be hashed are not cached.
+
+    Callbacks reading a memoized helper of the context vector only depend on its declared attributes. Results of `async`
+    callbacks are cached once they are available.
+    """
+
+    def __init__(self, function: Callable, depends_on: Optional[Iterable[str]] = None, size: int = DEFAULT_SIZE):
+        """
+        :param function: The callback, bound to its action, strategy or context vector
+        :param depends_on: The context vector attributes the result depends on. None for all attributes.
+        :param size: The maximum number of cached results
+        """
+        self.function = function
+        self.__wrapped__ = function
+        self.depends_on: Optional[Set[str]] = set(depends_on) if depends_on is not None else None
+        self.size = max(1, size)
+        self.entries: 'OrderedDict[Any, Any]' = OrderedDict()
+        # callbacks run on the executor's threads
+        self.lock = threading.Lock()
+        self.asynchronous = is_async(function)
+
+    def __call__(self, *args, **kwargs):
+        if self.asynchronous:
+            return self._call_async(*args, **kwargs)
+        key = self._key(args, kwargs)
+        if key is None:
+            MEMO_LOOKUPS.inc(result='uncacheable')
+            return self.function(*args, **kwargs)
+        found, result = self._lookup(key)
+        if found:
+            return result
+        result = self.function(*args, **kwargs)
+        self._store(key, result)
+        return result
+
+    async def _call_async(self, *args, **kwargs):
+        key = self._key(args, kwargs)
+        if key is None:
+            MEMO_LOOKUPS.inc(result='uncacheable')
+            return await self.function(*args, **kwargs)
+        found, result = self._lookup(key)
+        if found:
+            return result
+        result = await self.function(*args, **kwargs)
+        self._store(key, result)
+        return result
+
+    def _lookup(self, key: tuple) -> Tuple[bool, Any]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                MEMO_LOOKUPS.inc(result='hit')
+                return True, self.entries[key]
+        MEMO_LOOKUPS.inc(result='miss')
+        return False, None
+
+    def _store(self, key: tuple, result: Any):
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _key(self, args: tuple, kwargs: dict) -> Optional[tuple]:
+        values = []
+        for arg in args:
+            if isinstance(arg, TrackingContext):
+                # the result only depends on the declared attributes of the context, which the caller now depends on
+                record_reads(arg, self.depends_on if self.depends_on is not None else [ALL])
+                arg = arg._target
+            values.append(arg)
+        key = (tuple(values), tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def invalidate(self, keys: Optional[Iterable[str]]):
+        """
+        Clears the cache if any of the given context vector attributes changed. `None` means all attributes changed.
+        """
+        if keys is None or self.depends_on is None or not self.depends_on.isdisjoint(keys):
+            self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def track_reads(self, reads: Set[str]) -> Callable:
+        """
+        :return: The helper as seen by a callback whose reads are tracked
+        """
+
+        def tracked(*args, **kwargs):
+            reads.update(self.depends_on if self.depends_on is not None else [ALL])
+            return self(*args, **kwargs)
+
+        return tracked
+
+    def __deepcopy__(self, memo):
+        # copies, e.g. for sessions, are bound to the copied owner and start with an empty cache
+        return Memoized(copy.deepcopy(self.function, memo), self.depends_on, self.size)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def memoize(function: Callable, declaration: Any) -> Callable:
+    """
+    Wraps the callback according to the `cache` key of its yaml entry.
+    """
+    if not declaration:
+        return function
+    if isinstance(declaration, dict):
+        return Memoized(function, declaration.get('attributes'), declaration.get('size', DEFAULT_SIZE))
+    if isinstance(declaration, (list, tuple)):
+        return Memoized(function, declaration)
+    if isinstance(declaration, str):
+        return Memoized(function, [declaration])
+    return Memoized(function)
+
+
+def memoized(owners: Iterable[Any]) -> List[Memoized]:
+    """
+    :return: All memoized callbacks of the given actions, strategies or context vectors
+    """
+    return [value for owner in owners for value in vars(owner).values() if isinstance(value, Memoized)]
@@ -0,0 +1,168 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# latency buckets in seconds, from 100µs to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        # callbacks update metrics from the executor's threads
+        self.lock = threading.Lock()
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = list(self.samples())
+        lines.extend(f"{name}{_format(labels)} {value}" for name, labels, value in samples)
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+        # per label set: counts per bucket (the last one being +Inf), sum of observations
+        self.values: Dict[Labels, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the `with` block in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                yield f"{self.name}_bucket", labels + (('le', le),), cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, total
+
+
+class Registry:
+    """
+    Collects metrics and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._register(Gauge(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def expose(self) -> str:
+        return '\n'.join(line for metric in self.metrics.values() for line in metric.expose()) + '\n'
+
+
+registry = Registry()
+
+ACTION_PASS_SECONDS = registry.histogram('lotse_action_pass_seconds',
+                                         'Duration of action evaluation passes, including retractions')
+STRATEGY_PASS_SECONDS = registry.histogram('lotse_strategy_pass_seconds', 'Duration of strategy evaluation passes')
+CALLBACK_SECONDS = registry.histogram('lotse_callback_seconds',
+                                      'Latency of yaml callbacks by strategy or action and callback name')
+CALLBACK_TIMEOUTS = registry.counter('lotse_callback_timeouts_total', 'Callbacks abandoned after their timeout')
+ACTIONS_EVALUATED = registry.counter('lotse_actions_evaluated_total', 'Actions whose applicability was evaluated')
+MEMO_LOOKUPS = registry.counter('lotse_memo_lookups_total', 'Calls of callbacks declared with `cache`, by result')
+ACTIONS_DEFERRED = registry.counter('lotse_actions_deferred_total',
+                                    'Actions skipped to stay within the guidance budget, by reason')
+SUGGESTIONS_MADE = registry.counter('lotse_suggestions_made_total', 'Suggestions generated, by strategy')
+SUGGESTIONS_RETRACTED = registry.counter('lotse_suggestions_retracted_total',
+                                         'Suggestions retracted, by strategy and reason (action, ttl or limit)')
+SUGGESTIONS_DEDUPLICATED = registry.counter('lotse_suggestions_deduplicated_total',
+                                            'Suggestions dropped as duplicates of a live suggestion, by strategy')
+SUGGESTIONS_OPEN = registry.gauge('lotse_suggestions_open', 'Suggestions that were neither accepted, rejected nor '
+                                                            'retracted yet')
+BROADCAST_QUEUE_DEPTH = registry.histogram('lotse_broadcast_queue_depth',
+                                           'Messages queued for a client when a new message is added', SIZE_BUCKETS)
+BROADCAST_SEND_SECONDS = registry.histogram('lotse_broadcast_send_seconds',
+                                            'Time from queueing a message until it was sent to the client')
+BROADCAST_DROPPED = registry.counter('lotse_broadcast_dropped_total',
+                                     'Messages dropped or coalesced because a client was too slow')
+BROADCAST_BYTES = registry.counter('lotse_broadcast_bytes_total',
+                                   'Bytes sent to websocket clients, by encoding and compression')
+CONNECTIONS = registry.gauge('lotse_websocket_connections', 'Open websocket connections')
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from lotse.data import ColumnStore, RunningAggregate
+from lotse.strategy import Strategy
+from .conditions import Condition
+from .executor import is_async
+from .loader import SOURCE, StrategyLoader, runtime_state
+from .memo import memoized
+
+logger = logging.getLogger(__name__)
+
+# attributes of the context vector that stay in the engine's process
+LOCAL_ATTRIBUTES = {'history'}
+
+# (name of the shared memory block holding the manifest, its size)
+SnapshotRef = Tuple[str, int]
+
+
+class SharedArray:
+    """
+    Refers to a NumPy array copied into a shared memory block.
+    """
+
+    def __init__(self, block: str, dtype: str, shape: Tuple[int, ...]):
+        self.block = block
+        self.dtype = dtype
+        self.shape = shape
+
+
+class SharedColumns:
+    """
+    Refers to a `ColumnStore` whose columns were copied into shared memory. Indexes are rebuilt by each worker, running
+    aggregates are sent along.
+    """
+
+    def __init__(self, columns: Dict[str, Any], index_kinds: Dict[str, str], running: Dict[str, RunningAggregate]):
+        self.columns = columns
+        self.index_kinds = index_kinds
+        self.running = running
+
+    @property
+    def key(self) -> Optional[tuple]:
+        """
+        :return: Identifies the store by the blocks holding its columns, which are copied to new blocks whenever it
+        changes. None if a column is not held in shared memory.
+        """
+        if not all(isinstance(array, SharedArray) for array in self.columns.values()):
+            return None
+        return (tuple(sorted((column, array.block) for column, array in self.columns.items())),
+                tuple(sorted(self.index_kinds.items())))
+
+
+def _shareable(value: Any) -> bool:
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject and value.nbytes > 0
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13, attaching registers the block again with the resource tracker the workers share with the
+        # engine's process, which is harmless as the engine unlinks the block
+        return shared_memory.SharedMemory(name=name)
+
+
+def _picklable(values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return: The values that can be sent to the workers. Workers keep the initial value of the others.
+    """
+    picklable = {}
+    for name, value in values.items():
+        try:
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug("Attribute %s of the context vector cannot be sent to the strategy workers", name)
+            continue
+        picklable[name] = value
+    return picklable
+
+
+class SharedSnapshot:
+    """
+    A read-only copy of an engine's context vector in shared memory, read by the worker processes of a `StrategyPool`.
+
+    NumPy arrays and the columns of `ColumnStore`s are copied into their own shared memory blocks, which workers map
+    without copying. They are only copied again once their attribute changed. All other attributes are pickled into a
+    manifest, once per version of the context vector rather than once per task. Workers keep the stores they rebuilt
+    from unchanged blocks, with their indexes, when a manifest is published for changes of other attributes.
+    """
+
+    def __init__(self):
+        # key (attribute or attribute.column) -> (the array, its block)
+        self.arrays: Dict[str, Tuple[np.ndarray, shared_memory.SharedMemory]] = {}
+        # attributes changed since the last publication, None for all
+        self.dirty: Optional[Set[str]] = None
+        self.manifest: Optional[shared_memory.SharedMemory] = None
+        self.size = 0
+
+    def mark_changed(self, keys):
+        if keys is None:
+            self.dirty = None
+        elif self.dirty is not None:
+            self.dirty.update(keys)
+
+    def publish(self, context: Any) -> SnapshotRef:
+        """
+        Copies the changed attributes of the context vector into shared memory.
+
+        :return: The reference workers read the snapshot from
+        """
+        if self.manifest is not None and self.dirty is not None and not self.dirty:
+            return self.manifest.name, self.size
+        used: Set[str] = set()
+        values = {}
+        for name, value in vars(context).items():
+            if name in LOCAL_ATTRIBUTES or callable(value):
+                continue
+            if _shareable(value):
+                values[name] = self._array(name, name, value, used)
+            elif isinstance(value, ColumnStore):
+                columns = {column: self._array(f'{name}.{column}', name, array, used) if _shareable(array) else array
+                           for column, array in value.columns.items()}
+                values[name] = SharedColumns(columns, dict(value.index_kinds), dict(value.running))
+            else:
+                values[name] = value
+        for key in [key for key in self.arrays if key not in used]:
+            self._unlink(self.arrays.pop(key)[1])
+        try:
+            data = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps(_picklable(values), protocol=pickle.HIGHEST_PROTOCOL)
+        previous = self.manifest
+        self.manifest = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        self.manifest.buf[:len(data)] = data
+        self.size = len(data)
+        if previous is not None:
+            self._unlink(previous)
+        self.dirty = set()
+        return self.manifest.name, self.size
+
+    def _array(self, key: str, attribute: str, array: np.ndarray, used: Set[str]) -> SharedArray:
+        used.add(key)
+        existing = self.arrays.get(key)
+        if existing is None or existing[0] is not array or self.dirty is None or attribute in self.dirty:
+            block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            if existing is not None:
+                self._unlink(existing[1])
+            existing = self.arrays[key] = (array, block)
+        return SharedArray(existing[1].name, existing[0].dtype.str, existing[0].shape)
+
+    @staticmethod
+    def _unlink(block: shared_memory.SharedMemory):
+        try:
+            block.close()
+            block.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+    def close(self):
+        for _, block in self.arrays.values():
+            self._unlink(block)
+        self.arrays = {}
+        if self.manifest is not None:
+            self._unlink(self.manifest)
+            self.manifest = None
+
+    def __del__(self):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        # each engine publishes its own context vector
+        return SharedSnapshot()
+
+
+# state of a worker process
+_worker: Dict[str, Any] = {}
+
+
+def _initialize(strategy_path: str, state_path: str, cache_dir: Optional[str]):
+    from .lotse_engine import ContextVector
+    loader = StrategyLoader(cache_dir, lazy_actions=True)
+    context = loader.load(os.path.join(state_path, 'vector.yaml'), ContextVector, state_path)
+    _worker.update(loader=loader, strategy_path=strategy_path, context=context, base=dict(vars(context)),
+                   strategies={}, manifest=None, blocks={}, stores={})
+
+
+def _resolve(value: Any, blocks: Dict[str, shared_memory.SharedMemory], stores: Dict[tuple, ColumnStore]) -> Any:
+    if isinstance(value, SharedArray):
+        block = blocks.get(value.block) or _worker['blocks'].get(value.block) or _attach(value.block)
+        blocks[value.block] = block
+        array = np.ndarray(value.shape, np.dtype(value.dtype), buffer=block.buf)
+        array.flags.writeable = False
+        return array
+    if isinstance(value, SharedColumns):
+        key = value.key
+        store = _worker['stores'].get(key) if key is not None else None
+        if store is not None:
+            # unchanged since the previous manifest, keep its indexes rather than rebuilding them
+            for array in value.columns.values():
+                blocks[array.block] = _worker['blocks'][array.block]
+            store.running = value.running
+        else:
+            columns = {column: _resolve(array, blocks, stores) for column, array in value.columns.items()}
+            store = ColumnStore(columns, value.index_kinds, value.running)
+        if key is not None:
+            stores[key] = store
+        return store
+    return value
+
+
+def _context(ref: SnapshotRef) -> Any:
+    name, size = ref
+    context = _worker['context']
+    if _worker['manifest'] == name:
+        return context
+    block = _attach(name)
+    try:
+        values = pickle.loads(bytes(block.buf[:size]))
+    finally:
+        block.close()
+    blocks, stores = {}, {}
+    resolved = {key: _resolve(value, blocks, stores) for key, value in values.items()}
+    context.__dict__.clear()
+    context.__dict__.update(_worker['base'])
+    context.__dict__.update(resolved)
+    for memo in memoized([context, *_worker['strategies'].values()]):
+        memo.clear()
+    for key, block in _worker['blocks'].items():
+        if key not in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # still referenced, e.g. by a result cached by a callback; closed with the process
+                blocks[key] = block
+    _worker['blocks'] = blocks
+    _worker['stores'] = stores
+    _worker['manifest'] = name
+    return context
+
+
+def _strategy(path: str, digest: str) -> Strategy:
+    strategy = _worker['strategies'].get(path)
+    if strategy is None or getattr(strategy, SOURCE, None) != digest:
+        # the strategy was changed and reloaded by the engine since this worker loaded it
+        strategy = _worker['strategies'][path] = _worker['loader'].load(path, Strategy, _worker['strategy_path'])
+    return strategy
+
+
+def _evaluate(ref: SnapshotRef, path: str, digest: str, state: Dict[str, Any], delta: Any) -> bool:
+    context = _context(ref)
+    strategy = _strategy(path, digest)
+    strategy.__dict__.update(state)
+    return bool(strategy.determine_applicability(context, delta))
+
+
+class StrategyPool:
+    """
+    Evaluates `determine_applicability` of strategies in worker processes. Each worker loads the strategies and the
+    state vector from their yaml files once and reads the context vector from a `SharedSnapshot`. Strategies declaring
+    `determine_applicability` with `when`, or `parallel: false` in their metadata, are evaluated by the engine as usual.
+
+    Callbacks run in the workers cannot modify the context vector or the strategy, and `ctx.history` is not available
+    to them.
+    """
+
+    def __init__(self, strategy_path: str, state_path: str, cache_dir: Optional[str] = None,
+                 processes: Optional[int] = None):
+        """
+        :param processes: The number of worker processes. Defaults to the number of CPUs.
+        """
+        self.strategy_path = strategy_path
+        self.state_path = state_path
+        self.cache_dir = cache_dir
+        self.processes = processes
+        # forking a process that runs threads and an event loop is unsafe
+        self.broken = False
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_initialize, initargs=(strategy_path, state_path, cache_dir))
+
+    @staticmethod
+    def eligible(strategy: Strategy, loader: StrategyLoader) -> bool:
+        metadata = getattr(strategy, 'metadata', None) or {}
+        callback = vars(strategy).get('determine_applicability')
+        # `async` callbacks are awaited concurrently in the engine instead
+        return metadata.get('parallel', True) is not False and callback is not None \
+            and not isinstance(callback, Condition) and not is_async(callback) and loader.source(strategy) is not None
+
+    async def evaluate(self, ref: SnapshotRef, strategy: Strategy, loader: StrategyLoader, delta: Any,
+                       timeout: Optional[float] = None) -> Optional[bool]:
+        """
+        A worker that does not reply within `timeout` is not interrupted: it finishes evaluating the callback in the
+        background and takes no other strategy until then, the reply is discarded.
+
+        :return: Whether the strategy is applicable, or None if it cannot be evaluated in a worker, e.g. because its
+        state cannot be pickled or the pool was shut down
+        :raises asyncio.TimeoutError: If the worker did not reply within `timeout` seconds
+        :raises Exception: Whatever `determine_applicability` raised in the worker, as when it runs in the engine
+        """
+        if self.broken:
+            return None
+        source = loader.source(strategy)
+        state = runtime_state(strategy)
+        try:
+            pickle.dumps((state, delta), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.debug("Evaluating %s in the engine, its state cannot be sent to the workers", source.path)
+            return None
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, _evaluate, ref, source.path, source.digest,
+                                                                state, delta)
+        except BrokenProcessPool:
+            return self._broken("A strategy worker process died")
+        except RuntimeError:
+            # raised by `run_in_executor` once the pool was shut down
+            return self._broken("The strategy workers were shut down")
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except BrokenProcessPool:
+            return self._broken("A strategy worker process died")
+
+    def _broken(self, reason: str) -> None:
+        logger.error("%s, evaluating strategies in the engine from now on", reason)
+        self.broken = True
+        return None
+
+    def shutdown(self):
+        """
+        Stops the worker processes for good, when the app shuts down. Strategies are evaluated in the engine afterwards.
+        """
+        self.broken = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
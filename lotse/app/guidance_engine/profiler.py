@@ -0,0 +1,326 @@
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import types
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple
+
+from lotse.strategy import Strategy
+from .executor import is_async
+
+ProfilerMode = Literal['deterministic', 'sampling']
+
+# (strategy, action, callback), or (engine, callback) for callbacks of the state vector and meta strategy
+Labels = Tuple[str, ...]
+
+
+def _id(owner: Any) -> str:
+    metadata = getattr(owner, 'metadata', None) or {}
+    return str(metadata.get('action_id') or metadata.get('strategy_id') or metadata.get('strategy') or
+               type(owner).__name__)
+
+
+def _labels(owner: Any, name: str) -> Labels:
+    if owner is None:
+        return 'engine', name
+    strategy = getattr(owner, 'strategy', None)
+    if strategy is not None and not isinstance(owner, Strategy):
+        return _id(strategy), _id(owner), name
+    return _id(owner), name
+
+
+def _code(callback: Callable) -> Optional[types.CodeType]:
+    """
+    :return: The code of the function a callback eventually calls, e.g. the compiled `load` of a yaml entry
+    """
+    for _ in range(8):
+        if isinstance(callback, partial):
+            callback = callback.func
+        elif hasattr(callback, '__wrapped__'):
+            callback = callback.__wrapped__
+        elif hasattr(callback, '__func__'):
+            callback = callback.__func__
+        else:
+            break
+    return getattr(callback, '__code__', None)
+
+
+def _frame(filename: str, line: int, name: str) -> str:
+    if filename == '~' or not line:
+        # built-in functions
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def _enter(callback, *args, **kwargs):
+    return callback(*args, **kwargs)
+
+
+async def _enter_async(callback, *args, **kwargs):
+    return await callback(*args, **kwargs)
+
+
+class CallbackProfiler:
+    """
+    Profiles the yaml callbacks the engines run, until it is stopped or for a given number of ticks (evaluation passes)
+    or requests. Profiles are attributed to the strategy, action and callback and to the yaml file and line the callback
+    was declared in: every callback is entered through a frame named `strategy/action/callback`, located at the callback
+    in its yaml file. The callback's own frames carry the yaml file and line numbers as well.
+
+    `deterministic` profiling records every function call with `cProfile`. `sampling` records the stacks of running
+    callbacks every `interval` seconds, which slows callbacks down less.
+
+    `async` callbacks are timed and sampled while they run. As they share the event loop with each other, their calls are
+    not recorded in `deterministic` mode.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.mode: ProfilerMode = 'deterministic'
+        self.interval = 0.005
+        self.ticks: Optional[int] = None
+        self.requests: Optional[int] = None
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+        self.stats: Optional[pstats.Stats] = None
+        self.samples: 'Counter[str]' = Counter()
+        # calls and seconds per callback
+        self.calls: Dict[Labels, List[float]] = {}
+        self.locations: Dict[Labels, Tuple[str, int]] = {}
+        self.trampolines: Dict[Tuple[Labels, str, int, bool], Callable] = {}
+        # trampoline code -> labels of its callback, for the sampler
+        self.entries: Dict[types.CodeType, Labels] = {}
+        # thread id -> number of callbacks it is running, for the sampler
+        self.running: 'Counter[int]' = Counter()
+        self.sampler: Optional[threading.Thread] = None
+        self.halt = threading.Event()
+
+    def start(self, mode: ProfilerMode = 'deterministic', ticks: int = None, requests: int = None,
+              interval: float = 0.005):
+        """
+        Discards previous results and profiles all callbacks from now on.
+
+        :param ticks: Stop after this many evaluation passes. None to profile until `stop` is called.
+        :param requests: Stop after this many state updates or interactions
+        :param interval: Seconds between two samples in `sampling` mode
+        """
+        if mode not in ('deterministic', 'sampling'):
+            raise ValueError(f"Unknown profiling mode {mode}, use deterministic or sampling")
+        self.stop()
+        with self.lock:
+            self.mode, self.ticks, self.requests, self.interval = mode, ticks, requests, interval
+            self.stats, self.samples, self.calls, self.locations = None, Counter(), {}, {}
+            self.started, self.stopped = time.time(), None
+            self.active = True
+        if mode == 'sampling':
+            self.halt.clear()
+            self.sampler = threading.Thread(target=self._sample, name='lotse-profiler', daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.stopped = time.time()
+        if self.sampler is not None:
+            self.halt.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def tick(self):
+        """
+        Counts an evaluation pass towards `ticks`.
+        """
+        if self.active and self.ticks is not None:
+            self.ticks -= 1
+            if self.ticks <= 0:
+                self.stop()
+
+    def request(self):
+        """
+        Counts a state update or interaction towards `requests`.
+        """
+        if self.active and self.requests is not None:
+            self.requests -= 1
+            if self.requests <= 0:
+                self.stop()
+
+    def wrap(self, owner: Any, name: str, callback: Callable) -> Callable:
+        """
+        :param owner: The action or strategy the callback belongs to, None for the state vector and meta strategy
+        :return: The callback, profiled while it runs
+        """
+        labels = _labels(owner, name)
+        code = _code(callback)
+        location = (code.co_filename, code.co_firstlineno) if code is not None else ('<when>', 0)
+        asynchronous = is_async(callback)
+        trampoline = self._trampoline(labels, *location, asynchronous)
+        self.locations.setdefault(labels, location)
+
+        if asynchronous:
+            async def profiled_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    if self.mode == 'sampling':
+                        return await self._sampled_async(trampoline, callback, args, kwargs)
+                    return await trampoline(callback, *args, **kwargs)
+                finally:
+                    self._record(labels, start)
+
+            return profiled_async
+
+        def profiled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if self.mode == 'sampling':
+                    return self._sampled(labels, trampoline, callback, args, kwargs)
+                return self._profiled(trampoline, callback, args, kwargs)
+            finally:
+                self._record(labels, start)
+
+        return profiled
+
+    def _record(self, labels: Labels, start: float):
+        with self.lock:
+            entry = self.calls.setdefault(labels, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+    def _trampoline(self, labels: Labels, filename: str, line: int, asynchronous: bool = False) -> Callable:
+        key = (labels, filename, line, asynchronous)
+        trampoline = self.trampolines.get(key)
+        if trampoline is None:
+            name = '/'.join(labels)
+            enter = _enter_async if asynchronous else _enter
+            changes = {'co_name': name, 'co_filename': filename, 'co_firstlineno': max(line, 1)}
+            if sys.version_info >= (3, 11):
+                changes['co_qualname'] = name
+            trampoline = self.trampolines[key] = types.FunctionType(enter.__code__.replace(**changes),
+                                                                   enter.__globals__, name)
+            self.entries[trampoline.__code__] = labels
+        return trampoline
+
+    def _profiled(self, trampoline: Callable, callback: Callable, args: tuple, kwargs: dict):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            return trampoline(callback, *args, **kwargs)
+        try:
+            return trampoline(callback, *args, **kwargs)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def _sampled(self, labels: Labels, trampoline: Callable, callback: Callable, args: tuple, kwargs: dict):
+        thread = threading.get_ident()
+        self.running[thread] += 1
+        try:
+            return trampoline(callback, *args, **kwargs)
+        finally:
+            self._leave(thread)
+
+    async def _sampled_async(self, trampoline: Callable, callback: Callable, args: tuple, kwargs: dict):
+        # the callback's frames are only on the stack of the event loop's thread while it is not awaiting
+        thread = threading.get_ident()
+        self.running[thread] += 1
+        try:
+            return await trampoline(callback, *args, **kwargs)
+        finally:
+            self._leave(thread)
+
+    def _leave(self, thread: int):
+        self.running[thread] -= 1
+        if self.running[thread] <= 0:
+            del self.running[thread]
+
+    def _sample(self):
+        while not self.halt.wait(self.interval):
+            frames = sys._current_frames()
+            for thread in list(self.running):
+                frame, stack = frames.get(thread), []
+                while frame is not None and frame.f_code not in self.entries:
+                    code = frame.f_code
+                    stack.append(_frame(code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if frame is None:
+                    # not within a callback at the moment
+                    continue
+                with self.lock:
+                    self.samples[';'.join(self.entries[frame.f_code] + tuple(reversed(stack)))] += 1
+
+    def status(self) -> dict:
+        """
+        :return: Whether the profiler is running, and the number of calls and seconds per callback, slowest first
+        """
+        with self.lock:
+            calls = sorted(self.calls.items(), key=lambda item: -item[1][1])
+            return {
+                'active': self.active,
+                'mode': self.mode,
+                'remaining_ticks': self.ticks,
+                'remaining_requests': self.requests,
+                'started': self.started,
+                'stopped': self.stopped,
+                'callbacks': [{'labels': list(labels), 'file': self.locations.get(labels, ('', 0))[0],
+                               'line': self.locations.get(labels, ('', 0))[1], 'calls': count, 'seconds': seconds}
+                              for labels, (count, seconds) in calls],
+            }
+
+    def pstats(self) -> bytes:
+        """
+        :return: The profile in the format of `pstats.Stats.dump_stats`, only recorded in `deterministic` mode
+        """
+        with self.lock:
+            return marshal.dumps(self.stats.stats if self.stats is not None else {})
+
+    def collapsed(self) -> str:
+        """
+        :return: The profile as collapsed stacks, one `frame;frame;... count` line per stack, e.g. for flamegraph.pl or
+        speedscope. Counts are samples in `sampling` mode, and microseconds in `deterministic` mode, where they are
+        estimated from the calls between functions.
+        """
+        with self.lock:
+            stacks = self.samples if self.mode == 'sampling' else self._collapse()
+            return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()) if count > 0)
+
+    def _collapse(self) -> 'Counter[str]':
+        stacks: 'Counter[str]' = Counter()
+        if self.stats is None:
+            return stacks
+        stats = self.stats.stats
+        callees = defaultdict(dict)
+        for function, (_, _, _, _, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees[caller][function] = edge
+        roots = {(filename, max(line, 1), '/'.join(labels)): labels for labels, filename, line, _ in self.trampolines}
+
+        def walk(function, path: Tuple[str, ...], fraction: float):
+            stacks[';'.join(path)] += round(stats[function][2] * fraction * 1e6)
+            for callee, edge in callees.get(function, {}).items():
+                total = stats[callee][3]
+                share = fraction * min(1.0, edge[3] / total) if total > 0 else 0
+                frame = _frame(*callee)
+                # recursive calls are attributed to the outermost frame, calls below a microsecond are dropped
+                if total * share >= 1e-6 and frame not in path:
+                    walk(callee, path + (frame,), share)
+
+        for function in stats:
+            labels = roots.get(function)
+            if labels is not None:
+                walk(function, labels, 1.0)
+        return stacks
+
+
+profiler = CallbackProfiler()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+class Broker:
+    """
+    Publish/subscribe messaging and ownership of keys between the workers of a guidance server. Messages are published
+    as text; brokers delivering to subscribers within the publishing process may deliver `local` instead.
+    """
+
+    async def publish(self, channel: str, text: str, local: Any = None):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        """
+        Calls `handler` with every message published on the channel, including those published by this process.
+        """
+        raise NotImplementedError
+
+    async def claim(self, key: str, worker: str, force: bool = False) -> str:
+        """
+        Makes `worker` the owner of the key, unless another worker owns it already and `force` is False.
+
+        :return: The owner of the key
+        """
+        raise NotImplementedError
+
+    async def release(self, key: str, worker: str):
+        """
+        Gives up ownership of the key, if `worker` owns it.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """
+    Delivers messages within the current process only. The default, for servers running a single worker.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, List[Handler]] = {}
+        self.owners: Dict[str, str] = {}
+
+    async def publish(self, channel: str, text: str, local: Any = None):
+        for handler in self.handlers.get(channel, ()):
+            await handler(local if local is not None else text)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers.setdefault(channel, []).append(handler)
+
+    async def claim(self, key: str, worker: str, force: bool = False) -> str:
+        if force:
+            self.owners[key] = worker
+        return self.owners.setdefault(key, worker)
+
+    async def release(self, key: str, worker: str):
+        if self.owners.get(key) == worker:
+            del self.owners[key]
+
+
+class RedisBroker(Broker):
+    """
+    Delivers messages between processes and hosts through Redis pub/sub. Requires the `redis` package.
+    """
+
+    def __init__(self, url: str = 'redis://localhost:6379', client: Any = None, prefix: str = 'lotse'):
+        """
+        :param url: The Redis server to connect to
+        :param client: A `redis.asyncio.Redis` compatible client to use instead of connecting to `url`, e.g.
+        `fakeredis.aioredis.FakeRedis()` for tests
+        :param prefix: Prefix of all channels and keys, to share a Redis server between applications
+        """
+        if client is None:
+            try:
+                import redis.asyncio
+            except ImportError:
+                raise ImportError("The redis broker requires the redis package: pip install lotse[redis]")
+            client = redis.asyncio.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.pubsub = None
+        self.handlers: Dict[str, List[Handler]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, text: str, local: Any = None):
+        await self.client.publish(f'{self.prefix}:{channel}', text)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub()
+        self.handlers.setdefault(f'{self.prefix}:{channel}', []).append(handler)
+        await self.pubsub.subscribe(f'{self.prefix}:{channel}')
+        if self.task is None:
+            self.task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not receive from redis, retrying")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message.get('type') != 'message':
+                continue
+            channel, data = message['channel'], message['data']
+            channel = channel.decode('utf-8') if isinstance(channel, bytes) else channel
+            data = data.decode('utf-8') if isinstance(data, bytes) else data
+            for handler in self.handlers.get(channel, ()):
+                try:
+                    await handler(data)
+                except Exception:
+                    logger.exception("Could not handle message on %s", channel)
+
+    def _owner_key(self, key: str) -> str:
+        return f'{self.prefix}:owner:{key}'
+
+    async def claim(self, key: str, worker: str, force: bool = False) -> str:
+        if force:
+            await self.client.set(self._owner_key(key), worker)
+            return worker
+        if await self.client.set(self._owner_key(key), worker, nx=True):
+            return worker
+        owner = await self.client.get(self._owner_key(key))
+        if owner is None:
+            # released in the meantime
+            return await self.claim(key, worker)
+        return owner.decode('utf-8') if isinstance(owner, bytes) else owner
+
+    async def release(self, key: str, worker: str):
+        owner = await self.client.get(self._owner_key(key))
+        if owner is not None and (owner.decode('utf-8') if isinstance(owner, bytes) else owner) == worker:
+            await self.client.delete(self._owner_key(key))
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.close()
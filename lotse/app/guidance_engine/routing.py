@@ -0,0 +1,123 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from .pubsub import Broker
+
+logger = logging.getLogger(__name__)
+
+# the routing key of the engine shared by all clients when sessions are not isolated
+SHARED = '*'
+
+Executor = Callable[[Optional[str], dict], Awaitable[dict]]
+
+
+class RemoteCommandError(Exception):
+    """
+    A command forwarded to the worker owning the session failed there.
+    """
+
+
+class OwnerUnavailable(Exception):
+    """
+    The worker owning the session did not reply, and this worker took the session over.
+    """
+
+
+class SessionRouter:
+    """
+    Routes commands to the worker that owns the engine they address. The first worker that needs an engine claims it;
+    other workers forward commands for that engine through the broker and wait for the owner's reply. If the owner
+    does not reply within `timeout` seconds, e.g. because it was shut down, the forwarding worker takes the engine over.
+    """
+
+    def __init__(self, broker: Broker, execute: Executor, worker: str = None, timeout: float = 10):
+        """
+        :param broker: The broker shared by all workers
+        :param execute: Executes a command on the local engine and returns the acknowledgement as dictionary with `ok`,
+        `error` and `result`
+        :param worker: The id of this worker. Defaults to a random id.
+        :param timeout: Seconds to wait for the owner to reply
+        """
+        self.broker = broker
+        self.execute = execute
+        self.worker = worker or f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.timeout = timeout
+        self.owned: Set[str] = set()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.started = False
+        self._counter = itertools.count()
+
+    async def start(self):
+        if not self.started:
+            self.started = True
+            await self.broker.subscribe(f'worker:{self.worker}', self._on_message)
+
+    def owns(self, key: str) -> bool:
+        """
+        :return: Whether this worker claimed the key. Does not ask the broker.
+        """
+        return key in self.owned
+
+    async def owner(self, key: str, force: bool = False) -> str:
+        """
+        :return: The worker owning the key, claiming it for this worker if no worker owns it yet
+        """
+        await self.start()
+        owner = await self.broker.claim(key, self.worker, force)
+        if owner == self.worker:
+            self.owned.add(key)
+        else:
+            self.owned.discard(key)
+        return owner
+
+    async def release(self, key: str):
+        self.owned.discard(key)
+        await self.broker.release(key, self.worker)
+
+    async def forward(self, owner: str, key: str, client_id: Optional[str], command: dict) -> Optional[Any]:
+        """
+        Executes the command on the owning worker.
+
+        :return: The result of the command
+        :raises RemoteCommandError: If the command failed on the owner
+        :raises OwnerUnavailable: If the owner did not reply in time. This worker owns the key afterwards.
+        """
+        reply = f'{self.worker}:{next(self._counter)}'
+        future = self.pending[reply] = asyncio.get_running_loop().create_future()
+        request = {'kind': 'request', 'reply_to': self.worker, 'reply': reply, 'client_id': client_id,
+                   'command': command}
+        try:
+            await self.broker.publish(f'worker:{owner}', json.dumps(request))
+            ack = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Worker %s did not reply, taking over %s", owner, key)
+            await self.owner(key, force=True)
+            raise OwnerUnavailable(f"Worker {owner} did not reply")
+        finally:
+            self.pending.pop(reply, None)
+        if not ack.get('ok'):
+            raise RemoteCommandError(ack.get('error'))
+        return ack.get('result')
+
+    async def _on_message(self, text: str):
+        message = json.loads(text)
+        if message.get('kind') == 'reply':
+            future = self.pending.get(message['reply'])
+            if future is not None and not future.done():
+                future.set_result(message['ack'])
+            return
+        # execute concurrently, so that commands forwarded by other workers do not block each other's replies
+        asyncio.create_task(self._execute(message))
+
+    async def _execute(self, message: dict):
+        try:
+            ack = await self.execute(message.get('client_id'), message['command'])
+        except Exception as e:
+            ack = {'ok': False, 'error': str(e)}
+        await self.broker.publish(f"worker:{message['reply_to']}",
+                                  json.dumps({'kind': 'reply', 'reply': message['reply'], 'ack': ack}, default=str))
@@ -0,0 +1,80 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+class Scheduler:
+    """
+    A priority queue of deadlines. The guidance loop sleeps until the earliest deadline has passed, or until a deadline
+    earlier than all others is scheduled, e.g. because a state update arrived.
+
+    Deadlines are unix timestamps. Each key has at most one deadline; scheduling a key again replaces its deadline.
+    """
+
+    def __init__(self):
+        self.queue: List[Tuple[float, int, Hashable]] = []
+        self.deadlines: Dict[Hashable, float] = {}
+        self.wakeup = asyncio.Event()
+        self._counter = itertools.count()
+
+    def schedule(self, key: Hashable, due: Optional[float]):
+        """
+        Sets the deadline of the key. `None` removes the deadline.
+        """
+        if due is None:
+            self.deadlines.pop(key, None)
+            return
+        if self.deadlines.get(key) == due:
+            return
+        earliest = self.next_due()
+        self.deadlines[key] = due
+        # entries whose deadline was replaced stay in the heap and are skipped when they are popped
+        heapq.heappush(self.queue, (due, next(self._counter), key))
+        if earliest is None or due < earliest:
+            self.wakeup.set()
+
+    def notify(self, key: Hashable):
+        """
+        Makes the key due immediately.
+        """
+        self.schedule(key, min(time.time(), self.deadlines.get(key, float('inf'))))
+
+    def next_due(self) -> Optional[float]:
+        while self.queue:
+            due, _, key = self.queue[0]
+            if self.deadlines.get(key) == due:
+                return due
+            heapq.heappop(self.queue)
+        return None
+
+    def pop_due(self, now: float = None) -> List[Hashable]:
+        """
+        Removes and returns all keys whose deadline has passed, earliest first.
+        """
+        now = time.time() if now is None else now
+        keys = []
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                return keys
+            _, _, key = heapq.heappop(self.queue)
+            del self.deadlines[key]
+            keys.append(key)
+
+    async def wait(self):
+        """
+        Sleeps until the earliest deadline has passed or an earlier deadline was scheduled.
+        """
+        due = self.next_due()
+        timeout = None if due is None else max(0.0, due - time.time())
+        if timeout != 0:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeup.clear()
+
+    def __len__(self):
+        return len(self.deadlines)
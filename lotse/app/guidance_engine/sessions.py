@@ -0,0 +1,116 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional
+
+from .journal import JournalStore
+from .lotse_engine import LotseEngine
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    The guidance state of a single client: its own engine with context vector, actions and suggestions.
+    """
+
+    def __init__(self, client_id: str, engine: LotseEngine):
+        self.client_id = client_id
+        self.engine = engine
+        self.connections = 0
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """
+    Creates one isolated engine per client by cloning a template engine that has been parsed once. Sessions are evicted
+    in least-recently-used order once there are more than `max_sessions`, or when they have been idle for longer than
+    `max_idle`. Sessions with open websocket connections are never evicted.
+
+    With `journals`, the state of each session is persisted, and restored when the client returns after its session was
+    evicted or the server restarted.
+    """
+
+    def __init__(self, template: LotseEngine, max_sessions: int = 100, max_idle: Optional[float] = None,
+                 journals: JournalStore = None):
+        """
+        :param template: The engine to clone for new sessions. Its state is never modified by sessions.
+        :param max_sessions: The maximum number of sessions kept in memory
+        :param max_idle: Seconds after which sessions without connections are evicted. None to keep them.
+        :param journals: Where to persist the sessions. None to keep them in memory only.
+        """
+        self.template = template
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.journals = journals
+        self.sessions: 'OrderedDict[str, Session]' = OrderedDict()
+        # called with the client id of every removed session
+        self.on_remove: Optional[Callable[[str], None]] = None
+
+    def get(self, client_id: str) -> LotseEngine:
+        """
+        Returns the engine of the given client, creating a new session if necessary.
+        """
+        return self.session(client_id).engine
+
+    def session(self, client_id: str) -> Session:
+        session = self.sessions.get(client_id)
+        if session is None:
+            self.evict(reserve=1)
+            # the template's context vector was initialized already, and may have been set up further from python
+            engine = self.template.clone()
+            if self.journals is not None:
+                self.journals.attach(engine, client_id)
+            session = Session(client_id, engine)
+            self.sessions[client_id] = session
+            logger.info(f"Created guidance session for client {client_id}")
+        session.last_used = time.monotonic()
+        self.sessions.move_to_end(client_id)
+        return session
+
+    def connect(self, client_id: str) -> Session:
+        session = self.session(client_id)
+        session.connections += 1
+        return session
+
+    def disconnect(self, client_id: str):
+        session = self.sessions.get(client_id)
+        if session is not None:
+            session.connections = max(0, session.connections - 1)
+            session.last_used = time.monotonic()
+
+    def remove(self, client_id: str) -> Optional[Session]:
+        session = self.sessions.pop(client_id, None)
+        if session is not None and self.journals is not None:
+            self.journals.detach(session.engine)
+        if session is not None and self.on_remove is not None:
+            self.on_remove(client_id)
+        return session
+
+    def evict(self, reserve: int = 0):
+        """
+        Removes idle sessions and, least-recently-used first, sessions exceeding `max_sessions`.
+
+        :param reserve: The number of sessions about to be created
+        """
+        now = time.monotonic()
+        idle = [session for session in self.sessions.values() if session.connections == 0]
+        if self.max_idle is not None:
+            for session in [s for s in idle if now - s.last_used > self.max_idle]:
+                self.remove(session.client_id)
+                idle.remove(session)
+                logger.info(f"Evicted idle guidance session for client {session.client_id}")
+        # idle sessions are in least-recently-used order, as the ordered dict is
+        while len(self.sessions) + reserve > self.max_sessions and idle:
+            session = idle.pop(0)
+            self.remove(session.client_id)
+            logger.info(f"Evicted guidance session for client {session.client_id}")
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(list(self.sessions.values()))
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.sessions
@@ -1,29 +1,255 @@
-from typing import List
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Literal, Optional, Tuple
 
 from pydantic import BaseModel
-from starlette.websockets import WebSocket
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from .encoding import COMPRESSIONS, Compression, Encoding, Frame, OutgoingMessage, available_encodings, decode, \
+    encode
+from .pubsub import Broker, LocalBroker
+from .metrics import BROADCAST_BYTES, BROADCAST_DROPPED, BROADCAST_QUEUE_DEPTH, BROADCAST_SEND_SECONDS, CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+# What to do when a client does not read messages as fast as they are produced and its queue is full:
+# - drop_oldest: discard the oldest queued message
+# - coalesce: replace queued messages about the same suggestion, otherwise discard the oldest queued message
+# - disconnect: close the connection to the client
+SlowConsumerPolicy = Literal['drop_oldest', 'coalesce', 'disconnect']
+
+
+class ClientConnection:
+    """
+    A connected websocket with a bounded queue of outgoing messages, drained by its own task.
+
+    Messages are sent in the encoding and compression the client asked for. With `deltas`, a suggestion made by an
+    action that already sent the client a suggestion is sent as JSON merge patch against that previous suggestion.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue_size: int, policy: SlowConsumerPolicy,
+                 client_id: Optional[str] = None, encoding: Encoding = 'json', compression: Compression = 'none',
+                 deltas: bool = False):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.encoding = encoding
+        self.compression = compression
+        self.deltas = deltas
+        # the last suggestion sent to the client by each action, the base for deltas
+        self.sent: Dict[str, dict] = {}
+        # (key, message, time it was queued)
+        self.queue: Deque[Tuple[Optional[str], OutgoingMessage, float]] = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def push(self, key: Optional[str], message: OutgoingMessage) -> bool:
+        """
+        Queues a message without waiting for it to be sent.
+
+        :param key: Messages with the same key supersede each other under the `coalesce` policy.
+        :param message: The message
+        :return: False if the client is too slow and should be disconnected
+        """
+        if self.policy == 'coalesce' and key is not None:
+            for i, (queued_key, _, _) in enumerate(self.queue):
+                if queued_key == key:
+                    del self.queue[i]
+                    self.dropped += 1
+                    BROADCAST_DROPPED.inc(policy=self.policy)
+                    break
+        if len(self.queue) >= self.max_queue_size:
+            if self.policy == 'disconnect':
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            BROADCAST_DROPPED.inc(policy=self.policy)
+        BROADCAST_QUEUE_DEPTH.observe(len(self.queue))
+        self.queue.append((key, message, time.perf_counter()))
+        self.ready.set()
+        return True
+
+    async def drain(self):
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                _, message, queued = self.queue.popleft()
+                frame = self.frame(message)
+                if isinstance(frame, str):
+                    await self.websocket.send_text(frame)
+                else:
+                    await self.websocket.send_bytes(frame)
+                BROADCAST_SEND_SECONDS.observe(time.perf_counter() - queued)
+                BROADCAST_BYTES.inc(len(frame), encoding=self.encoding, compression=self.compression)
+            self.ready.clear()
+
+    def frame(self, message: OutgoingMessage) -> Frame:
+        """
+        Encodes the message for this client. Deltas are computed when the message is sent rather than queued, so that
+        they always refer to a suggestion the client has received.
+        """
+        if not self.deltas or message.interaction != 'make' or message.action_id is None:
+            return message.frame(self.encoding, self.compression)
+        base = self.sent.get(message.action_id)
+        self.sent[message.action_id] = message.data['suggestion']
+        delta = message.delta(base) if base is not None else None
+        if delta is None:
+            return message.frame(self.encoding, self.compression)
+        return encode(delta, self.encoding, self.compression)
 
 
 class ConnectionManager:
-    def __init__(self):
+    """
+    Sends messages to the websockets connected to this process. Broadcasts and messages to clients are published through
+    a `Broker`, so that they also reach clients connected to other workers.
+    """
+
+    def __init__(self, max_queue_size: int = 100, slow_consumer_policy: SlowConsumerPolicy = 'drop_oldest',
+                 broker: Broker = None):
+        """
+        :param max_queue_size: The maximum number of messages queued per client before the slow consumer policy applies
+        :param slow_consumer_policy: How to handle clients whose queue is full, see `SlowConsumerPolicy`
+        :param broker: Distributes messages between workers. Defaults to a `LocalBroker` for a single worker.
+        """
         self.connections: List[WebSocket] = []
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.max_queue_size = max_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.broker = broker or LocalBroker()
+        self.subscribed = False
 
-    async def connect(self, websocket: WebSocket):
+    def configure(self, max_queue_size: int = None, slow_consumer_policy: SlowConsumerPolicy = None,
+                  broker: Broker = None):
+        if max_queue_size is not None:
+            self.max_queue_size = max_queue_size
+        if slow_consumer_policy is not None:
+            self.slow_consumer_policy = slow_consumer_policy
+        if broker is not None and broker is not self.broker:
+            self.broker = broker
+            self.subscribed = False
+        for client in self.clients.values():
+            client.max_queue_size = self.max_queue_size
+            client.policy = self.slow_consumer_policy
+
+    async def connect(self, websocket: WebSocket, client_id: Optional[str] = None, encoding: Encoding = 'json',
+                      compression: Compression = 'none', deltas: bool = False):
+        """
+        Accepts the websocket and starts sending messages to it.
+
+        :param encoding: `json` or `msgpack`. MessagePack requires the `msgpack` package.
+        :param compression: `none` or `deflate` to compress every message. Prefer the permessage-deflate extension of
+        the websocket server if the client supports it.
+        :param deltas: Whether to send suggestions of an action as patches against its previous suggestion
+        :raises ValueError: If the encoding is not available
+        """
+        if encoding not in available_encodings():
+            raise ValueError(f"Unsupported encoding {encoding}, use one of {', '.join(available_encodings())}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression {compression}, use one of {', '.join(COMPRESSIONS)}")
+        await self._subscribe()
         await websocket.accept()
+        client = ClientConnection(websocket, self.max_queue_size, self.slow_consumer_policy, client_id, encoding,
+                                  compression, deltas)
+        client.task = asyncio.create_task(self._send(client))
         self.connections.append(websocket)
+        self.clients[websocket] = client
+        CONNECTIONS.set(len(self.clients))
 
     async def broadcast(self, message: BaseModel):
-        print("Serializing message to JSON: ", message.json(exclude={'action'}))
-        for connection in self.connections:
-            # if connection is not websocket:
-            await connection.send_text(message.json(exclude={'action'}))
+        """
+        Serializes the message once per encoding and queues it for all connected clients of all workers. Does not wait
+        for the messages to be sent.
+        """
+        await self._subscribe()
+        outgoing = OutgoingMessage(message)
+        await self.broker.publish('broadcast', outgoing.text, outgoing)
+
+    async def send(self, client_id: str, message: BaseModel):
+        """
+        Queues the message for all connections of the given client only, on all workers.
+        """
+        await self._subscribe()
+        outgoing = OutgoingMessage(message)
+        await self.broker.publish('send', f'{client_id}\n{outgoing.text}', (client_id, outgoing))
+
+    async def _subscribe(self):
+        if not self.subscribed:
+            self.subscribed = True
+            await self.broker.subscribe('broadcast', self._on_broadcast)
+            await self.broker.subscribe('send', self._on_send)
+
+    async def _on_broadcast(self, message: Any):
+        outgoing = message if isinstance(message, OutgoingMessage) else OutgoingMessage(text=message)
+        await self._queue(list(self.clients.values()), outgoing)
+
+    async def _on_send(self, message: Any):
+        if isinstance(message, tuple):
+            client_id, outgoing = message
+        else:
+            client_id, text = message.split('\n', 1)
+            outgoing = OutgoingMessage(text=text)
+        await self._queue([client for client in self.clients.values() if client.client_id == client_id], outgoing)
+
+    async def reply(self, websocket: WebSocket, message: BaseModel):
+        """
+        Queues the message for the given connection only, behind the messages already queued for it.
+        """
+        client = self.clients.get(websocket)
+        if client is not None:
+            await self._queue([client], OutgoingMessage(message))
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        """
+        Waits for the next message of the client and decodes it.
+
+        :raises WebSocketDisconnect: If the client disconnected
+        """
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        client = self.clients.get(websocket)
+        frame = message.get('text') if message.get('text') is not None else message.get('bytes')
+        if client is None:
+            return decode(frame)
+        return decode(frame, client.encoding, client.compression)
+
+    async def _queue(self, clients: List[ClientConnection], outgoing: OutgoingMessage):
+        if not clients:
+            return
+        logger.debug("Sending message to %d clients: %s", len(clients), outgoing.text)
+        for client in clients:
+            if not client.push(outgoing.key, outgoing):
+                logger.warning("Disconnecting slow client with %d queued messages", len(client.queue))
+                self.clients.pop(client.websocket, None)
+                client.task.cancel()
+                asyncio.create_task(self.disconnect(client.websocket))
+        # give the sender tasks a chance to pick up the messages
+        await asyncio.sleep(0)
+
+    async def _send(self, client: ClientConnection):
+        try:
+            await client.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.info("Could not send message to client, disconnecting", exc_info=True)
+            await self.disconnect(client.websocket)
 
     async def disconnect(self, websocket: WebSocket):
+        client = self.clients.pop(websocket, None)
+        CONNECTIONS.set(len(self.clients))
+        if client is not None and client.task is not None and client.task is not asyncio.current_task():
+            client.task.cancel()
         try:
-            self.connections.remove(websocket)
+            if websocket in self.connections:
+                self.connections.remove(websocket)
             await websocket.close()
         except RuntimeError:
-            print("\n\nERROR ON DISCONNECT\n\n")
+            # the websocket was already closed by the client
             pass
 
 
@@ -0,0 +1,196 @@
+import hashlib
+import heapq
+import json
+import time
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+from lotse.action import ConditionalGuidanceAction
+from lotse.suggestion import SuggestionModel
+
+
+class SuggestionPolicy:
+    """
+    Bounds the suggestions an engine keeps alive. Actions can override `ttl` and `max_per_action` with
+    `suggestion_ttl` and `max_suggestions` in their `metadata`.
+    """
+
+    def __init__(self, ttl: float = None, max_per_action: int = None, max_per_strategy: int = None,
+                 deduplicate: bool = True):
+        """
+        :param ttl: Seconds after which suggestions are retracted automatically. None keeps them until they are
+        accepted, rejected or retracted by their action.
+        :param max_per_action: The number of suggestions each action can have at once. When exceeded, the oldest
+        suggestions of the action are retracted.
+        :param max_per_strategy: Like `max_per_action`, for all actions of a strategy.
+        :param deduplicate: Whether to drop new suggestions whose action, title and content equal a live suggestion.
+        """
+        self.ttl = ttl
+        self.max_per_action = max_per_action
+        self.max_per_strategy = max_per_strategy
+        self.deduplicate = deduplicate
+
+    def ttl_for(self, action: ConditionalGuidanceAction) -> Optional[float]:
+        return (getattr(action, 'metadata', None) or {}).get('suggestion_ttl', self.ttl)
+
+    def limit_for(self, action: ConditionalGuidanceAction) -> Optional[int]:
+        return (getattr(action, 'metadata', None) or {}).get('max_suggestions', self.max_per_action)
+
+
+def content_key(suggestion: SuggestionModel) -> Tuple[Hashable, str]:
+    """
+    :return: The action of the suggestion and a hash of its title and content, which identify duplicate suggestions.
+    """
+    content = json.dumps([suggestion.suggestion.title, suggestion.suggestion.event.value], sort_keys=True, default=str)
+    return suggestion.action, hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class SuggestionStore:
+    """
+    Holds the suggestions currently made by the engine, indexed by suggestion id, by the action that generated them and
+    by the strategy they belong to. Lookup, insertion and removal take constant time. Iteration yields suggestions in
+    the order in which they were added.
+
+    The store enforces its `SuggestionPolicy`: adding a suggestion returns the suggestions it displaced from a full
+    action or strategy, and `expired()` returns suggestions that outlived their TTL.
+    """
+
+    def __init__(self, suggestions: Iterable[SuggestionModel] = (), policy: SuggestionPolicy = None):
+        self.policy = policy or SuggestionPolicy()
+        self.by_id: Dict[str, SuggestionModel] = {}
+        self.by_action: Dict[ConditionalGuidanceAction, Dict[str, SuggestionModel]] = {}
+        self.by_strategy: Dict[str, Dict[str, SuggestionModel]] = {}
+        self.by_content: Dict[Tuple[Hashable, str], str] = {}
+        self.keys: Dict[str, Tuple[Hashable, str]] = {}
+        # (expiry time, suggestion id); entries of removed suggestions are skipped when they reach the top
+        self.expiry: List[Tuple[float, str]] = []
+        self.expires: Dict[str, float] = {}
+        self.extend(suggestions)
+
+    def duplicate(self, suggestion: SuggestionModel) -> Optional[SuggestionModel]:
+        """
+        :return: The live suggestion of the same action with the same title and content, if deduplication is enabled.
+        """
+        if not self.policy.deduplicate:
+            return None
+        existing = self.by_content.get(content_key(suggestion))
+        return self.by_id.get(existing) if existing is not None else None
+
+    def add(self, suggestion: SuggestionModel, now: float = None) -> List[SuggestionModel]:
+        """
+        Adds the suggestion and removes the oldest suggestions of its action and strategy beyond their limits.
+
+        :return: The removed suggestions
+        """
+        suggestion_id = suggestion.suggestion.id
+        self.remove(suggestion_id)
+        self.by_id[suggestion_id] = suggestion
+        self.by_action.setdefault(suggestion.action, {})[suggestion_id] = suggestion
+        self.by_strategy.setdefault(suggestion.suggestion.strategy, {})[suggestion_id] = suggestion
+        key = self.keys[suggestion_id] = content_key(suggestion)
+        self.by_content[key] = suggestion_id
+        ttl = self.policy.ttl_for(suggestion.action)
+        if ttl is not None:
+            due = self.expires[suggestion_id] = (time.time() if now is None else now) + ttl
+            heapq.heappush(self.expiry, (due, suggestion_id))
+
+        removed = []
+        for bucket, limit in ((self.by_action.get(suggestion.action), self.policy.limit_for(suggestion.action)),
+                              (self.by_strategy.get(suggestion.suggestion.strategy), self.policy.max_per_strategy)):
+            if limit is None or bucket is None:
+                continue
+            # buckets keep insertion order, so the first suggestions are the oldest
+            for oldest in list(bucket)[:max(0, len(bucket) - max(limit, 1))]:
+                removed.append(self.remove(oldest))
+        return removed
+
+    def extend(self, suggestions: Iterable[SuggestionModel]) -> List[SuggestionModel]:
+        removed = []
+        for suggestion in suggestions:
+            removed.extend(self.add(suggestion))
+        return removed
+
+    def next_expiry(self) -> Optional[float]:
+        """
+        :return: When the next suggestion expires, as a unix timestamp
+        """
+        while self.expiry:
+            due, suggestion_id = self.expiry[0]
+            if self.expires.get(suggestion_id) == due:
+                return due
+            heapq.heappop(self.expiry)
+        return None
+
+    def expired(self, now: float = None) -> List[SuggestionModel]:
+        """
+        Removes and returns all suggestions whose TTL has passed, oldest first.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        while True:
+            due = self.next_expiry()
+            if due is None or due > now:
+                return expired
+            _, suggestion_id = heapq.heappop(self.expiry)
+            expired.append(self.remove(suggestion_id))
+
+    def get(self, suggestion_id: str) -> Optional[SuggestionModel]:
+        return self.by_id.get(suggestion_id)
+
+    def remove(self, suggestion_id: str) -> Optional[SuggestionModel]:
+        """
+        Removes the suggestion with the given id from all indices.
+
+        :return: The removed suggestion, or None if there was no suggestion with that id.
+        """
+        suggestion = self.by_id.pop(suggestion_id, None)
+        if suggestion is None:
+            return None
+        for index, key in ((self.by_action, suggestion.action), (self.by_strategy, suggestion.suggestion.strategy)):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(suggestion_id, None)
+                if not bucket:
+                    del index[key]
+        key = self.keys.pop(suggestion_id, None)
+        if self.by_content.get(key) == suggestion_id:
+            del self.by_content[key]
+        if self.expires.pop(suggestion_id, None) is not None and len(self.expiry) > 2 * len(self.expires) + 64:
+            # drop stale entries so that the heap stays proportional to the live suggestions
+            self.expiry = [(due, i) for due, i in self.expiry if self.expires.get(i) == due]
+            heapq.heapify(self.expiry)
+        return suggestion
+
+    def replace_action(self, old: ConditionalGuidanceAction, new: ConditionalGuidanceAction):
+        """
+        Moves the suggestions of an action to its replacement, e.g. after its yaml file was reloaded, keeping their
+        order and expiry.
+        """
+        bucket = self.by_action.pop(old, None)
+        if not bucket:
+            return
+        self.by_action.setdefault(new, {}).update(bucket)
+        for suggestion_id, suggestion in bucket.items():
+            suggestion.action = new
+            key = self.keys[suggestion_id]
+            if self.by_content.get(key) == suggestion_id:
+                del self.by_content[key]
+            key = self.keys[suggestion_id] = content_key(suggestion)
+            self.by_content[key] = suggestion_id
+
+    def for_action(self, action: ConditionalGuidanceAction) -> List[SuggestionModel]:
+        return list(self.by_action.get(action, {}).values())
+
+    def for_strategy(self, strategy: str) -> List[SuggestionModel]:
+        return list(self.by_strategy.get(strategy, {}).values())
+
+    def actions(self) -> List[ConditionalGuidanceAction]:
+        return list(self.by_action)
+
+    def __contains__(self, suggestion_id: str) -> bool:
+        return suggestion_id in self.by_id
+
+    def __iter__(self) -> Iterator[SuggestionModel]:
+        return iter(list(self.by_id.values()))
+
+    def __len__(self) -> int:
+        return len(self.by_id)
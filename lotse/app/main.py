@@ -1,22 +1,40 @@
 import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
 import logging
+import os
 import sys
-from typing import List, Any, Optional, Dict
+import time
+from typing import List, Any, Optional, Dict, Tuple
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from .guidance_engine import socket_manager
+from .guidance_engine.executor import CallbackExecutor
+from .guidance_engine.journal import JournalStore
+from .guidance_engine.loader import StrategyLoader
 from .guidance_engine.lotse_engine import LotseEngine
+from .guidance_engine.pubsub import Broker
+from .guidance_engine.parallel import StrategyPool
+from .guidance_engine.routing import SHARED, OwnerUnavailable, RemoteCommandError, SessionRouter
+from .guidance_engine.metrics import ACTION_PASS_SECONDS, STRATEGY_PASS_SECONDS, SUGGESTIONS_OPEN, registry
+from .guidance_engine.profiler import ProfilerMode, profiler
+from .guidance_engine.scheduler import Scheduler
+from .guidance_engine.sessions import SessionManager
 from .guidance_engine.socket_manager import get_connection_manager, ConnectionManager
+from .guidance_engine.suggestion_store import SuggestionPolicy
 from ..suggestion import SuggestionModel
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOTSE_LOG_LEVEL', 'INFO').upper(),
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
     handlers=[
         logging.StreamHandler(sys.stdout)
@@ -24,73 +42,318 @@ logging.basicConfig(
 )
 logger = logging.Logger('catch_all')
 
+# set while executing commands on this worker, e.g. those forwarded by other workers, to prevent routing them again
+_local_only = contextvars.ContextVar('local_only', default=False)
+
 
 class GuidanceAPI(FastAPI):
     def __init__(self, **extra: Any):
+        extra.setdefault('lifespan', self.lifespan)
         super().__init__(**extra)
         self.lotse_engine = None
-        self.action_task = None
-        self.strategies_task = None
+        self.sessions: Optional[SessionManager] = None
+        # routes commands to the worker owning an engine, if a broker connects several workers
+        self.session_router: Optional[SessionRouter] = None
+        # persists the engines, see `setup_engine`
+        self.journals: Optional[JournalStore] = None
+        self.scheduler = Scheduler()
+        self.scheduler_task = None
 
         self.guidance_loop_timeout = 2
         self.inference_loop_timeout = 30
-
-    def get_engine(self) -> LotseEngine:
-        return self.lotse_engine
-
-    # every two seconds, evaluate all conditional actions and potentially generate new suggestions
-    async def evaluate_actions(self, manager=get_connection_manager()):
-        try:
-            retract = self.lotse_engine.suggestions_to_retract()
-            print(f"got suggestions to retract: {retract}")
-            for suggestion in retract:
-                print('hi')
-                suggestion.interaction = 'retract'
-                suggestion.action.retract(app.lotse_engine.current_state, app.lotse_engine.last_delta, suggestion)
-                await manager.broadcast(suggestion)
-
-            print('generating suggestions')
-            suggestions = self.lotse_engine.generate_suggestions()
-            print(f"got new suggestions to broadcast: {suggestions}")
-            for suggestion in suggestions:
-                print(suggestion)
-                await manager.broadcast(suggestion)
-        except:
-            logging.exception("Could not evaluate actions")
-
-    # every two seconds, evaluate all conditional actions and potentially generate new suggestions
-    async def evaluate_actions_continuously(self):
-        while True:
-            print('-----------------------------------------------------')
-            print('generating next update')
-
-            # broadcast new guidance
-            await self.evaluate_actions()
-            await asyncio.sleep(self.guidance_loop_timeout)
-
-    # every 30 seconds, evaluate all strategies
-    async def evaluate_strategies_continously(self):
+        self.update_debounce = 0
+        # seconds between checks for changed yaml files, None to disable hot reloading
+        self.reload_interval: Optional[float] = None
+        self._pending_evaluations: Dict[Optional[str], Dict[str, bool]] = {}
+        # client -> when the scheduler evaluates the engine's state changes, e.g. at the end of a debounce window
+        self._changes_due: Dict[Optional[str], float] = {}
+
+    def routing_key(self, client_id: Optional[str]) -> str:
+        return SHARED if self.sessions is None or client_id is None else client_id
+
+    async def remote_owner(self, client_id: Optional[str]) -> Optional[str]:
+        """
+        :return: The worker owning the engine of the client if it is not this worker. Claims the engine for this
+        worker if no worker owns it yet.
+        """
+        if self.session_router is None or _local_only.get():
+            return None
+        key = self.routing_key(client_id)
+        if self.session_router.owns(key):
+            return None
+        owner = await self.session_router.owner(key)
+        return None if owner == self.session_router.worker else owner
+
+    def get_engine(self, client_id: Optional[str] = None) -> LotseEngine:
+        """
+        Returns the engine of the given client if sessions are isolated, and the shared engine otherwise.
+        """
+        if self.sessions is None or client_id is None:
+            return self.lotse_engine
+        return self.sessions.get(client_id)
+
+    def state_engine(self, client_id: Optional[str] = None) -> LotseEngine:
+        """
+        Returns the engine whose context vector a state update of the given client modifies.
+
+        :raises HTTPException: 400 if sessions are isolated and no client is given, as the update would modify the
+        template of all new sessions rather than the state of any client
+        """
+        if self.sessions is not None and client_id is None:
+            raise HTTPException(400, "Sessions are isolated, state updates require a client_id")
+        return self.get_engine(client_id)
+
+    def engines(self) -> List[Tuple[Optional[str], LotseEngine]]:
+        """
+        :return: The engines evaluated in the guidance loop, each with the client that receives its suggestions.
+        Engines owned by other workers are evaluated there.
+        """
+        if self.sessions is None:
+            return [(None, self.lotse_engine)] if self.session_router is None or self.session_router.owns(SHARED) else []
+        return [(session.client_id, session.engine) for session in self.sessions]
+
+    def _targets(self, client_id: Optional[str]) -> List[Tuple[Optional[str], LotseEngine]]:
+        if client_id is None or self.sessions is None:
+            return self.engines()
+        if self.session_router is not None and not self.session_router.owns(client_id):
+            return []
+        return [(client_id, self.get_engine(client_id))]
+
+    def schedule(self, client_id: Optional[str] = None):
+        """
+        (Re-)schedules the next strategy and action evaluation of the engine serving the given client.
+        """
+        if self.sessions is None:
+            client_id, engine = None, self.lotse_engine
+        else:
+            session = self.sessions.sessions.get(client_id)
+            engine = session.engine if session is not None else None
+        if engine is None:
+            self.scheduler.schedule(('actions', client_id), None)
+            self.scheduler.schedule(('strategies', client_id), None)
+            return
+        self.scheduler.schedule(('actions', client_id),
+                                engine.next_action_due(self.guidance_loop_timeout, self._changes_due.get(client_id)))
+        self.scheduler.schedule(('strategies', client_id), engine.next_strategy_due(self.inference_loop_timeout))
+
+    async def publish(self, message: SuggestionModel, client_id: Optional[str] = None,
+                      manager=get_connection_manager()):
+        if self.sessions is None or client_id is None:
+            await manager.broadcast(message)
+        else:
+            await manager.send(client_id, message)
+
+    async def evaluate_actions(self, manager=get_connection_manager(), client_id: Optional[str] = None):
+        for target, engine in self._targets(client_id):
+            if target not in self._pending_evaluations:
+                self._changes_due.pop(target, None)
+            try:
+                async with engine.lock:
+                    with ACTION_PASS_SECONDS.time():
+                        retract = await engine.retract_suggestions()
+                        suggestions = await engine.generate_suggestions()
+                        retract.extend(engine.take_evicted())
+                logging.debug("Retracting %d and broadcasting %d new suggestions", len(retract), len(suggestions))
+                for suggestion in retract:
+                    await self.publish(suggestion, target, manager)
+                for suggestion in suggestions:
+                    await self.publish(suggestion, target, manager)
+            except Exception:
+                logging.exception("Could not evaluate actions")
+            self.schedule(target)
+        SUGGESTIONS_OPEN.set(sum(len(engine.suggestions) for _, engine in self.engines()))
+        profiler.tick()
+
+    async def request_evaluation(self, client_id: Optional[str] = None, strategies: bool = False, actions: bool = True):
+        """
+        Evaluates strategies and/or actions after a state update. If `update_debounce` is set, all requests arriving
+        within that many seconds of the first one are coalesced into a single evaluation at the end of the window, and
+        the scheduler does not evaluate the changes before. Without re-evaluation, the update is picked up by the
+        scheduler within `guidance_loop_timeout` seconds.
+        """
+        if self.update_debounce <= 0:
+            # requested evaluations run right away, so the scheduler does not need to evaluate the changes
+            self._defer_changes(client_id)
+            self.schedule(client_id)
+            if strategies:
+                await self.evaluate_strategies(client_id)
+            if actions:
+                await self.evaluate_actions(client_id=client_id)
+            return
+        pending = self._pending_evaluations.get(client_id)
+        if pending is None:
+            pending = self._pending_evaluations[client_id] = {'strategies': False, 'actions': False}
+            self._changes_due[client_id] = time.time() + self.update_debounce
+            asyncio.create_task(self._evaluate_after_debounce(client_id))
+        pending['strategies'] |= strategies
+        pending['actions'] |= actions
+        self.schedule(client_id)
+
+    def _defer_changes(self, client_id: Optional[str]):
+        """
+        Lets the scheduler evaluate state changes in its next regular pass rather than right away.
+        """
+        due = time.time() + self.guidance_loop_timeout
+        self._changes_due[client_id] = min(self._changes_due.get(client_id, due), due)
+
+    async def _evaluate_after_debounce(self, client_id: Optional[str]):
+        await asyncio.sleep(self.update_debounce)
+        pending = self._pending_evaluations.pop(client_id)
+        self._changes_due.pop(client_id, None)
+        self._defer_changes(client_id)
+        self.schedule(client_id)
+        if pending['strategies']:
+            await self.evaluate_strategies(client_id)
+        if pending['actions']:
+            await self.evaluate_actions(client_id=client_id)
+
+    async def run_scheduler(self):
+        """
+        Evaluates the strategies and actions of all engines when they are due, and sleeps otherwise. Actions are due
+        when the state changed, when their trigger is due, or every `guidance_loop_timeout` seconds if they depend on
+        the current time. Strategies are due every `inference_loop_timeout` seconds.
+        """
+        if self.session_router is not None and self.sessions is None:
+            await self.session_router.owner(SHARED)
+        for client_id, _ in self.engines():
+            self.schedule(client_id)
+        if self.sessions is not None:
+            self.scheduler.schedule('evict', time.time() + self.inference_loop_timeout)
+        if self.reload_interval is not None:
+            self.scheduler.schedule('reload', time.time() + self.reload_interval)
         while True:
-            print('updating strategies periodically')
-            self.evaluate_strategies()
-            await asyncio.sleep(self.inference_loop_timeout)
-
-    def evaluate_strategies(self):
-        try:
-            if not self.lotse_engine.current_state:
-                return
-            self.lotse_engine.applicable_strategies = self.lotse_engine.get_applicable_strategies()
-            self.lotse_engine.generate_conditional_actions()
-        except:
-            logging.exception("Could not evaluate actions")
-
-    def setup_engine(self, path: str, initial_context, meta='meta.yaml', guidance_loop_timeout=2, inference_loop_timeout=30):
-        self.lotse_engine = LotseEngine(path, initial_context, meta)
-        self.lotse_engine.applicable_strategies = self.lotse_engine.strategies
+            await self.scheduler.wait()
+            for key in self.scheduler.pop_due():
+                if key == 'evict':
+                    self.sessions.evict()
+                    self.scheduler.schedule('evict', time.time() + self.inference_loop_timeout)
+                    continue
+                if key == 'reload':
+                    await self.reload_strategies()
+                    self.scheduler.schedule('reload', time.time() + self.reload_interval)
+                    continue
+                kind, client_id = key
+                if self.sessions is not None and client_id not in self.sessions:
+                    continue
+                if kind == 'strategies':
+                    await self.evaluate_strategies(client_id)
+                else:
+                    await self.evaluate_actions(client_id=client_id)
+
+    async def reload_strategies(self, manager=get_connection_manager()):
+        """
+        Reloads strategy, action and meta strategy files that changed since they were loaded, in the engine loaded by
+        `setup_engine` and in all engines of this worker. Suggestions of actions that no longer exist are retracted.
+        """
+        changed = self.lotse_engine.loader.changed()
+        targets = self.engines()
+        # sessions are cloned from the engine loaded by `setup_engine`, which must be up to date as well
+        engines = targets + [(None, self.lotse_engine)] if all(e is not self.lotse_engine for _, e in targets) \
+            else targets
+        for target, engine in engines:
+            try:
+                async with engine.lock:
+                    retract = await engine.reload(changed)
+                for suggestion in retract:
+                    await self.publish(suggestion, target, manager)
+            except Exception:
+                logging.exception("Could not reload strategies")
+            if engine is not self.lotse_engine or self.sessions is None:
+                self.schedule(target)
+
+    async def evaluate_strategies(self, client_id: Optional[str] = None):
+        for target, engine in self._targets(client_id):
+            try:
+                if not engine.current_state:
+                    continue
+                async with engine.lock:
+                    with STRATEGY_PASS_SECONDS.time():
+                        await engine.evaluate_strategies()
+            except Exception:
+                logging.exception("Could not evaluate actions")
+            self.schedule(target)
+        profiler.tick()
+
+    def setup_engine(self, path: str, initial_context, meta='meta.yaml', guidance_loop_timeout=2, inference_loop_timeout=30,
+                     max_queue_size=100, slow_consumer_policy='drop_oldest', isolate_sessions=False, max_sessions=100,
+                     session_idle_timeout=None, callback_timeout=None, callback_executor: CallbackExecutor = None,
+                     update_debounce=0, strategy_cache=True, lazy_loading=True, suggestion_ttl=None,
+                     max_suggestions_per_action=None, max_suggestions_per_strategy=None, deduplicate_suggestions=True,
+                     history_size=100, history_age=None, history_bytes=64 * 2 ** 20, broker: Broker = None,
+                     hot_reload=False, reload_interval=1, parallel_strategies=0, journal_path=None,
+                     snapshot_every=1000):
+        """
+        Loads strategies, actions and the state vector and configures the guidance engine.
+
+        If `isolate_sessions` is True, every websocket client gets its own engine, cloned from the engine loaded here.
+        At most `max_sessions` sessions are kept; the least recently used ones without open connections are evicted
+        first, as are sessions idle for more than `session_idle_timeout` seconds.
+
+        Callbacks defined in the yaml files run in a thread pool. Callbacks taking longer than `callback_timeout`
+        seconds are abandoned and their action or strategy is skipped for a while. Pass a `CallbackExecutor` as
+        `callback_executor` for finer control, e.g. timeouts per callback.
+
+        State updates requesting re-evaluation within `update_debounce` seconds are coalesced into a single evaluation.
+
+        Parsed yaml files and compiled callbacks are cached in `__lotse_cache__` within `path`, so that only changed
+        files are parsed again on the next start. Pass a directory as `strategy_cache` to cache elsewhere, or False to
+        disable the cache. With `lazy_loading`, the actions of a strategy are only built once the strategy is applicable,
+        and no strategy is considered applicable before the first strategy evaluation. Otherwise, all strategies are
+        considered applicable until then.
+
+        Suggestions are retracted automatically after `suggestion_ttl` seconds. Once an action or strategy has
+        `max_suggestions_per_action` or `max_suggestions_per_strategy` live suggestions, its oldest suggestions are
+        retracted in favor of new ones. With `deduplicate_suggestions`, new suggestions whose action, title and content
+        equal a live suggestion are dropped.
+
+        Callbacks can query the last `history_size` versions of the context vector, or those of the last `history_age`
+        seconds, as `ctx.history`. Older versions are also dropped while the values they hold exceed an estimated
+        `history_bytes`, None to not limit their size.
+
+        To run several workers, pass a `broker` shared by all of them, e.g. a `RedisBroker`. Suggestions then reach
+        clients connected to any worker, and every engine (the shared one, or each session) is evaluated by a single
+        worker that claims it. Other workers forward state updates and interactions to the owner.
+
+        With `hot_reload`, the strategy path is checked for changed, added and deleted yaml files every
+        `reload_interval` seconds. Only the changed files are parsed again, and the affected strategies and actions are
+        replaced between two evaluation passes, keeping their runtime state where their declaration did not change.
+
+        With `parallel_strategies`, the applicability of strategies is evaluated in that many worker processes (True for
+        one per CPU). Workers read large NumPy arrays and columnar data of the context vector from shared memory.
+
+        With a `journal_path`, the context vector, suggestions and the state of actions and strategies of every engine
+        are journaled to that directory and compacted into a snapshot every `snapshot_every` records. After a restart,
+        each engine resumes where it left off; sessions are restored when their client returns.
+        """
+        executor = callback_executor or CallbackExecutor(timeout=callback_timeout)
+        if strategy_cache is True:
+            strategy_cache = os.path.join(path, '__lotse_cache__')
+        loader = StrategyLoader(strategy_cache or None, lazy_loading)
+        policy = SuggestionPolicy(suggestion_ttl, max_suggestions_per_action, max_suggestions_per_strategy,
+                                  deduplicate_suggestions)
+        pool = None
+        if parallel_strategies:
+            pool = StrategyPool(path, initial_context, strategy_cache or None,
+                                None if parallel_strategies is True else parallel_strategies)
+        self.lotse_engine = LotseEngine(path, initial_context, meta, executor, loader, policy, history_size,
+                                        history_age, pool, history_bytes)
+        get_connection_manager().configure(max_queue_size, slow_consumer_policy, broker)
+        self.session_router = SessionRouter(broker, _execute_forwarded) if broker is not None else None
+        if not lazy_loading:
+            self.lotse_engine.applicable_strategies = self.lotse_engine.strategies
         self.guidance_loop_timeout = guidance_loop_timeout
         self.inference_loop_timeout = inference_loop_timeout
-        print(f"got {len(self.lotse_engine.applicable_strategies)} applicable strats")
+        self.update_debounce = update_debounce
+        self.reload_interval = reload_interval if hot_reload else None
+        logging.info(f"Loaded {len(self.lotse_engine.strategies)} strategies")
         self.lotse_engine.generate_conditional_actions()
+        self.journals = JournalStore(journal_path, snapshot_every) if journal_path else None
+        self.sessions = SessionManager(self.lotse_engine, max_sessions, session_idle_timeout, self.journals) \
+            if isolate_sessions else None
+        if self.journals is not None and self.sessions is None:
+            self.journals.attach(self.lotse_engine, SHARED)
+        if self.sessions is not None and self.session_router is not None:
+            self.sessions.on_remove = lambda client_id: asyncio.ensure_future(self.session_router.release(client_id))
         return self
 
     def start(self):
@@ -107,19 +370,91 @@ class GuidanceAPI(FastAPI):
 
         loop.set_exception_handler(handle_exception)
 
-        self.strategies_task = loop.create_task(self.evaluate_strategies_continously())
-        self.action_task = loop.create_task(self.evaluate_actions_continuously())
+        self.scheduler_task = loop.create_task(self.run_scheduler())
         if not loop.is_running():
             loop.run_forever()
 
     def stop(self):
+        """
+        Stops the guidance loop until `start` is called again. The engines are journaled further, as state updates are
+        still accepted while the loop is stopped, and a snapshot of each is written, in the background if called from
+        the event loop.
+        """
         if not self.lotse_engine:
             raise Exception('You must initialize your engine by calling setup_engine() first.')
-        self.strategies_task.cancel()
-        self.action_task.cancel()
+        if self.scheduler_task is not None:
+            self.scheduler_task.cancel()
+            self.scheduler_task = None
+        if self.journals is not None:
+            for _, engine in self.engines():
+                self.journals.checkpoint(engine)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, _: FastAPI):
+        yield
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stops the guidance loop, journaling, the callback threads and the strategy worker processes for good, when the
+        app shuts down.
+        """
+        if not self.lotse_engine:
+            return
+        self.stop()
+        if self.journals is not None:
+            for _, engine in self.engines():
+                self.journals.detach(engine)
+        # sessions share the executor and the pool of the template engine
+        self.lotse_engine.executor.shutdown()
+        if self.lotse_engine.pool is not None:
+            self.lotse_engine.pool.shutdown()
+
+    async def interact(self, client_id: Optional[str], interaction: str, suggestion_id: str) -> SuggestionModel:
+        """
+        Accepts, rejects or starts or ends the preview of a suggestion.
+
+        :param interaction: `accept`, `reject`, `preview_start` or `preview_end`
+        :raises KeyError: If there is no suggestion with that id
+        """
+        engine = self.get_engine(client_id)
+        async with engine.lock:
+            if interaction == 'accept':
+                suggestion = await engine.accept_suggestion(suggestion_id)
+            elif interaction == 'reject':
+                suggestion = await engine.reject_suggestion(suggestion_id)
+            elif interaction == 'preview_start':
+                suggestion = await engine.preview_start(suggestion_id, client_id)
+            elif interaction == 'preview_end':
+                suggestion = await engine.preview_end(suggestion_id)
+            else:
+                raise ValueError(f"Unknown interaction {interaction}")
+        self.schedule(client_id)
+        return suggestion
+
+    def release_previews(self, client_id: str):
+        """
+        Ends the previews the client started and did not end, so that their snapshots no longer keep versions of the
+        context vector in its history. Sessions owned by other workers are left as they are.
+        """
+        if self.sessions is None:
+            engines = [engine for _, engine in self.engines()]
+        else:
+            session = self.sessions.sessions.get(client_id)
+            engines = [session.engine] if session is not None else []
+        for engine in engines:
+            released = engine.history.release_previews(client_id)
+            if released:
+                logging.debug("Ended %d previews of disconnected client %s", released, client_id)
 
     def update_state(self, key, value):
-        self.lotse_engine.current_state.__dict__.update({key: value})
+        """
+        Sets an attribute of the shared context vector from python, like `/state/update` without re-evaluation: the
+        change is recorded in the delta and picked up by the next scheduled pass.
+        """
+        self.lotse_engine.update_state({key: value})
+        self._defer_changes(None)
+        self.schedule()
 
 
 app = GuidanceAPI()
@@ -137,6 +472,35 @@ app.add_middleware(
 )
 
 
+def routed(command: str, payload=lambda model: json.loads(model.json())):
+    """
+    Forwards requests for engines owned by other workers to their owner as websocket command, see `COMMANDS`.
+
+    :param command: The name of the command
+    :param payload: Converts the request body into the fields of the command
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def route(*args, **kwargs):
+            client_id = kwargs.get('client_id')
+            if not _local_only.get():
+                # websocket commands are counted by `execute_command`
+                profiler.request()
+            owner = await app.remote_owner(client_id)
+            if owner is not None:
+                body = next((value for name, value in kwargs.items() if name != 'client_id'), None)
+                try:
+                    result = await app.session_router.forward(owner, app.routing_key(client_id), client_id,
+                                                      {'command': command, **(payload(body) if body else {})})
+                    return JSONResponse(result)
+                except OwnerUnavailable:
+                    pass
+            result = endpoint(*args, **kwargs)
+            return await result if inspect.isawaitable(result) else result
+        return route
+    return decorator
+
+
 @app.exception_handler(Exception)
 def handle_annotation_error(request: Request, exc: Exception):
     return JSONResponse(
@@ -160,18 +524,84 @@ async def start_engine():
          tags=['Engine Configuration'],
          description="Stops the guidance engine temporarily. To activate or deactivate individual guidance strategies, \
           consider adding flags or other filter mechanisms to the context vector.")
-def stop_engine():
+async def stop_engine():
     app.stop()
 
 
+@app.get('/metrics',
+         tags=['Engine Configuration'],
+         response_class=PlainTextResponse,
+         description="Exposes metrics of the guidance engine in the Prometheus text format: durations of evaluation \
+          passes, latencies of the callbacks of each strategy and action, suggestions made and retracted, and \
+          websocket queue depths and send latencies.")
+def get_metrics():
+    return registry.expose()
+
+
+class ProfilerStart(BaseModel):
+    mode: ProfilerMode = Field('deterministic', description="`deterministic` records every function call of the \
+     callbacks, `sampling` records the stacks of running callbacks every `interval` seconds and slows them down less.")
+    ticks: Optional[int] = Field(None, description="Stop profiling after this many evaluation passes.")
+    requests: Optional[int] = Field(None, description="Stop profiling after this many state updates, interactions or \
+     websocket commands.")
+    interval: float = Field(0.005, description="Seconds between two samples in `sampling` mode.")
+
+
+@app.post('/profiler/start',
+          tags=['Profiling'],
+          description="Starts profiling the yaml callbacks of this worker, until `/profiler/stop` is called or for the \
+           given number of `ticks` or `requests`. Previous results are discarded.")
+def start_profiler(options: ProfilerStart):
+    profiler.start(options.mode, options.ticks, options.requests, options.interval)
+    return profiler.status()
+
+
+@app.post('/profiler/stop',
+          tags=['Profiling'],
+          description="Stops profiling. The results remain available until profiling starts again.")
+def stop_profiler():
+    profiler.stop()
+    return profiler.status()
+
+
+@app.get('/profiler',
+         tags=['Profiling'],
+         description="Whether the profiler is running, and the number of calls and total seconds of each callback by \
+          strategy, action and callback name, with the yaml file and line it was declared in. Slowest first.")
+def get_profiler_status():
+    return profiler.status()
+
+
+@app.get('/profiler/pstats',
+         tags=['Profiling'],
+         response_class=Response,
+         description="Downloads the profile recorded in `deterministic` mode in the pstats format, e.g. for \
+          `python -m pstats`, snakeviz or gprof2dot. Every callback is entered through a function named \
+          `strategy/action/callback`; functions of the callbacks refer to their yaml file and line.")
+def get_profiler_pstats():
+    return Response(profiler.pstats(), media_type='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename="lotse.pstats"'})
+
+
+@app.get('/profiler/collapsed',
+         tags=['Profiling'],
+         response_class=PlainTextResponse,
+         description="Downloads the profile as collapsed stacks for flamegraphs, e.g. for flamegraph.pl or speedscope. \
+          Stacks start with the strategy, action and callback name. Counts are samples in `sampling` mode and \
+          microseconds in `deterministic` mode.")
+def get_profiler_collapsed():
+    return profiler.collapsed()
+
+
 @app.get("/suggestions",
          tags=['Guidance Interactions'],
          description="Retrieve all suggestions currently made by the engine. Typically, new suggestions will be \
           transmitted via the websocket. However, (re-)fetching them via REST might become necessary, e.g., after \
            refreshing the page."
          )
-def get_guidance_suggestions() -> List[SuggestionModel]:
-    return app.lotse_engine.suggestions
+@routed('get_suggestions')
+def get_guidance_suggestions(client_id: Optional[str] = None) -> List[SuggestionModel]:
+    return list(app.get_engine(client_id).suggestions)
 
 
 @app.websocket("/channels/{client_id}")
@@ -180,18 +610,36 @@ async def chatroom_ws(client_id: str,
                       manager: ConnectionManager = Depends(socket_manager.get_connection_manager)):
     if client_id is None:
         raise ValueError("Please specify a Client ID")
-    await manager.connect(websocket)
+    params = websocket.query_params
+    try:
+        await manager.connect(websocket, client_id, params.get('encoding', 'json'), params.get('compression', 'none'),
+                              params.get('deltas', 'false').lower() in ('1', 'true', 'yes'))
+    except ValueError as e:
+        logging.warning("Rejecting client %s: %s", client_id, e)
+        await websocket.close(code=1008)
+        return
+    # sessions owned by other workers are evaluated there, their suggestions reach this worker through the broker
+    owned = app.sessions is not None and await app.remote_owner(client_id) is None
+    if owned:
+        app.sessions.connect(client_id)
+        app.schedule(client_id)
     try:
         while True:
-            data = await websocket.receive_json(mode="text")
             try:
-                # we don't really do anything with messages we get from the websocket!
-                pass
+                command = await manager.receive(websocket)
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
-                logger.error("got error while processing message", exc_info=True)
+                await manager.reply(websocket, CommandAck(ok=False, error=f"Could not decode message: {e}"))
+                continue
+            await handle_command(client_id, websocket, command, manager)
     except WebSocketDisconnect:
-        print("got disconnect exception")
+        logging.debug("Client %s disconnected", client_id)
         await manager.disconnect(websocket)
+        if owned:
+            app.sessions.disconnect(client_id)
+        if not any(client.client_id == client_id for client in manager.clients.values()):
+            app.release_previews(client_id)
 
 
 class StateUpdate(BaseModel):
@@ -210,14 +658,12 @@ class StateVectorUpdate(StateUpdate):
           description="Updates the state vector by applying all key-value pairs specified in the `updates` field. \
                       If you need more complex updates than setting values directly, use `update_with_callback`"
           )
-async def update_state(update: StateVectorUpdate):
-    app.lotse_engine.last_delta = update.updates
-    for key, value in update.updates.items():
-        app.update_state(key, value)
-    if update.re_evaluate_strategies is True:
-        app.evaluate_strategies()
-    if update.re_evaluate_actions is True:
-        await app.evaluate_actions()
+@routed('update_state')
+async def update_state(update: StateVectorUpdate, client_id: Optional[str] = None):
+    engine = app.state_engine(client_id)
+    async with engine.lock:
+        engine.update_state(update.updates)
+    await app.request_evaluation(client_id, update.re_evaluate_strategies is True, update.re_evaluate_actions is True)
 
 
 class StateVectorUpdateWithCallback(StateUpdate):
@@ -231,13 +677,109 @@ class StateVectorUpdateWithCallback(StateUpdate):
                       callback on the context vector. The name of the callback specified here must have been declared \
                       in the state vector yaml file."
           )
-async def update_with_callback(update: StateVectorUpdateWithCallback):
-    callback = getattr(app.lotse_engine.current_state, update.callback)
-    app.lotse_engine.last_delta = callback(**update.params)
-    if update.re_evaluate_strategies is True:
-        app.evaluate_strategies()
-    if update.re_evaluate_actions is True:
-        await app.evaluate_actions()
+@routed('update_with_callback')
+async def update_with_callback(update: StateVectorUpdateWithCallback, client_id: Optional[str] = None):
+    engine = app.state_engine(client_id)
+    async with engine.lock:
+        await engine.update_state_with_callback(update.callback, update.params)
+    await app.request_evaluation(client_id, update.re_evaluate_strategies is True, update.re_evaluate_actions is True)
+
+
+class StateOperation(BaseModel):
+    updates: Optional[Dict[str, Any]] = Field(None, description="Key-value pairs to update in the state vector.")
+    callback: Optional[str] = Field(None, description="The name of a callback to execute as specified in the state \
+     vector yaml file. Executed after applying `updates`, if both are given.")
+    params: Optional[Dict[str, Any]] = Field(None, description="Key-value pairs to be passed to the callback as named \
+     arguments.")
+
+
+class StateVectorBatchUpdate(StateUpdate):
+    operations: List[StateOperation] = Field(description="The updates and callbacks to apply, in order.")
+
+
+@app.post('/state/update_batch',
+          tags=['State Vector Manipulation'],
+          description="Applies a list of updates and callbacks to the state vector in order, merging their deltas. \
+                      Strategies and actions are evaluated at most once, after all operations have been applied. \
+                      Use this endpoint to send bursts of interactions, e.g. while brushing or dragging a slider."
+          )
+@routed('update_batch')
+async def update_batch(update: StateVectorBatchUpdate, client_id: Optional[str] = None):
+    engine = app.state_engine(client_id)
+    async with engine.lock:
+        for operation in update.operations:
+            if operation.updates:
+                engine.update_state(operation.updates)
+            if operation.callback:
+                await engine.update_state_with_callback(operation.callback, operation.params or {})
+    await app.request_evaluation(client_id, update.re_evaluate_strategies is True, update.re_evaluate_actions is True)
+
+
+class StateAppend(StateUpdate):
+    attribute: str = Field(description="The name of the data source in the state vector to append to, declared as \
+     `type: columnar` or holding a list of records")
+    rows: List[Dict[str, Any]] = Field(description="The rows to append, as records")
+
+
+class AppendResult(BaseModel):
+    start: Optional[int] = Field(None, description="The position of the first appended row, None if no rows were \
+     streamed")
+    count: int = Field(description="The number of appended rows")
+
+
+@app.post('/state/append',
+          tags=['State Vector Manipulation'],
+          response_model=AppendResult,
+          description="Appends rows to a data source of the state vector instead of replacing it, updating its indexes \
+                      and aggregates incrementally. Actions find the appended rows in the delta. Send large or \
+                      continuous data in chunks, or use `/state/stream/{attribute}`."
+          )
+@routed('append_rows')
+async def append_rows(update: StateAppend, client_id: Optional[str] = None):
+    engine = app.state_engine(client_id)
+    async with engine.lock:
+        start = engine.append_rows(update.attribute, update.rows)
+    await app.request_evaluation(client_id, update.re_evaluate_strategies is True, update.re_evaluate_actions is True)
+    return AppendResult(start=start, count=len(update.rows))
+
+
+@app.post('/state/stream/{attribute}',
+          tags=['State Vector Manipulation'],
+          response_model=AppendResult,
+          description="Appends rows streamed as newline-delimited json (one record per line) to a data source of the \
+                      state vector. Rows are appended in chunks of `chunk_size` rows as they arrive, each chunk like a \
+                      request to `/state/append`."
+          )
+async def stream_rows(attribute: str, request: Request, client_id: Optional[str] = None, chunk_size: int = 1000,
+                      re_evaluate_actions: bool = True, re_evaluate_strategies: bool = False):
+    chunk: List[Dict[str, Any]] = []
+    result: Optional[AppendResult] = None
+
+    async def flush():
+        nonlocal chunk, result
+        if not chunk:
+            return
+        update = StateAppend(attribute=attribute, rows=chunk, re_evaluate_actions=re_evaluate_actions,
+                             re_evaluate_strategies=re_evaluate_strategies)
+        appended = await append_rows(update=update, client_id=client_id)
+        if isinstance(appended, Response):
+            # appended by the worker owning the engine
+            appended = AppendResult.parse_raw(appended.body)
+        result = appended if result is None else AppendResult(start=result.start, count=result.count + appended.count)
+        chunk = []
+
+    pending = b''
+    async for data in request.stream():
+        *lines, pending = (pending + data).split(b'\n')
+        for line in lines:
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) >= max(chunk_size, 1):
+                await flush()
+    if pending.strip():
+        chunk.append(json.loads(pending))
+    await flush()
+    return result or AppendResult(count=0)
 
 
 @app.post('/reject',
@@ -246,12 +788,9 @@ async def update_with_callback(update: StateVectorUpdateWithCallback):
           description="Finds the suggestion instance in the engine by matching the IDs and rejects the found instance, \
                       calling its reject method as defined in the yaml file. Finally, the suggestion is removed from \
                       the engine's list of current suggestions.")
-def reject_suggestion(rejected_suggestion: SuggestionModel):
-    engine_suggestion: SuggestionModel = next(
-        sugg for sugg in app.lotse_engine.suggestions if sugg.suggestion.id == rejected_suggestion.suggestion.id)
-    engine_suggestion.action.reject(engine_suggestion, app.lotse_engine.current_state, app.lotse_engine.last_delta)
-    app.lotse_engine.suggestions = list(
-        filter(lambda s: s.suggestion.id != engine_suggestion.suggestion.id, app.lotse_engine.suggestions))
+@routed('reject', lambda suggestion: {'suggestion_id': suggestion.suggestion.id})
+async def reject_suggestion(rejected_suggestion: SuggestionModel, client_id: Optional[str] = None):
+    await app.interact(client_id, 'reject', rejected_suggestion.suggestion.id)
 
 
 @app.post('/accept',
@@ -260,12 +799,9 @@ def reject_suggestion(rejected_suggestion: SuggestionModel):
           description="Finds the suggestion instance in the engine by matching the IDs and rejects the found instance, \
                       calling its reject method as defined in the yaml file. Finally, the suggestion is removed from \
                       the engine's list of current suggestions.")
-def accept_suggestion(accepted_suggestion: SuggestionModel):
-    engine_suggestion: SuggestionModel = next(
-        sugg for sugg in app.lotse_engine.suggestions if sugg.suggestion.id == accepted_suggestion.suggestion.id)
-    engine_suggestion.action.accept(engine_suggestion, app.lotse_engine.current_state, app.lotse_engine.last_delta)
-    app.lotse_engine.suggestions = list(
-        filter(lambda s: s.suggestion.id != engine_suggestion.suggestion.id, app.lotse_engine.suggestions))
+@routed('accept', lambda suggestion: {'suggestion_id': suggestion.suggestion.id})
+async def accept_suggestion(accepted_suggestion: SuggestionModel, client_id: Optional[str] = None):
+    await app.interact(client_id, 'accept', accepted_suggestion.suggestion.id)
 
 
 @app.post('/preview_start',
@@ -273,10 +809,9 @@ def accept_suggestion(accepted_suggestion: SuggestionModel):
           response_model=None,
           description="Finds the suggestion instance in the engine by matching the IDs and calls `preview_start` on \
           the found instance, if it is defined in the action's yaml file.")
-def preview_suggestion(previewed: SuggestionModel):
-    engine_suggestion = next(
-        sugg for sugg in app.lotse_engine.suggestions if sugg.suggestion.id == previewed.suggestion.id)
-    engine_suggestion.action.preview_start(engine_suggestion, app.lotse_engine.current_state, app.lotse_engine.last_delta)
+@routed('preview_start', lambda suggestion: {'suggestion_id': suggestion.suggestion.id})
+async def preview_suggestion(previewed: SuggestionModel, client_id: Optional[str] = None):
+    await app.interact(client_id, 'preview_start', previewed.suggestion.id)
 
 
 @app.post('/preview_end',
@@ -284,7 +819,102 @@ def preview_suggestion(previewed: SuggestionModel):
           response_model=None,
           description="Finds the suggestion instance in the engine by matching the IDs and calls `preview_start` on \
           the found instance, if it is defined in the action's yaml file.")
-def end_preview_for_suggestion(suggestion: SuggestionModel):
-    engine_suggestion = next(
-        sugg for sugg in app.lotse_engine.suggestions if sugg.suggestion.id == suggestion.suggestion.id)
-    engine_suggestion.action.preview_end(engine_suggestion, app.lotse_engine.current_state, app.lotse_engine.last_delta)
+@routed('preview_end', lambda suggestion: {'suggestion_id': suggestion.suggestion.id})
+async def end_preview_for_suggestion(suggestion: SuggestionModel, client_id: Optional[str] = None):
+    await app.interact(client_id, 'preview_end', suggestion.suggestion.id)
+
+
+class NoArguments(BaseModel):
+    pass
+
+
+class SuggestionInteraction(BaseModel):
+    suggestion_id: str = Field(description="The id of the suggestion")
+
+
+class CommandAck(BaseModel):
+    """
+    The reply to a command received via websocket.
+    """
+    type: str = Field('ack', description="Always `ack`, to tell replies from suggestions")
+    id: Optional[Any] = Field(None, description="The id of the command")
+    ok: bool = Field(description="Whether the command succeeded")
+    error: Optional[str] = Field(None, description="What went wrong, if the command failed")
+    result: Any = Field(None, description="The result of the command, e.g. the suggestions for `get_suggestions`")
+
+
+async def _get_suggestions(_, client_id: Optional[str]):
+    return await get_guidance_suggestions(client_id=client_id)
+
+
+def _interaction(interaction: str):
+    async def interact(command: SuggestionInteraction, client_id: Optional[str]):
+        await app.interact(client_id, interaction, command.suggestion_id)
+    return interact
+
+
+# websocket commands: name -> (payload model, handler). The handlers are the ones of the corresponding REST endpoints.
+COMMANDS = {
+    'update_state': (StateVectorUpdate, update_state),
+    'update_with_callback': (StateVectorUpdateWithCallback, update_with_callback),
+    'update_batch': (StateVectorBatchUpdate, update_batch),
+    'append_rows': (StateAppend, append_rows),
+    'accept': (SuggestionInteraction, _interaction('accept')),
+    'reject': (SuggestionInteraction, _interaction('reject')),
+    'preview_start': (SuggestionInteraction, _interaction('preview_start')),
+    'preview_end': (SuggestionInteraction, _interaction('preview_end')),
+    'get_suggestions': (NoArguments, _get_suggestions),
+}
+
+
+async def execute_command(client_id: Optional[str], command: Any) -> CommandAck:
+    """
+    Executes a command on the engine of the client, forwarding it to the worker owning that engine if necessary.
+    """
+    command_id = command.get('id') if isinstance(command, dict) else None
+    if not _local_only.get():
+        profiler.request()
+    try:
+        if not isinstance(command, dict) or command.get('command') not in COMMANDS:
+            raise ValueError(f"Unknown command, use one of {', '.join(COMMANDS)}")
+        owner = await app.remote_owner(client_id)
+        if owner is not None:
+            try:
+                result = await app.session_router.forward(owner, app.routing_key(client_id), client_id, command)
+                return CommandAck(id=command_id, ok=True, result=result)
+            except OwnerUnavailable:
+                pass
+        model, handler = COMMANDS[command['command']]
+        payload = {key: value for key, value in command.items() if key not in ('id', 'command')}
+        token = _local_only.set(True)
+        try:
+            result = await handler(model(**payload), client_id)
+        finally:
+            _local_only.reset(token)
+    except Exception as e:
+        logging.debug("Command %s of client %s failed", command_id, client_id, exc_info=True)
+        error = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+        return CommandAck(id=command_id, ok=False, error=error)
+    return CommandAck(id=command_id, ok=True, result=result)
+
+
+async def _execute_forwarded(client_id: Optional[str], command: dict) -> dict:
+    token = _local_only.set(True)
+    try:
+        return json.loads((await execute_command(client_id, command)).json())
+    finally:
+        _local_only.reset(token)
+
+
+async def handle_command(client_id: str, websocket: WebSocket, command: Any, manager: ConnectionManager):
+    """
+    Executes a command received via websocket, e.g. ::
+
+        {"id": 42, "command": "update_state", "updates": {"hovered": 7}, "re_evaluate_actions": false}
+
+    Commands are executed in the order they are received. Commands with an `id` are acknowledged with a `CommandAck`
+    carrying that id once they completed, commands without an id only if they failed.
+    """
+    ack = await execute_command(client_id, command)
+    if ack.id is not None or not ack.ok:
+        await manager.reply(websocket, ack)
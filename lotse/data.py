@@ -0,0 +1,632 @@
+import csv
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+IndexKind = Literal['hash', 'sorted']
+Aggregation = Literal['count', 'sum', 'mean', 'min', 'max']
+
+
+def _missing(values: np.ndarray) -> Optional[np.ndarray]:
+    """
+    :return: A mask of the rows holding None, or None if the column cannot hold None
+    """
+    if values.dtype != object:
+        return None
+    return np.array([value is None for value in values], dtype=bool)
+
+
+def _codes(keys: np.ndarray) -> Tuple[List[Any], np.ndarray]:
+    """
+    :return: The distinct keys and the number of the distinct key of each row. Python objects are grouped by hashing,
+    as they may not be comparable with each other, e.g. None and strings.
+    """
+    if keys.dtype != object:
+        groups, inverse = np.unique(keys, return_inverse=True)
+        return groups.tolist(), inverse
+    codes: Dict[Any, int] = {}
+    inverse = np.array([codes.setdefault(key, len(codes)) for key in keys.tolist()], dtype=np.intp)
+    return list(codes), inverse
+
+
+class HashIndex:
+    """
+    Maps each distinct value of a column to the positions of the rows holding it. Rows holding None are kept under
+    None, like any other value.
+
+    The positions of a value grow into preallocated space like the columns of a `ColumnStore`, so that appending rows
+    only copies the positions of the values they hold a constant number of times on average.
+    """
+
+    def __init__(self, values: np.ndarray):
+        self.positions: Dict[Any, np.ndarray] = {}
+        # the preallocated arrays the positions of values are views of, once rows holding them were appended
+        self.buffers: Dict[Any, np.ndarray] = {}
+        self.extend(values, 0)
+
+    def equal(self, value) -> np.ndarray:
+        return self.positions.get(value, np.empty(0, dtype=np.intp))
+
+    def prepare(self, values: np.ndarray, offset: int) -> Dict[Any, np.ndarray]:
+        """
+        Groups rows appended at `offset` without changing the index, see `apply`.
+
+        :return: The positions of the appended rows holding each value
+        """
+        if not len(values):
+            return {}
+        keys, inverse = _codes(values)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+        return {key: order[starts[i]:starts[i + 1]] + offset for i, key in enumerate(keys)}
+
+    def apply(self, groups: Dict[Any, np.ndarray]):
+        for key, positions in groups.items():
+            existing = self.positions.get(key)
+            if existing is None:
+                self.positions[key] = positions
+                continue
+            start, end = len(existing), len(existing) + len(positions)
+            buffer = self.buffers.get(key)
+            if buffer is None or existing.base is not buffer or len(buffer) < end:
+                buffer = self.buffers[key] = np.empty(end + end // 2, dtype=np.intp)
+                buffer[:start] = existing
+            buffer[start:end] = positions
+            self.positions[key] = buffer[:end]
+
+    def extend(self, values: np.ndarray, offset: int):
+        """
+        Adds rows appended at `offset`, only touching the positions of the values they hold.
+        """
+        self.apply(self.prepare(values, offset))
+
+
+# the values of a column in order, and the positions of the rows holding them
+Run = Tuple[np.ndarray, np.ndarray]
+
+
+class SortedIndex:
+    """
+    Keeps the positions of the rows ordered by the values of a column for equality and range lookups. Rows holding None
+    are not ordered, they are only found by looking up None.
+
+    Appended rows are ordered as a run of their own, which is merged with the run before it once that is at most twice
+    as long. Appending n rows in chunks thus merges each row O(log n) times instead of copying the whole index for every
+    chunk, and lookups search O(log n) runs.
+    """
+
+    def __init__(self, values: np.ndarray):
+        # longest first
+        self.runs: List[Run] = []
+        self.missing = np.empty(0, dtype=np.intp)
+        self.extend(values, 0)
+
+    def equal(self, value) -> np.ndarray:
+        if value is None:
+            return self.missing
+        return self.between(value, value)
+
+    def between(self, low=None, high=None) -> np.ndarray:
+        found = []
+        for values, order in self.runs:
+            start = 0 if low is None else np.searchsorted(values, low, side='left')
+            end = len(values) if high is None else np.searchsorted(values, high, side='right')
+            found.append(order[start:end])
+        return np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+    def prepare(self, values: np.ndarray, offset: int) -> Tuple[List[Run], np.ndarray]:
+        """
+        Orders rows appended at `offset` and merges them into the runs without changing the index, see `apply`. Raises
+        if the values cannot be compared with each other or with the indexed values.
+
+        :return: The runs including the appended rows, and the positions of the rows holding None
+        """
+        positions = np.arange(offset, offset + len(values))
+        missing = _missing(values)
+        if missing is not None and missing.any():
+            values, positions, missing = values[~missing], positions[~missing], positions[missing]
+        else:
+            missing = np.empty(0, dtype=np.intp)
+        runs = list(self.runs)
+        if len(values):
+            order = np.argsort(values, kind='stable')
+            ordered = values[order]
+            for indexed, _ in runs:
+                # compare the rows with the indexed values now rather than when their run is merged
+                np.searchsorted(indexed, ordered[[0, -1]])
+            runs.append((ordered, positions[order]))
+            while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+                (values, order), (appended, positions) = runs[-2:]
+                # after existing rows holding the same value
+                at = np.searchsorted(values, appended, side='right')
+                values = values.astype(np.result_type(values, appended), copy=False)
+                runs[-2:] = [(np.insert(values, at, appended), np.insert(order, at, positions))]
+        return runs, missing
+
+    def apply(self, prepared: Tuple[List[Run], np.ndarray]):
+        runs, missing = prepared
+        self.runs = runs
+        if len(missing):
+            self.missing = np.concatenate((self.missing, missing))
+
+    def extend(self, values: np.ndarray, offset: int):
+        self.apply(self.prepare(values, offset))
+
+
+class RunningAggregate:
+    """
+    The `count`, `sum`, `mean`, `min` or `max` of a column, optionally per value of another column, that is updated with
+    the rows appended to a `ColumnStore` instead of being computed from all rows when it is read.
+
+    Rows holding None in the aggregated column are skipped. Rows holding None in the column they are grouped by are
+    aggregated in the group None.
+    """
+
+    def __init__(self, func: Aggregation = 'count', column: str = None, by: str = None):
+        """
+        :param column: The column to aggregate, not required for `count`
+        :param by: The column to group the rows by, None to aggregate all rows
+        """
+        if func not in ('count', 'sum', 'mean', 'min', 'max'):
+            raise ValueError(f"Unknown aggregation {func}")
+        if func != 'count' and column is None:
+            raise ValueError(f"Aggregation {func} requires a column")
+        self.func, self.column, self.by = func, column, by
+        self.reset()
+
+    def reset(self):
+        # group (None if not grouped) -> number of aggregated rows, and sum or minimum or maximum of the column
+        self.counts: Dict[Any, int] = {}
+        self.totals: Dict[Any, Any] = {}
+        self.values: Dict[Any, Any] = {}
+
+    @property
+    def value(self) -> Any:
+        """
+        :return: The aggregated value, or a dict of the value per group. None for `mean`, `min` and `max` of no rows.
+        """
+        if self.by is not None:
+            return self.values
+        return self.values.get(None, 0 if self.func in ('count', 'sum') else None)
+
+    def prepare(self, rows: int, keys: Optional[np.ndarray], values: Optional[np.ndarray]) -> Dict[Any, Tuple[int, Any]]:
+        """
+        Aggregates appended rows without changing the aggregate, see `apply`. Raises if the values cannot be
+        aggregated.
+
+        :param rows: The number of appended rows
+        :param keys: Their values of `by`, None if not grouped
+        :param values: Their values of `column`, None for `count`
+        :return: The new count and total of each group the rows belong to
+        """
+        missing = _missing(values) if values is not None else None
+        if missing is not None:
+            values = values[~missing]
+            keys = keys[~missing] if keys is not None else None
+            rows = len(values)
+        if rows <= 0:
+            return {}
+        if keys is None:
+            groups, inverse = [None], np.zeros(rows, dtype=np.intp)
+        else:
+            groups, inverse = _codes(keys)
+        counts = np.bincount(inverse, minlength=len(groups)).tolist()
+        totals = None
+        if values is not None:
+            order = np.argsort(inverse, kind='stable')
+            starts = np.searchsorted(inverse[order], np.arange(len(groups)))
+            reduce = {'sum': np.add, 'mean': np.add, 'min': np.minimum, 'max': np.maximum}[self.func]
+            totals = reduce.reduceat(values[order], starts).tolist()
+        updated = {}
+        for i, group in enumerate(groups):
+            count = self.counts.get(group, 0) + counts[i]
+            total = None if totals is None else totals[i]
+            if total is not None and group in self.totals:
+                previous = self.totals[group]
+                total = previous + total if self.func in ('sum', 'mean') else (min if self.func == 'min' else max)(
+                    previous, total)
+            updated[group] = count, total
+        return updated
+
+    def apply(self, updated: Dict[Any, Tuple[int, Any]]):
+        for group, (count, total) in updated.items():
+            self.counts[group] = count
+            if self.func == 'count':
+                self.values[group] = count
+                continue
+            self.totals[group] = total
+            self.values[group] = total / count if self.func == 'mean' else total
+
+    def add(self, store: 'ColumnStore', start: int = 0):
+        """
+        Adds the rows of the store from position `start` on.
+        """
+        keys = store.columns[self.by][start:] if self.by is not None else None
+        values = store.columns[self.column][start:] if self.func != 'count' else None
+        self.apply(self.prepare(len(store) - start, keys, values))
+
+
+class AppendedRows:
+    """
+    The rows appended to a `ColumnStore` or list of records in the context vector, reported in the delta.
+    """
+
+    def __init__(self, start: int, rows: Union['ColumnStore', List[Dict[str, Any]]]):
+        """
+        :param start: The position of the first appended row
+        :param rows: The appended rows, as store or list like the data they were appended to
+        """
+        self.start = start
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __repr__(self):
+        return f"AppendedRows(start={self.start}, count={len(self)})"
+
+
+def _column(values: List[Any]) -> np.ndarray:
+    """
+    Converts a list of values to an array, inferring numeric types for columns read from text files.
+    """
+    if values and all(isinstance(value, str) for value in values):
+        for dtype in (np.int64, np.float64):
+            try:
+                return np.array(values, dtype=dtype)
+            except ValueError:
+                continue
+    try:
+        return np.array(values)
+    except ValueError:
+        # ragged values such as lists of different lengths
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+
+def _dtype(existing: np.dtype, appended: np.dtype) -> np.dtype:
+    """
+    :return: The dtype of a column after values were appended, falling back to objects rather than converting numbers
+    to strings
+    """
+    if existing == appended:
+        return existing
+    numeric = 'biuf'
+    if existing.kind in numeric and appended.kind in numeric or existing.kind == appended.kind == 'U':
+        return np.result_type(existing, appended)
+    return np.dtype(object)
+
+
+class ColumnStore:
+    """
+    A table stored as one NumPy array per column. Use it for large datasets in the context vector instead of a list of
+    dicts, so that callbacks can look up rows through indexes and filter or aggregate without iterating over all rows
+    in python. Declare it in the state vector yaml as `type: columnar`.
+
+    Queries return row positions or new stores holding copies of the selected rows. Stores returned by queries have no
+    indexes and no aggregates.
+
+    Rows can be appended in chunks. Indexes and running aggregates are updated with the appended rows only, and columns
+    grow into preallocated space, so appending a chunk does not copy the whole store. Sorted indexes merge appended
+    chunks in batches, see `SortedIndex`.
+    """
+
+    def __init__(self, columns: Dict[str, Union[np.ndarray, List[Any]]], indexes: Dict[str, IndexKind] = None,
+                 aggregates: Dict[str, Union[dict, RunningAggregate]] = None):
+        """
+        :param columns: The values of each column, all of the same length
+        :param indexes: The columns to index and the kind of index for each. `hash` indexes support equality lookups,
+        `sorted` indexes also support ranges.
+        :param aggregates: Running aggregates to maintain, by name, declared as the arguments of `RunningAggregate`,
+        e.g. `{'func': 'max', 'column': 'humidity', 'by': 'station'}`. Aggregates passed as `RunningAggregate` are
+        taken as they are.
+        """
+        self.columns: Dict[str, np.ndarray] = {name: values if isinstance(values, np.ndarray) else _column(values)
+                                               for name, values in columns.items()}
+        if len({len(values) for values in self.columns.values()}) > 1:
+            raise ValueError("All columns must have the same length")
+        # the preallocated arrays the columns are views of, once rows were appended
+        self.buffers: Dict[str, np.ndarray] = {}
+        self.index_kinds: Dict[str, IndexKind] = {}
+        self.indexes: Dict[str, Union[HashIndex, SortedIndex]] = {}
+        for column, kind in (indexes or {}).items():
+            self.create_index(column, kind)
+        self.running: Dict[str, RunningAggregate] = {}
+        for name, aggregate in (aggregates or {}).items():
+            if isinstance(aggregate, RunningAggregate):
+                self.running[name] = aggregate
+            else:
+                self.declare_aggregate(name, **aggregate)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], indexes: Dict[str, IndexKind] = None,
+                     aggregates: Dict[str, dict] = None, columns: Sequence[str] = ()) -> 'ColumnStore':
+        """
+        :param columns: Columns to create even if no record holds them, e.g. for a store that is filled by appending
+        """
+        records = list(records)
+        names = list(dict.fromkeys([*columns, *(name for record in records for name in record)]))
+        return cls({name: [record.get(name) for record in records] for name in names}, indexes, aggregates)
+
+    @classmethod
+    def from_csv(cls, file_path: str, indexes: Dict[str, IndexKind] = None, fieldnames: List[str] = None,
+                 encoding: str = 'utf-8', delimiter: str = ',', aggregates: Dict[str, dict] = None) -> 'ColumnStore':
+        with open(file_path, 'r', encoding=encoding, newline='') as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            if fieldnames is None:
+                fieldnames = next(reader)
+            rows = list(reader)
+        return cls({name: [row[i] for row in rows] for i, name in enumerate(fieldnames)}, indexes, aggregates)
+
+    @classmethod
+    def from_json(cls, file_path: str, indexes: Dict[str, IndexKind] = None, encoding: str = 'utf-8',
+                  aggregates: Dict[str, dict] = None) -> 'ColumnStore':
+        with open(file_path, 'r', encoding=encoding) as f:
+            return cls.from_records(json.load(f), indexes, aggregates)
+
+    def __getstate__(self):
+        # the columns hold all rows, the unused space of the buffers is not copied or pickled
+        state = dict(vars(self))
+        state['buffers'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # stores pickled by previous versions have no buffers and aggregates
+        self.buffers, self.running = {}, {}
+        self.__dict__.update(state)
+
+    def create_index(self, column: str, kind: IndexKind = 'hash'):
+        if kind not in ('hash', 'sorted'):
+            raise ValueError(f"Unknown index kind {kind}")
+        self.index_kinds[column] = kind
+        self.indexes[column] = self._index(kind, self.columns[column])
+
+    @staticmethod
+    def _index(kind: IndexKind, values: np.ndarray) -> Union[HashIndex, SortedIndex]:
+        return HashIndex(values) if kind == 'hash' else SortedIndex(values)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: The bytes of the columns, like `np.ndarray.nbytes` without the objects held by columns of dtype object
+        """
+        return sum(values.nbytes for values in self.columns.values())
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.columns
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterates over the rows as dicts, like a list of records. Prefer the query methods for large stores.
+        """
+        return iter(self.records())
+
+    def equal(self, column: str, value) -> np.ndarray:
+        """
+        :param value: A value, or a list, tuple or set of values of which the row must hold one
+        :return: The positions of the rows holding the value in the column, in ascending order
+        """
+        index = self.indexes.get(column)
+        if isinstance(value, (list, tuple, set)):
+            if index is not None:
+                positions = [index.equal(v) for v in value]
+                return np.unique(np.concatenate(positions)) if positions else np.empty(0, dtype=np.intp)
+            values = self.columns[column]
+            if values.dtype != object:
+                return np.flatnonzero(np.isin(values, list(value)))
+            # `isin` would convert mixed values to strings, or fail to sort them
+            matches = np.zeros(len(values), dtype=bool)
+            for v in value:
+                matches |= np.equal(values, v)
+            return np.flatnonzero(matches)
+        if index is not None:
+            return np.sort(index.equal(value))
+        return np.flatnonzero(self.columns[column] == value)
+
+    def between(self, column: str, low=None, high=None) -> np.ndarray:
+        """
+        :return: The positions of the rows whose value in the column lies within [low, high], in ascending order.
+        Either bound may be None.
+        """
+        index = self.indexes.get(column)
+        if isinstance(index, SortedIndex):
+            return index.between(low, high)
+        values = self.columns[column]
+        # rows holding None lie in no range, as in sorted indexes
+        positions = np.flatnonzero(np.not_equal(values, None)) if values.dtype == object else np.arange(len(values))
+        values = values[positions]
+        mask = np.ones(len(values), dtype=bool)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return positions[mask]
+
+    def rows(self, **conditions) -> np.ndarray:
+        """
+        :param conditions: Column names and the values the rows must hold, see `equal`
+        :return: The positions of the rows matching all conditions, in ascending order
+        """
+        positions = None
+        for column, value in conditions.items():
+            matches = self.equal(column, value)
+            positions = matches if positions is None else np.intersect1d(positions, matches, assume_unique=True)
+        return np.arange(len(self)) if positions is None else positions
+
+    def select(self, positions: np.ndarray = None, **conditions) -> 'ColumnStore':
+        """
+        Returns the rows at the given positions (or matching a boolean mask) that also match all conditions.
+        """
+        if positions is not None and np.asarray(positions).dtype == bool:
+            positions = np.flatnonzero(positions)
+        if conditions:
+            matches = self.rows(**conditions)
+            positions = matches if positions is None else np.intersect1d(positions, matches)
+        if positions is None:
+            positions = np.arange(len(self))
+        return ColumnStore({name: values[positions] for name, values in self.columns.items()})
+
+    def first(self, **conditions) -> Optional[Dict[str, Any]]:
+        """
+        :return: The first row matching all conditions as dict, or None
+        """
+        positions = self.rows(**conditions)
+        return self.record(positions[0]) if len(positions) else None
+
+    def record(self, position: int) -> Dict[str, Any]:
+        return {name: values[position].tolist() if isinstance(values[position], np.generic) else values[position]
+                for name, values in self.columns.items()}
+
+    def records(self, positions: np.ndarray = None) -> List[Dict[str, Any]]:
+        """
+        :return: The rows at the given positions, or all rows, as dicts of python values
+        """
+        columns = {name: (values if positions is None else values[positions]).tolist()
+                   for name, values in self.columns.items()}
+        return [dict(zip(columns.keys(), row)) for row in zip(*columns.values())]
+
+    def aggregate(self, by: str, column: str = None, func: Aggregation = 'count',
+                  positions: np.ndarray = None) -> Dict[Any, Any]:
+        """
+        Groups the rows by the values of `by` and aggregates `column` within each group. Use `declare_aggregate` for
+        aggregates that are read often while rows are appended.
+
+        :param positions: Only aggregate the rows at these positions
+        :return: The aggregated value for each distinct value of `by`
+        """
+        keys = self.columns[by] if positions is None else self.columns[by][positions]
+        groups, inverse = _codes(keys)
+        if func == 'count':
+            return dict(zip(groups, np.bincount(inverse, minlength=len(groups)).tolist()))
+        values = self.columns[column] if positions is None else self.columns[column][positions]
+        if func in ('sum', 'mean'):
+            result = np.bincount(inverse, weights=values, minlength=len(groups))
+            if func == 'mean':
+                result = result / np.bincount(inverse, minlength=len(groups))
+        elif func in ('min', 'max'):
+            order = np.argsort(inverse, kind='stable')
+            starts = np.searchsorted(inverse[order], np.arange(len(groups)))
+            reduce = np.minimum if func == 'min' else np.maximum
+            result = reduce.reduceat(values[order], starts) if len(groups) else np.empty(0)
+        else:
+            raise ValueError(f"Unknown aggregation {func}")
+        return dict(zip(groups, result.tolist()))
+
+    def set(self, column: str, positions: np.ndarray, value):
+        """
+        Sets the value of a column in the rows at the given positions. Creates the column, filled with None, if it does
+        not exist yet. Indexes on the column are rebuilt.
+        """
+        if column not in self.columns:
+            self.columns[column] = np.full(len(self), None, dtype=object)
+        values = self.columns[column]
+        if values.dtype == object:
+            # assign element-wise, so that lists are stored as values rather than broadcast
+            for position in np.atleast_1d(positions):
+                values[position] = value
+        else:
+            values[positions] = value
+        if column in self.index_kinds:
+            self.create_index(column, self.index_kinds[column])
+        self._recompute(column)
+
+    def declare_aggregate(self, name: str, func: Aggregation = 'count', column: str = None, by: str = None):
+        """
+        Maintains an aggregate of the store from now on, see `RunningAggregate`. Its value is available as
+        `store.aggregates[name]`.
+        """
+        aggregate = RunningAggregate(func, column, by)
+        aggregate.add(self)
+        self.running[name] = aggregate
+
+    @property
+    def aggregates(self) -> Dict[str, Any]:
+        """
+        :return: The current value of each declared aggregate, without iterating over the rows
+        """
+        return {name: aggregate.value for name, aggregate in self.running.items()}
+
+    def append(self, rows: Union[Iterable[Dict[str, Any]], Dict[str, Union[np.ndarray, List[Any]]]]) -> int:
+        """
+        Appends rows, given as records or as the values of each column. Columns missing in the rows are filled with
+        None, as are new columns in the existing rows. Indexes and aggregates are updated with the appended rows. If
+        any row cannot be stored, indexed or aggregated, e.g. because it holds an unhashable value in a hash indexed
+        column, none of the rows is appended.
+
+        :return: The position of the first appended row
+        """
+        if isinstance(rows, dict):
+            appended = {name: values if isinstance(values, np.ndarray) else _column(list(values))
+                        for name, values in rows.items()}
+        else:
+            records = list(rows)
+            names = list(dict.fromkeys(name for record in records for name in record))
+            appended = {name: _column([record.get(name) for record in records]) for name in names}
+        if len({len(values) for values in appended.values()}) > 1:
+            raise ValueError("All columns must have the same length")
+        start = len(self)
+        count = len(next(iter(appended.values()))) if appended else 0
+        if not count:
+            return start
+        # build the columns, indexes and aggregates of all rows first and only then replace those of the store, so
+        # that rows which cannot be stored, indexed or aggregated leave it as it was
+        columns: Dict[str, np.ndarray] = {}
+        buffers: Dict[str, np.ndarray] = {}
+        for name in list(dict.fromkeys([*self.columns, *appended])):
+            values = appended.get(name)
+            if values is None:
+                values = np.full(count, None, dtype=object)
+            existing = self.columns.get(name)
+            if existing is None:
+                existing = np.full(start, None, dtype=object)
+            dtype = _dtype(existing.dtype, values.dtype) if len(existing) else values.dtype
+            columns[name], buffers[name] = self._grow(name, existing, values, dtype)
+        indexes, prepared = {}, {}
+        for column, index in self.indexes.items():
+            if columns[column].dtype != self.columns[column].dtype:
+                indexes[column] = self._index(self.index_kinds[column], columns[column])
+            else:
+                prepared[column] = index.prepare(columns[column][start:], start)
+        updated = {name: aggregate.prepare(
+            count, columns[aggregate.by][start:] if aggregate.by is not None else None,
+            columns[aggregate.column][start:] if aggregate.func != 'count' else None)
+            for name, aggregate in self.running.items()}
+        self.columns.update(columns)
+        self.buffers.update(buffers)
+        self.indexes.update(indexes)
+        for column, extension in prepared.items():
+            self.indexes[column].apply(extension)
+        for name, aggregate in self.running.items():
+            aggregate.apply(updated[name])
+        return start
+
+    def _grow(self, name: str, existing: np.ndarray, values: np.ndarray,
+              dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Writes the appended values to the unused space of the column's buffer, or to a new buffer if they do not fit.
+        The column itself is not replaced.
+
+        :return: The column holding the existing and the appended values as view of its buffer, and the buffer
+        """
+        start, end = len(existing), len(existing) + len(values)
+        buffer = self.buffers.get(name)
+        if buffer is None or existing.base is not buffer or buffer.dtype != dtype or len(buffer) < end:
+            # grow by half, so that appending n rows copies each row a constant number of times on average
+            buffer = np.empty(end + max(end // 2, 16), dtype=dtype)
+            buffer[:start] = existing
+        buffer[start:end] = values
+        return buffer[:end], buffer
+
+    def _recompute(self, column: str):
+        for aggregate in self.running.values():
+            if column in (aggregate.column, aggregate.by):
+                aggregate.reset()
+                aggregate.add(self)
@@ -24,7 +24,7 @@ setup(
     description="A framework for developing strategy-based guidance components for visual analytics components.",
     long_description=read("README.rst"),
 
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks', 'benchmarks.*')),
 
     install_requires=[
         'fastapi',
@@ -32,8 +32,13 @@ setup(
         'requests',
         'gsrickled==1.0.0',
         'starlette',
-        'pydantic'
+        'pydantic',
+        'numpy'
     ],
+    extras_require={
+        'msgpack': ['msgpack'],
+        'redis': ['redis']
+    },
 
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import pytest
+
+from benchmarks.generate import generate
+
+
+@pytest.fixture
+def setup_path(tmp_path):
+    """
+    A synthetic guidance setup with two strategies of one action each, see `benchmarks.generate`.
+
+    :return: The strategy path and the state path
+    """
+    generate(str(tmp_path), strategies=2, actions=1, attributes=3, rows=20)
+    return os.path.join(str(tmp_path), 'strategies'), os.path.join(str(tmp_path), 'state')
+
+
+@pytest.fixture
+def guidance_app():
+    """
+    The module-global guidance API, with a fresh scheduler and shut down after the test.
+    """
+    from lotse.app.guidance_engine.scheduler import Scheduler
+    from lotse.app.main import app
+    app.scheduler = Scheduler()
+    app._pending_evaluations.clear()
+    app._changes_due.clear()
+    yield app
+    app.shutdown()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Action:
+    """
+    Stands in for the action generating suggestions in tests of the suggestion store and the encodings.
+    """
+
+    def __init__(self, **metadata):
+        self.metadata = metadata
+
+
+def suggestion(suggestion_id: str, action=None, strategy: str = 'strategy', value=None, title: str = 'title'):
+    from lotse.suggestion import Suggestion, SuggestionContent, SuggestionModel
+    content = SuggestionContent(value=value if value is not None else suggestion_id, action_id='action')
+    return SuggestionModel(suggestion=Suggestion(title=title, description='description', id=suggestion_id,
+                                                 degree='orienting', event=content, strategy=strategy),
+                           action=action if action is not None else Action())
+
+
+def engine(setup_path, **options):
+    """
+    :return: An engine for the setup, configured with the given keyword arguments of `LotseEngine`
+    """
+    from lotse.app.guidance_engine.lotse_engine import LotseEngine
+    strategy_path, state_path = setup_path
+    return LotseEngine(strategy_path, state_path, 'meta.yaml', **options)
+
+
+async def suggest(engine, **updates):
+    """
+    Evaluates the strategies, applies the updates and evaluates the actions.
+
+    :return: The action ids of the engine's suggestions
+    """
+    await engine.evaluate_strategies()
+    engine.update_state(updates)
+    await engine.generate_suggestions()
+    return [s.action.metadata['action_id'] for s in engine.suggestions]
@@ -0,0 +1,49 @@
+import glob
+import os
+import time
+
+from lotse.app.guidance_engine.executor import CallbackExecutor
+from tests.conftest import engine, run, suggest
+
+ASYNC_CONDITION = """is_applicable:
+  args: [ctx, delta]
+  async: true
+  import: [asyncio]
+  load: |
+    await asyncio.sleep({seconds})
+    return ctx.value_{attribute} > self.threshold and ctx.enabled and not self.suggested
+"""
+
+
+def _make_async(setup_path, seconds):
+    """
+    Declares the `is_applicable` callbacks of all actions of the setup `async`, sleeping for the given seconds.
+    """
+    strategy_path, _ = setup_path
+    for file in glob.glob(os.path.join(strategy_path, 'actions', '*.yaml')):
+        with open(file) as f:
+            lines = f.read().split('\n')
+        attribute = next(line for line in lines if line.startswith('    return ctx.value_')).split('value_')[1][0]
+        start = lines.index('is_applicable:')
+        with open(file, 'w') as f:
+            f.write('\n'.join(lines[:start] + [ASYNC_CONDITION.format(seconds=seconds, attribute=attribute)] +
+                              lines[start + 4:]))
+
+
+def test_async_callbacks_are_awaited_concurrently(setup_path):
+    _make_async(setup_path, 0.3)
+    lotse = engine(setup_path)
+    started = time.time()
+    suggested = run(suggest(lotse, value_0=1000, value_1=1000))
+    assert sorted(suggested) == ['action_0_0', 'action_1_0']
+    # both callbacks sleep at the same time
+    assert time.time() - started < 0.55
+
+
+def test_async_callbacks_are_cancelled_after_their_timeout(setup_path):
+    _make_async(setup_path, 5)
+    lotse = engine(setup_path, executor=CallbackExecutor(timeouts={'is_applicable': 0.1}))
+    started = time.time()
+    assert run(suggest(lotse, value_0=1000, value_1=1000)) == []
+    assert time.time() - started < 1
+    assert len(lotse.executor.degraded) == 2
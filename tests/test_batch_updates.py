@@ -0,0 +1,60 @@
+from lotse.app.main import StateOperation, StateVectorBatchUpdate, update_batch
+from tests.conftest import engine, run
+
+
+def _record_passes(engine):
+    """
+    :return: The delta each action evaluation pass of the engine saw, and the number of strategy evaluation passes
+    """
+    deltas, strategy_passes = [], []
+    generate, evaluate = engine.generate_suggestions, engine.evaluate_strategies
+
+    async def generate_recorded():
+        deltas.append(engine.last_delta)
+        return await generate()
+
+    async def evaluate_recorded():
+        strategy_passes.append(engine.last_delta)
+        return await evaluate()
+
+    engine.generate_suggestions = generate_recorded
+    engine.evaluate_strategies = evaluate_recorded
+    return deltas, strategy_passes
+
+
+def test_deltas_are_merged_until_the_next_pass(setup_path):
+    lotse = engine(setup_path)
+
+    async def scenario():
+        lotse.update_state({'value_0': 1, 'value_1': 1})
+        lotse.update_state({'value_0': 2})
+        merged = lotse.last_delta
+        await lotse.generate_suggestions()
+        lotse.update_state({'value_2': 3})
+        return merged, lotse.last_delta
+
+    merged, after = run(scenario())
+    assert merged == {'value_0': 2, 'value_1': 1}
+    assert after == {'value_2': 3}
+
+
+def test_batches_are_evaluated_in_a_single_pass(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    deltas, strategy_passes = _record_passes(guidance_app.lotse_engine)
+    operations = [StateOperation(updates={'value_0': 1}), StateOperation(updates={'value_1': 2}),
+                  StateOperation(updates={'value_0': 100})]
+    run(update_batch(update=StateVectorBatchUpdate(operations=operations, re_evaluate_strategies=True)))
+    assert len(strategy_passes) == 1
+    assert deltas == [{'value_0': 100, 'value_1': 2}]
+    assert guidance_app.lotse_engine.current_state.value_0 == 100
+
+
+def test_updates_from_python_are_recorded_in_the_delta(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    lotse = guidance_app.lotse_engine
+    guidance_app.update_state('value_0', 100)
+    guidance_app.update_state('value_1', 1)
+    assert lotse.current_state.value_0 == 100
+    assert lotse.last_delta == {'value_0': 100, 'value_1': 1} and lotse.delta_pending
+    assert lotse.history.snapshot().value_0 == 100
+    assert guidance_app.scheduler.next_due() is not None
@@ -0,0 +1,54 @@
+import os
+
+from lotse.app.guidance_engine.budget import GuidanceBudget
+from tests.conftest import Action, engine, run, suggest
+
+
+def test_actions_are_queued_by_priority_then_position():
+    low, high, default = Action(priority=-1), Action(priority=5), Action()
+    budget = GuidanceBudget()
+    queue = budget.queue([low, default, high], {low: 0, default: 1, high: 2})
+    assert next(iter(queue)) is high
+    assert set(queue.remaining()) == {low, default}
+
+
+def test_suggestions_per_pass_and_rate_are_limited():
+    assert GuidanceBudget().begin() is None
+    assert GuidanceBudget(max_suggestions=3).begin() == 3
+    budget = GuidanceBudget(max_suggestions=3, rate=2, period=60)
+    assert budget.begin(now=budget.refilled) == 2
+    budget.spend(2)
+    assert budget.begin(now=budget.refilled) == 0
+    assert budget.next_available(now=budget.refilled) == budget.refilled + 30
+    assert budget.begin(now=budget.refilled + 30) == 1
+
+
+def test_costs_are_declared_or_measured():
+    declared, measured = Action(cost=0.5), Action()
+    budget = GuidanceBudget(max_seconds=0.1)
+    budget.begin()
+    assert budget.cost(declared) == 0.5 and not budget.affordable(declared)
+    assert budget.cost(measured) == 0 and budget.affordable(measured)
+    budget.observe(measured, 1.0)
+    budget.observe(measured, 0.0)
+    assert budget.cost(measured) == 0.7
+
+
+def test_budget_declared_by_the_meta_strategy():
+    meta = Action()
+    meta.budget = {'max_suggestions': 1}
+    assert GuidanceBudget.from_meta(meta).max_suggestions == 1
+    assert GuidanceBudget.from_meta(Action()) is None
+
+
+def test_actions_beyond_the_budget_are_deferred_to_the_next_pass(setup_path):
+    with open(os.path.join(setup_path[0], 'meta.yaml'), 'w') as f:
+        f.write('budget:\n  max_suggestions: 1\n')
+    budgeted = engine(setup_path)
+
+    async def scenario():
+        first = await suggest(budgeted, value_0=1000, value_1=1000)
+        await budgeted.generate_suggestions()
+        return len(first), len(budgeted.suggestions)
+
+    assert run(scenario()) == (1, 2)
@@ -0,0 +1,33 @@
+from starlette.testclient import TestClient
+
+from lotse.app.main import app, execute_command
+from tests.conftest import run
+
+
+def test_commands_are_acknowledged(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+
+    async def scenario():
+        update = await execute_command(None, {'id': 1, 'command': 'update_state', 'updates': {'value_0': 5},
+                                              're_evaluate_actions': False})
+        unknown = await execute_command(None, {'id': 2, 'command': 'unknown'})
+        missing = await execute_command(None, {'id': 3, 'command': 'accept', 'suggestion_id': 'missing'})
+        return update, unknown, missing
+
+    update, unknown, missing = run(scenario())
+    assert (update.id, update.ok) == (1, True)
+    assert guidance_app.lotse_engine.current_state.value_0 == 5
+    assert (unknown.id, unknown.ok) == (2, False) and 'Unknown command' in unknown.error
+    assert not missing.ok and missing.error == 'No suggestion with id missing'
+
+
+def test_websocket_commands_are_executed_in_order(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    with TestClient(app).websocket_connect('/channels/client') as websocket:
+        websocket.send_json({'command': 'update_state', 'updates': {'value_1': 1}, 're_evaluate_actions': False})
+        websocket.send_json({'id': 'second', 'command': 'update_state', 'updates': {'value_1': 2},
+                             're_evaluate_actions': False})
+        assert websocket.receive_json() == {'type': 'ack', 'id': 'second', 'ok': True, 'error': None, 'result': None}
+        websocket.send_text('not json')
+        assert websocket.receive_json()['ok'] is False
+    assert guidance_app.lotse_engine.current_state.value_1 == 2
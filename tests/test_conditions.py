@@ -0,0 +1,57 @@
+import pytest
+
+from lotse.app.guidance_engine.conditions import Condition, ConditionNetwork
+
+
+class Owner:
+    def __init__(self, threshold=10):
+        self.threshold = threshold
+
+
+class Context:
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def test_conditions_are_validated_when_declared():
+    with pytest.raises(ValueError):
+        Condition('__import__("os")', Owner())
+    with pytest.raises(ValueError):
+        Condition({'some': ['ctx.a']}, Owner())
+
+
+def test_nested_conditions():
+    network = ConditionNetwork()
+    condition = Condition({'any': [{'not': 'ctx.enabled'}, ['ctx.value > self.threshold', 'len(ctx.items) > 1']]},
+                          Owner())
+    results = []
+    for context in (Context(enabled=False, value=0, items=[]), Context(enabled=True, value=20, items=[1, 2]),
+                    Context(enabled=True, value=20, items=[1])):
+        network.begin_pass()
+        network.mark_changed(None)
+        results.append(network.evaluate(condition, context, None))
+    assert results == [True, True, False]
+
+
+def test_shared_expressions_are_evaluated_once_per_pass_and_kept_until_changed():
+    network = ConditionNetwork()
+    first, second = Condition(['ctx.enabled', 'ctx.value > 1'], Owner()), Condition('ctx.enabled', Owner())
+    context = Context(enabled=True, value=5)
+    network.begin_pass()
+    assert network.evaluate(first, context, None) and network.evaluate(second, context, None)
+    assert network.evaluations == 2
+    network.begin_pass()
+    context.enabled = False
+    # the attribute was not marked as changed, so the kept value is used
+    assert network.evaluate(second, context, None)
+    network.mark_changed(['enabled'])
+    assert not network.evaluate(second, context, None)
+    assert network.evaluations == 3
+
+
+def test_expressions_reading_the_owner_are_not_shared():
+    network = ConditionNetwork()
+    low, high = Condition('ctx.value > self.threshold', Owner(1)), Condition('ctx.value > self.threshold', Owner(10))
+    context = Context(value=5)
+    network.begin_pass()
+    assert network.evaluate(low, context, None) and not network.evaluate(high, context, None)
@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+
+from lotse.data import ColumnStore, RunningAggregate
+
+AGGREGATES = {'rows': {'func': 'count'},
+              'per_station': {'func': 'count', 'by': 'station'},
+              'max_humidity': {'func': 'max', 'column': 'humidity', 'by': 'station'},
+              'mean_humidity': {'func': 'mean', 'column': 'humidity'}}
+
+
+def _records(start, count):
+    return [{'station': f's{i % 3}', 'date': i, 'humidity': float(i % 7)} for i in range(start, start + count)]
+
+
+def _store(records):
+    return ColumnStore.from_records(records, indexes={'station': 'hash', 'date': 'sorted'}, aggregates=AGGREGATES)
+
+
+def _assert_consistent(store):
+    """
+    Asserts that the indexes and aggregates of the store match those of a store built from all of its rows at once.
+    """
+    rebuilt = _store(store.records())
+    assert store.aggregates == rebuilt.aggregates
+    for station in set(store['station'].tolist()):
+        assert store.equal('station', station).tolist() == rebuilt.equal('station', station).tolist()
+    assert store.between('date', 5, 40).tolist() == rebuilt.between('date', 5, 40).tolist()
+
+
+def test_appended_chunks_match_a_rebuilt_store():
+    store = _store(_records(0, 10))
+    for start in range(10, 100, 15):
+        assert store.append(_records(start, 15)) == start
+    assert len(store) == 100
+    _assert_consistent(store)
+    assert store.equal('station', 's1').tolist() == list(range(1, 100, 3))
+    assert store.aggregates['rows'] == 100
+
+
+def test_appended_columns_do_not_copy_the_store():
+    store = _store(_records(0, 10))
+    store.append(_records(10, 1))
+    buffer = store.buffers['date']
+    store.append(_records(11, 1))
+    assert store.buffers['date'] is buffer
+
+
+def test_none_keys_are_kept_in_their_own_bucket():
+    store = _store(_records(0, 6))
+    store.append([{'station': None, 'date': None, 'humidity': None}, {'station': None, 'date': 6, 'humidity': 1.0}])
+    assert store.equal('station', None).tolist() == [6, 7]
+    assert store.equal('date', None).tolist() == [6]
+    assert store.between('date', 0, 10).tolist() == [0, 1, 2, 3, 4, 5, 7]
+    assert store.aggregates['per_station'][None] == 2
+    # rows without humidity are not aggregated
+    assert store.aggregates['max_humidity'][None] == 1.0
+    assert store.aggregates['rows'] == 8
+
+
+def test_failed_append_leaves_the_store_unchanged():
+    store = _store(_records(0, 6))
+    columns = {name: values.copy() for name, values in store.columns.items()}
+    aggregates = store.aggregates
+    with pytest.raises(TypeError):
+        # lists are not hashable and cannot be kept in the hash index
+        store.append([{'station': 's9', 'date': 6, 'humidity': 1.0}, {'station': ['s1'], 'date': 7, 'humidity': 2.0}])
+    assert len(store) == 6
+    assert all(np.array_equal(store[name], values) for name, values in columns.items())
+    assert store.aggregates == aggregates
+    assert store.equal('station', 's9').tolist() == []
+    store.append(_records(6, 3))
+    _assert_consistent(store)
+
+
+def test_running_aggregate_skips_rows_without_value():
+    aggregate = RunningAggregate('sum', 'value')
+    aggregate.add(ColumnStore({'value': [1, None, 2]}))
+    assert aggregate.value == 3
+
+
+def test_indexes_merge_appended_chunks_in_batches():
+    rng = np.random.default_rng(0)
+    store = ColumnStore({'key': np.empty(0, dtype=np.int64), 'value': np.empty(0)},
+                        indexes={'key': 'hash', 'value': 'sorted'})
+    for _ in range(200):
+        store.append({'key': rng.integers(0, 5, 10), 'value': rng.random(10)})
+    assert len(store.indexes['value'].runs) <= np.log2(len(store)) + 1
+    buffer = store.indexes['key'].buffers[0]
+    store.append({'key': np.array([0]), 'value': np.array([0.5])})
+    assert store.indexes['key'].buffers[0] is buffer
+    rebuilt = ColumnStore(dict(store.columns), indexes={'key': 'hash', 'value': 'sorted'})
+    for key in range(5):
+        assert store.equal('key', key).tolist() == rebuilt.equal('key', key).tolist()
+    for low, high in [(0.1, 0.2), (None, 0.5), (0.9, None), (0.5, 0.5)]:
+        assert store.between('value', low, high).tolist() == rebuilt.between('value', low, high).tolist()
+
+
+def test_values_that_cannot_be_ordered_are_rejected_before_their_run_is_merged():
+    store = ColumnStore({'value': np.array([None] + list(range(100)), dtype=object)}, indexes={'value': 'sorted'})
+    with pytest.raises(TypeError):
+        store.append([{'value': 'a'}])
+    assert len(store) == 101
+    assert store.between('value', 10, 12).tolist() == [11, 12, 13]
+
+
+MIXED = [{'key': 'a', 'rank': 3, 'value': 1.0}, {'key': None, 'rank': None, 'value': 2.0},
+         {'key': 3, 'rank': 1, 'value': 4.0}, {'key': 'a', 'rank': 2, 'value': 8.0}]
+
+
+@pytest.mark.parametrize('indexes', [{}, {'key': 'hash', 'rank': 'sorted'}])
+def test_queries_on_columns_holding_none_and_mixed_types(indexes):
+    store = ColumnStore.from_records(MIXED, indexes=indexes)
+    assert store.equal('key', None).tolist() == [1]
+    assert store.equal('key', 'a').tolist() == [0, 3]
+    assert store.equal('key', ['a', None]).tolist() == [0, 1, 3]
+    assert store.between('rank', 2, 3).tolist() == [0, 3]
+    assert store.between('rank').tolist() == [0, 2, 3]
+    assert store.select(key=None).records() == [MIXED[1]]
+    assert store.select(np.array([0, 1, 2]), key=['a', 3])['value'].tolist() == [1.0, 4.0]
+
+
+@pytest.mark.parametrize('indexes', [{}, {'key': 'hash', 'rank': 'sorted'}])
+def test_aggregates_group_none_and_mixed_keys(indexes):
+    store = ColumnStore.from_records(MIXED, indexes=indexes)
+    assert store.aggregate('key') == {'a': 2, None: 1, 3: 1}
+    assert store.aggregate('key', 'value', 'sum') == {'a': 9.0, None: 2.0, 3: 4.0}
+    assert store.aggregate('key', 'value', 'mean') == {'a': 4.5, None: 2.0, 3: 4.0}
+    assert store.aggregate('key', 'value', 'min') == {'a': 1.0, None: 2.0, 3: 4.0}
+    assert store.aggregate('rank', 'value', 'max', positions=np.array([1, 2])) == {None: 2.0, 1: 4.0}
+    with pytest.raises(ValueError):
+        store.aggregate('key', 'value', 'median')
+
+
+@pytest.mark.parametrize('indexes', [{}, {'key': 'hash', 'rank': 'sorted'}])
+def test_set_values_are_found_and_aggregated(indexes):
+    store = ColumnStore.from_records(MIXED, indexes=indexes, aggregates={'per_key': {'func': 'count', 'by': 'key'}})
+    store.set('key', np.array([0]), None)
+    store.set('rank', np.array([2]), None)
+    store.set('flag', np.array([3]), 'x')
+    assert store.equal('key', None).tolist() == [0, 1]
+    assert store.between('rank', 0, 10).tolist() == [0, 3]
+    assert store.aggregate('key') == {None: 2, 3: 1, 'a': 1}
+    assert store.aggregates['per_key'] == {None: 2, 3: 1, 'a': 1}
+    assert store['flag'].tolist() == [None, None, None, 'x']
+    assert store.aggregate('flag') == {None: 3, 'x': 1}
@@ -0,0 +1,64 @@
+import time
+
+from lotse.app.guidance_engine.dependencies import ALL, DELTA, DependencyTracker, reads_clock, tracked
+
+
+class Context:
+    def __init__(self):
+        self.month = 1
+        self.data = []
+
+    def helper(self):
+        return self.data
+
+
+def test_tracked_context_records_reads():
+    reads = set()
+    ctx, delta = tracked(Context(), {'month': 2}, reads)
+    assert ctx.month == 1
+    assert reads == {'month'}
+    ctx.helper()
+    delta.get('month')
+    assert reads == {'month', ALL, DELTA}
+
+
+def test_writes_pass_through_the_tracked_context():
+    context = Context()
+    ctx, _ = tracked(context, None, set())
+    ctx.month = 3
+    assert context.month == 3
+
+
+def test_only_dependents_of_changed_attributes_are_due():
+    tracker = DependencyTracker()
+    tracker.record('a', {'month'}, False, lambda ctx: ctx.month)
+    tracker.record('b', {'data'}, False, lambda ctx: ctx.data)
+    tracker.consume()
+    assert tracker.due() == set()
+    tracker.mark_changed(['month'])
+    assert tracker.due() == {'a'}
+    tracker.mark_changed(None)
+    assert tracker.due() == {'a', 'b'}
+
+
+def test_applicable_and_invalidated_keys_stay_due():
+    tracker = DependencyTracker()
+    tracker.record('applicable', {'month'}, True, lambda ctx: ctx.month)
+    tracker.record('idle', {'month'}, False, lambda ctx: ctx.month)
+    tracker.consume()
+    assert tracker.due() == {'applicable'}
+    tracker.invalidate('idle')
+    assert tracker.due() == {'applicable', 'idle'}
+
+
+def test_retain_forgets_removed_keys_and_evaluates_new_ones():
+    tracker = DependencyTracker()
+    tracker.record('old', {'month'}, False, lambda ctx: ctx.month)
+    tracker.retain(['new'])
+    assert 'old' not in tracker.dependencies and 'month' not in tracker.dependents
+    assert tracker.due() == {'new'}
+
+
+def test_clock_reads_are_detected_from_code():
+    assert reads_clock(lambda ctx: time.time() > ctx.month)
+    assert not reads_clock(lambda ctx: ctx.month > 1)
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from lotse.app.guidance_engine.encoding import OutgoingMessage, apply_merge_patch, decode, encode, merge_patch
+from lotse.app.guidance_engine.socket_manager import ClientConnection
+from tests.conftest import suggestion
+
+
+@pytest.mark.parametrize('encoding', ['json', 'msgpack'])
+@pytest.mark.parametrize('compression', ['none', 'deflate'])
+def test_frames_decode_to_the_encoded_data(encoding, compression):
+    if encoding == 'msgpack':
+        pytest.importorskip('msgpack')
+    data = {'suggestion': {'id': 'a', 'values': [1, 2.5, None, 'text']}}
+    frame = encode(data, encoding, compression)
+    assert isinstance(frame, str) == (encoding == 'json' and compression == 'none')
+    assert decode(frame, encoding, compression) == data
+
+
+def test_merge_patches_turn_the_base_into_the_target():
+    base = {'id': 'a', 'event': {'value': {'x': 1, 'y': 2}}, 'title': 't'}
+    target = {'id': 'b', 'event': {'value': {'x': 1, 'z': 3}}, 'title': 't'}
+    patch = merge_patch(base, target)
+    assert patch == {'id': 'b', 'event': {'value': {'y': None, 'z': 3}}}
+    assert apply_merge_patch(base, patch) == target
+
+
+def test_messages_are_serialized_once_per_encoding():
+    message = OutgoingMessage(suggestion('a'))
+    assert message.key == 'a' and message.interaction == 'make'
+    assert message.frame('json', 'deflate') is message.frame('json', 'deflate')
+    assert json.loads(message.text)['suggestion']['id'] == 'a'
+    assert 'action' not in message.data
+
+
+def test_suggestions_of_the_same_action_are_sent_as_deltas():
+    client = ClientConnection(None, 10, 'drop_oldest', deltas=True)
+    description = 'a long description that stays the same ' * 4
+    first = OutgoingMessage(suggestion('a', value={'x': 1, 'text': description}))
+    second = OutgoingMessage(suggestion('b', value={'x': 2, 'text': description}))
+    assert client.frame(first) == first.text
+    delta = json.loads(client.frame(second))
+    assert delta['base'] == 'a'
+    assert apply_merge_patch(first.data['suggestion'], delta['patch']) == second.data['suggestion']
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from lotse.app.guidance_engine.executor import CallbackExecutor
+from tests.conftest import engine, run, suggest
+
+
+def _make_slow(setup_path):
+    """
+    Lets the `is_applicable` callback of the first action count its calls and sleep while `ctx.value_2` is set.
+    """
+    path = os.path.join(setup_path[0], 'actions', 'action_0_0.yaml')
+    with open(path) as f:
+        declaration = f.read()
+    declaration = declaration.replace('is_applicable:\n  args: [ctx, delta]\n',
+                                      'is_applicable:\n  args: [ctx, delta]\n  import: [time]\n')
+    declaration = declaration.replace('    return ctx.value_0 >',
+                                      '    self.calls = getattr(self, "calls", 0) + 1\n'
+                                      '    time.sleep(0.5 if ctx.value_2 else 0)\n'
+                                      '    return ctx.value_0 >')
+    with open(path, 'w') as f:
+        f.write(declaration)
+
+
+def test_timed_out_callbacks_are_abandoned_and_skipped_during_their_cooldown(setup_path):
+    _make_slow(setup_path)
+    lotse = engine(setup_path, executor=CallbackExecutor(timeouts={'is_applicable': 0.05}, degraded_cooldown=0.3))
+
+    async def scenario():
+        started = time.time()
+        assert await suggest(lotse, value_0=1000, value_2=1) == []
+        # the pass does not wait for the abandoned callback
+        assert time.time() - started < 0.4
+        action = next(a for a in lotse.conditional_actions if a.metadata['action_id'] == 'action_0_0')
+        assert lotse.executor.is_degraded(action) and action.calls == 1
+        lotse.update_state({'value_2': 0})
+        await lotse.generate_suggestions()
+        assert lotse.executor.is_degraded(action) and action.calls == 1
+        await asyncio.sleep(0.35)
+        lotse.update_state({'value_1': 1})
+        made = await lotse.generate_suggestions()
+        assert not lotse.executor.is_degraded(action) and action.calls == 2
+        return [s.action.metadata['action_id'] for s in made]
+
+    assert run(scenario()) == ['action_0_0']
+
+
+def test_shutting_down_the_app_stops_the_callback_threads(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    executor = guidance_app.lotse_engine.executor
+    guidance_app.shutdown()
+    with pytest.raises(RuntimeError):
+        executor.pool.submit(time.sleep, 0)
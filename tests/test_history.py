@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pytest
+from starlette.testclient import TestClient
+
+from lotse.app.guidance_engine.history import StateHistory, estimate_size
+from lotse.data import ColumnStore
+from tests.conftest import run, suggest
+
+
+class State:
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def test_snapshots_read_the_values_of_their_version():
+    history = StateHistory(State(a=1, b=[1]))
+    before = history.snapshot()
+    history.record({'a': 2}, now=10)
+    history.record({'a': 3, 'c': 1}, now=20)
+    assert (before.a, before.b) == (1, [1])
+    assert history.snapshot().a == 3
+    with pytest.raises(AttributeError):
+        _ = before.c
+    with pytest.raises(AttributeError):
+        before.a = 4
+
+
+def test_unchanged_values_are_shared_rather_than_copied():
+    data = list(range(10))
+    history = StateHistory(State(data=data, a=0))
+    history.record({'a': 1})
+    assert history.snapshot().data is data
+
+
+def test_old_versions_are_compacted_unless_a_snapshot_refers_to_them():
+    history = StateHistory(State(a=0), max_versions=2)
+    pinned = history.snapshot()
+    for value in range(1, 6):
+        history.record({'a': value})
+    assert len(history) == 5 and pinned.a == 0
+    del pinned
+    history.record({'a': 6})
+    assert len(history) == 2
+    assert [value for _, value in history.values('a')] == [5, 6]
+    with pytest.raises(LookupError):
+        history.value_at('a', 1)
+
+
+def test_changes_within_a_window_or_since_a_snapshot():
+    history = StateHistory(State(a=0, b=0))
+    history.record({'a': 1})
+    since = history.snapshot()
+    history.record({'b': 1})
+    history.record({'b': 2})
+    assert history.changed('b', since=since) and not history.changed('a', since=since)
+    assert history.changes(since=since) == {'b': 2}
+    assert history.changed('a', within=60)
+
+
+def test_reassigned_attributes_are_recorded():
+    state = State(a=[1], b=1)
+    history = StateHistory(state)
+    before = dict(vars(state))
+    state.a.append(2)
+    state.b = 2
+    history.record_reassigned(before, state)
+    assert history.changes() == {'b': 2}
+
+
+def test_size_estimates():
+    assert estimate_size(np.zeros(1000)) == 8000
+    assert estimate_size(ColumnStore({'a': np.zeros(100), 'b': np.zeros(100, dtype=np.int32)})) == 1200
+    rows = [{'station': 'A', 'humidity': 1.0}] * 1000
+    assert estimate_size(rows) > 1000 * estimate_size(rows[0])
+
+
+def test_replaced_datasets_are_dropped_beyond_the_size_budget():
+    history = StateHistory(State(data=None, a=0), max_bytes=20000)
+    for value in range(3):
+        history.record({'data': np.full(1000, value)})
+    # two arrays of 8000 bytes fit into the budget
+    assert [values[0] for _, values in history.values('data')] == [1, 2]
+    history.record({'data': np.zeros(10 ** 4)})
+    # the latest version is kept even if it exceeds the budget on its own
+    assert len(history) == 1 and history.bytes == 80000
+    for value in range(3):
+        history.record({'a': value})
+    assert history.bytes < 20000 and history.snapshot().data.shape == (10 ** 4,)
+
+
+def test_previews_of_a_client_are_released():
+    history = StateHistory(State(a=0), max_versions=1)
+    history.start_preview('first', 'client')
+    history.start_preview('second', 'other')
+    for value in range(1, 4):
+        history.record({'a': value})
+    assert len(history) == 3
+    assert history.release_previews('client') == 1
+    assert history.preview('first') is None and history.preview('second').a == 0
+    history.end_preview('second')
+    history.compact()
+    assert len(history) == 1
+
+
+def test_previews_end_when_their_client_disconnects(guidance_app, setup_path):
+    strategy_path, _ = setup_path
+    with open(os.path.join(strategy_path, 'actions', 'action_0_0.yaml'), 'a') as f:
+        f.write("preview_start:\n  args: [suggestion, ctx, delta]\n  load: |\n    pass\n")
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    engine = guidance_app.lotse_engine
+    run(suggest(engine, value_0=1000, value_1=1000))
+    ids = {s.action.metadata['action_id']: s.suggestion.id for s in engine.suggestions}
+    suggestion_id, failing_id = ids['action_0_0'], ids['action_1_0']
+    with TestClient(guidance_app).websocket_connect('/channels/client') as websocket:
+        websocket.send_json({'id': 1, 'command': 'preview_start', 'suggestion_id': suggestion_id})
+        assert websocket.receive_json()['ok']
+        assert engine.history.preview(suggestion_id) is not None
+        # previews whose callback fails are not pinned
+        websocket.send_json({'id': 2, 'command': 'preview_start', 'suggestion_id': failing_id})
+        assert not websocket.receive_json()['ok']
+        assert engine.history.preview(failing_id) is None
+    assert engine.history.previews == {}
@@ -0,0 +1,37 @@
+import os
+
+from benchmarks.generate import generate
+from lotse.app.guidance_engine.lotse_engine import LotseEngine
+from tests.conftest import run
+
+
+def _engine(directory, guidance_app):
+    generate(directory, strategies=2, actions=1, attributes=2, rows=5, declarative=True)
+    action = os.path.join(directory, 'strategies', 'actions', 'action_0_0.yaml')
+    with open(action) as f:
+        declaration = f.read()
+    with open(action, 'w') as f:
+        f.write(declaration.replace('    self.threshold += 1\n', '    self.threshold += 1\n    ctx.enabled = False\n'))
+    guidance_app.setup_engine(os.path.join(directory, 'strategies'), os.path.join(directory, 'state'),
+                              strategy_cache=False)
+    return guidance_app.lotse_engine
+
+
+def test_attributes_assigned_by_interactions_are_marked_changed(guidance_app, tmp_path):
+    engine: LotseEngine = _engine(str(tmp_path), guidance_app)
+
+    async def scenario():
+        await engine.evaluate_strategies()
+        engine.update_state({'value_0': 1000})
+        await engine.generate_suggestions()
+        made = [s.action.metadata['action_id'] for s in engine.suggestions]
+        await engine.accept_suggestion(next(iter(engine.suggestions)).suggestion.id)
+        # the condition `ctx.enabled` of the other action was evaluated before it was reset in `accept`
+        engine.update_state({'value_1': 1000})
+        await engine.generate_suggestions()
+        return made, [s.action.metadata['action_id'] for s in engine.suggestions]
+
+    made, remaining = run(scenario())
+    assert made == ['action_0_0']
+    assert remaining == []
+    assert engine.history.version >= 2
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+import time
+
+from lotse.app.guidance_engine.journal import JournalStore
+from lotse.app.main import StateVectorUpdate, update_state
+from tests.conftest import engine, run, suggest
+
+
+def test_stopping_keeps_journaling(guidance_app, setup_path, tmp_path):
+    journal_path = os.path.join(str(tmp_path), 'journal')
+
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, journal_path=journal_path)
+        guidance_app.start()
+        await update_state(update=StateVectorUpdate(updates={'value_0': 1}, re_evaluate_actions=False))
+        guidance_app.stop()
+        assert guidance_app.lotse_engine.journal is not None
+        await update_state(update=StateVectorUpdate(updates={'value_1': 2}, re_evaluate_actions=False))
+        guidance_app.shutdown()
+        assert guidance_app.lotse_engine.journal is None
+
+    run(scenario())
+    guidance_app.setup_engine(*setup_path, strategy_cache=False, journal_path=journal_path)
+    state = guidance_app.lotse_engine.current_state
+    assert (state.value_0, state.value_1) == (1, 2)
+
+
+def test_stopping_before_starting(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+    guidance_app.stop()
+
+
+def _action(lotse, action_id):
+    return next(action for strategy in lotse.strategies for action in vars(strategy).values()
+                if getattr(action, 'metadata', {}).get('action_id') == action_id)
+
+
+def test_restoring_after_a_crash(setup_path, tmp_path):
+    store = JournalStore(str(tmp_path / 'journals'))
+    lotse = engine(setup_path)
+    store.attach(lotse, 'client')
+
+    async def scenario():
+        await suggest(lotse, value_0=1000, value_1=1000)
+        accepted = next(s for s in lotse.suggestions if s.action.metadata['action_id'] == 'action_0_0')
+        await lotse.accept_suggestion(accepted.suggestion.id)
+
+    run(scenario())
+    threshold = _action(lotse, 'action_0_0').threshold
+    remaining = [s.suggestion.id for s in lotse.suggestions]
+    # the process dies without a checkpoint, while writing a record
+    lotse.journal.close()
+    with open(lotse.journal.journal_file, 'ab') as f:
+        f.write(b'\x00\x00\x01')
+
+    restored = engine(setup_path)
+    store.attach(restored, 'client')
+    assert restored.current_state.value_0 == 1000
+    assert [s.suggestion.id for s in restored.suggestions] == remaining
+    assert _action(restored, 'action_0_0').threshold == threshold
+    assert not _action(restored, 'action_0_0').suggested
+    assert _action(restored, 'action_1_0').suggested
+
+
+def test_snapshots_are_written_in_the_background(setup_path, tmp_path):
+    store = JournalStore(str(tmp_path / 'journals'), snapshot_every=2)
+    lotse = engine(setup_path)
+    journal = store.attach(lotse, 'client')
+    threads = []
+    write = journal._write
+
+    def slow_write(snapshot):
+        threads.append(threading.current_thread())
+        time.sleep(0.2)
+        write(snapshot)
+
+    journal._write = slow_write
+
+    async def scenario():
+        lotse.update_state({'value_0': 1})
+        lotse.update_state({'value_1': 2})
+        task = journal.task
+        await asyncio.sleep(0.05)
+        # the event loop is not blocked while the snapshot is written, updates bypassing the lock are kept
+        assert not task.done()
+        lotse.update_state({'value_2': 3})
+        await task
+
+    run(scenario())
+    assert threads and threading.main_thread() not in threads
+    assert journal.pending == 1
+    journal.close()
+    restored = engine(setup_path)
+    store.attach(restored, 'client')
+    state = restored.current_state
+    assert (state.value_0, state.value_1, state.value_2) == (1, 2, 3)
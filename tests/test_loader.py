@@ -0,0 +1,31 @@
+import os
+
+from lotse.action import ConditionalGuidanceAction
+from lotse.app.guidance_engine.loader import LazyAction, StrategyLoader, resolve
+from tests.conftest import engine
+
+
+def _action_file(setup_path, strategy=0):
+    return os.path.join(setup_path[0], 'actions', f'action_{strategy}_0.yaml')
+
+
+def test_compiled_files_are_cached_on_disk(setup_path, tmp_path):
+    cache = os.path.join(str(tmp_path), 'cache')
+    first = engine(setup_path, loader=StrategyLoader(cache))
+    assert first.loader.hits == 0 and first.loader.misses > 0
+    second = engine(setup_path, loader=StrategyLoader(cache))
+    assert second.loader.misses == 0 and second.loader.hits == first.loader.misses
+    with open(_action_file(setup_path), 'a') as f:
+        f.write('extra: 1\n')
+    third = engine(setup_path, loader=StrategyLoader(cache))
+    assert third.loader.misses == 1
+
+
+def test_actions_are_built_once_their_strategy_is_applicable(setup_path):
+    lazy = engine(setup_path)
+    strategy = lazy.strategies[0]
+    assert isinstance(strategy.action, LazyAction)
+    resolve(strategy)
+    assert isinstance(strategy.action, ConditionalGuidanceAction)
+    assert isinstance(engine(setup_path, loader=StrategyLoader(lazy_actions=False)).strategies[0].action,
+                      ConditionalGuidanceAction)
@@ -0,0 +1,79 @@
+from lotse.app.guidance_engine.dependencies import ALL, tracked
+from lotse.app.guidance_engine.memo import Memoized, memoize
+from tests.conftest import run
+
+
+class Context:
+    def __init__(self):
+        self.month = 1
+        self.data = [1, 2, 3]
+
+
+def _counted(calls):
+    def total(ctx, factor=1):
+        calls.append(factor)
+        return sum(ctx.data) * factor
+    return total
+
+
+def test_results_are_cached_until_a_declared_attribute_changes():
+    calls = []
+    helper = Memoized(_counted(calls), ['data'])
+    context = Context()
+    assert helper(context) == helper(context) == 6
+    assert helper(context, factor=2) == 12
+    assert calls == [1, 2]
+    helper.invalidate(['month'])
+    helper(context)
+    assert calls == [1, 2]
+    helper.invalidate(['data'])
+    helper(context)
+    assert calls == [1, 2, 1]
+
+
+def test_least_recently_used_results_are_dropped():
+    calls = []
+    helper = Memoized(_counted(calls), size=2)
+    context = Context()
+    for factor in (1, 2, 1, 3, 2):
+        helper(context, factor=factor)
+    assert calls == [1, 2, 3, 2] and len(helper) == 2
+
+
+def test_unhashable_arguments_are_not_cached():
+    calls = []
+    helper = Memoized(lambda values: calls.append(values) or len(values))
+    helper([1])
+    helper([1])
+    assert len(calls) == 2
+
+
+def test_callers_only_depend_on_the_declared_attributes():
+    helper = Memoized(_counted([]), ['data'])
+    reads = set()
+    context, _ = tracked(Context(), None, reads)
+    helper(context)
+    assert reads == {'data'}
+    reads.clear()
+    Memoized(_counted([]))(context)
+    assert ALL in reads
+
+
+def test_async_results_are_cached():
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        return value * 2
+
+    helper = Memoized(fetch)
+    assert run(helper(2)) == run(helper(2)) == 4
+    assert calls == [2]
+
+
+def test_cache_declarations():
+    function = _counted([])
+    assert memoize(function, None) is function
+    assert memoize(function, ['month']).depends_on == {'month'}
+    assert memoize(function, {'attributes': ['data'], 'size': 4}).size == 4
+    assert memoize(function, True).depends_on is None
@@ -0,0 +1,68 @@
+import os
+import re
+
+from fastapi.testclient import TestClient
+
+from lotse.app.guidance_engine.metrics import registry
+from tests.conftest import run
+
+SAMPLE = re.compile(r'^(\w+)(\{.*\})? (\S+)$')
+BUCKET = re.compile(r'^(\{.*?),?le="([^"]+)"\}$')
+
+
+def _scrape(client):
+    """
+    :return: The kind of each metric from its `# TYPE` line, and the samples as (name, labels, value)
+    """
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.text.endswith('\n')
+    kinds, samples = {}, []
+    for line in response.text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            kinds[name] = kind
+        elif not line.startswith('# HELP '):
+            name, labels, value = SAMPLE.match(line).groups()
+            samples.append((name, labels or '', float(value)))
+    return kinds, samples
+
+
+def test_metrics_are_exposed_in_the_prometheus_text_format(guidance_app, setup_path):
+    path = os.path.join(setup_path[0], 'strategy_0.yaml')
+    with open(path) as f:
+        declaration = f.read()
+    with open(path, 'w') as f:
+        f.write(declaration.replace('strategy_id: strategy_0', 'strategy_id: "a \\"quoted\\" \\\\ strategy\\nid"'))
+    guidance_app.setup_engine(*setup_path, strategy_cache=False)
+
+    async def evaluate():
+        await guidance_app.evaluate_strategies()
+        await guidance_app.evaluate_actions()
+
+    run(evaluate())
+    with TestClient(guidance_app) as client:
+        kinds, samples = _scrape(client)
+
+    assert kinds == {name: metric.kind for name, metric in registry.metrics.items()}
+    histograms = [name for name, kind in kinds.items() if kind == 'histogram']
+    for histogram in histograms:
+        buckets, counts, sums = {}, {}, {}
+        for name, labels, value in samples:
+            if name == f'{histogram}_bucket':
+                series, le = BUCKET.match(labels).groups()
+                buckets.setdefault(series + '}' if series != '{' else '', []).append((le, value))
+            elif name == f'{histogram}_count':
+                counts[labels] = value
+            elif name == f'{histogram}_sum':
+                sums[labels] = value
+        assert buckets.keys() == counts.keys() == sums.keys()
+        for series, values in buckets.items():
+            bounds = [float(le) for le, _ in values]
+            cumulative = [value for _, value in values]
+            assert bounds == sorted(bounds) and bounds[-1] == float('inf')
+            assert cumulative == sorted(cumulative) and cumulative[-1] == counts[series]
+            assert sums[series] >= 0
+    passes = [value for name, labels, value in samples if name == 'lotse_strategy_pass_seconds_count']
+    assert passes and passes[0] >= 1
+    labelled = [labels for name, labels, _ in samples if name == 'lotse_callback_seconds_count']
+    assert '{callback="determine_applicability",owner="a \\"quoted\\" \\\\ strategy\\nid"}' in labelled
@@ -0,0 +1,75 @@
+import os
+import types
+
+import numpy as np
+import pytest
+
+from lotse.app.guidance_engine import parallel
+from lotse.app.guidance_engine.parallel import SharedSnapshot
+from lotse.data import ColumnStore
+from tests.conftest import run
+
+
+def test_strategy_pool_survives_stop_and_start(guidance_app, setup_path):
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, parallel_strategies=1)
+        engine = guidance_app.lotse_engine
+        guidance_app.start()
+        guidance_app.stop()
+        guidance_app.start()
+        return await engine.evaluate_in_pool(), engine.pool.broken
+
+    results, broken = run(scenario())
+    assert len(results) == 2 and all(result is True for result in results.values())
+    assert not broken
+
+
+def test_shut_down_strategy_pool_falls_back_to_the_engine(guidance_app, setup_path):
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, parallel_strategies=1)
+        engine = guidance_app.lotse_engine
+        engine.pool.shutdown()
+        engine.pool.broken = False
+        return await engine.evaluate_in_pool()
+
+    assert all(result is None for result in run(scenario()).values())
+
+
+def test_callback_errors_in_the_workers_do_not_break_the_pool(guidance_app, setup_path):
+    path = os.path.join(setup_path[0], 'strategy_0.yaml')
+    with open(path) as f:
+        declaration = f.read()
+    with open(path, 'w') as f:
+        f.write(declaration.replace('return ctx.enabled', "raise RuntimeError('failing callback')"))
+
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, parallel_strategies=1)
+        engine = guidance_app.lotse_engine
+        with pytest.raises(RuntimeError, match='failing callback'):
+            await engine.evaluate_in_pool()
+        assert not engine.pool.broken
+        strategy = next(s for s in engine.strategies if s.metadata['strategy_id'] == 'strategy_1')
+        return await engine.pool.evaluate(engine.snapshot.publish(engine.current_state), strategy, engine.loader,
+                                          engine.last_delta)
+
+    assert run(scenario()) is True
+
+
+def test_workers_keep_unchanged_columnar_data(setup_path):
+    strategy_path, state_path = setup_path
+    parallel._initialize(strategy_path, state_path, None)
+    snapshot = SharedSnapshot()
+    state = types.SimpleNamespace(data=ColumnStore({'a': np.arange(10)}, indexes={'a': 'sorted'}), value=1)
+    try:
+        data = parallel._context(snapshot.publish(state)).data
+        state.value = 2
+        snapshot.mark_changed(['value'])
+        context = parallel._context(snapshot.publish(state))
+        assert context.value == 2 and context.data is data
+        state.data.append({'a': np.array([10])})
+        snapshot.mark_changed(['data'])
+        context = parallel._context(snapshot.publish(state))
+        assert context.data is not data and context.data.between('a', 9, 10).tolist() == [9, 10]
+    finally:
+        snapshot.close()
+        parallel._worker.clear()
@@ -0,0 +1,61 @@
+import marshal
+import os
+
+import pytest
+
+from lotse.app.guidance_engine.profiler import profiler
+from tests.conftest import engine, run, suggest
+
+
+@pytest.fixture
+def profiling():
+    yield profiler
+    profiler.stop()
+
+
+def _callback(status, action, name):
+    return next(c for c in status['callbacks'] if c['labels'][-2:] == [action, name])
+
+
+def test_callbacks_are_attributed_to_their_action_and_yaml_file(setup_path, profiling):
+    lotse = engine(setup_path)
+    profiling.start('deterministic')
+    run(suggest(lotse, value_0=1000))
+    profiling.stop()
+    status = profiling.status()
+    assert not status['active']
+    condition = _callback(status, 'action_0_0', 'is_applicable')
+    assert condition['calls'] == 1
+    assert os.path.basename(condition['file']) == 'action_0_0.yaml'
+    assert condition['line'] > 0
+    assert _callback(status, 'action_0_0', 'generate_suggestion_content')['calls'] == 1
+    assert marshal.loads(profiling.pstats())
+    assert any(line.startswith(';'.join(condition['labels'])) for line in profiling.collapsed().splitlines())
+
+
+def test_sampling_records_stacks_of_running_callbacks(setup_path, profiling):
+    strategy_path, _ = setup_path
+    file = os.path.join(strategy_path, 'actions', 'action_0_0.yaml')
+    with open(file) as f:
+        action = f.read()
+    with open(file, 'w') as f:
+        f.write(action.replace('    return ctx.value_0 >', '    import time\n    time.sleep(0.1)\n    return ctx.value_0 >'))
+    lotse = engine(setup_path)
+    profiling.start('sampling', interval=0.005)
+    run(suggest(lotse))
+    profiling.stop()
+    stacks = profiling.collapsed().splitlines()
+    assert any('action_0_0' in stack and 'is_applicable' in stack for stack in stacks)
+
+
+def test_profiling_stops_after_the_given_ticks_and_requests(profiling):
+    profiling.start(ticks=2)
+    profiling.tick()
+    assert profiling.status()['active']
+    profiling.tick()
+    assert not profiling.status()['active']
+    profiling.start(requests=1)
+    profiling.request()
+    assert not profiling.active
+    with pytest.raises(ValueError):
+        profiling.start('tracing')
@@ -0,0 +1,34 @@
+import os
+import re
+
+from tests.conftest import engine, run, suggest
+
+
+def _action_file(setup_path, strategy=0):
+    return os.path.join(setup_path[0], 'actions', f'action_{strategy}_0.yaml')
+
+
+def test_reloaded_actions_keep_their_suggestions_and_runtime_state(setup_path):
+    reloading = engine(setup_path)
+    assert run(suggest(reloading, value_0=1000)) == ['action_0_0']
+    live = next(iter(reloading.suggestions))
+    old = live.action
+    old.counter = 3
+    path = _action_file(setup_path)
+    with open(path) as f:
+        declaration = f.read()
+    with open(path, 'w') as f:
+        f.write(re.sub(r'threshold: \d+', 'threshold: 5000', declaration))
+    assert run(reloading.reload(reloading.loader.changed())) == []
+    new = reloading.suggestions.get(live.suggestion.id).action
+    assert new is not old
+    assert new.threshold == 5000 and new.counter == 3
+
+
+def test_deleted_strategies_are_removed_and_their_suggestions_retracted(setup_path):
+    reloading = engine(setup_path)
+    run(suggest(reloading, value_0=1000))
+    os.remove(os.path.join(setup_path[0], 'strategy_0.yaml'))
+    retracted = run(reloading.reload(reloading.loader.changed()))
+    assert [s.action.metadata['action_id'] for s in retracted] == ['action_0_0']
+    assert len(reloading.strategies) == 1 and len(reloading.suggestions) == 0
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from lotse.app.guidance_engine.pubsub import LocalBroker, RedisBroker
+from lotse.app.guidance_engine.routing import OwnerUnavailable, RemoteCommandError, SessionRouter
+from tests.conftest import run
+
+
+def _redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisBroker(client=fakeredis.aioredis.FakeRedis())
+
+
+@pytest.mark.parametrize('kind', ['local', 'redis'])
+def test_brokers_deliver_messages_and_track_owners(kind):
+    make = LocalBroker if kind == 'local' else _redis
+
+    async def scenario():
+        broker = make()
+        received = asyncio.Queue()
+        await broker.subscribe('channel', received.put)
+        await broker.publish('channel', 'text')
+        message = await asyncio.wait_for(received.get(), 2)
+        owners = [await broker.claim('key', 'first'), await broker.claim('key', 'second')]
+        await broker.release('key', 'second')
+        owners.append(await broker.claim('key', 'second'))
+        await broker.release('key', 'first')
+        owners.append(await broker.claim('key', 'second'))
+        owners.append(await broker.claim('key', 'third', force=True))
+        await broker.close()
+        return message, owners
+
+    assert run(scenario()) == ('text', ['first', 'first', 'first', 'second', 'third'])
+
+
+def test_commands_are_forwarded_to_the_owner():
+    async def scenario():
+        broker = LocalBroker()
+        executed = []
+
+        async def execute(client_id, command):
+            executed.append((client_id, command))
+            return {'ok': command['command'] != 'fail', 'error': 'failed', 'result': 42}
+
+        owner = SessionRouter(broker, execute, worker='owner')
+        other = SessionRouter(broker, execute, worker='other')
+        assert await owner.owner('client') == 'owner' and owner.owns('client')
+        assert await other.owner('client') == 'owner' and not other.owns('client')
+        result = await other.forward('owner', 'client', 'client', {'command': 'update_state'})
+        with pytest.raises(RemoteCommandError):
+            await other.forward('owner', 'client', 'client', {'command': 'fail'})
+        return result, executed
+
+    result, executed = run(scenario())
+    assert result == 42
+    assert executed[0] == ('client', {'command': 'update_state'})
+
+
+def test_unavailable_owners_are_taken_over():
+    async def scenario():
+        broker = LocalBroker()
+        other = SessionRouter(broker, None, worker='other', timeout=0.05)
+        await broker.claim('client', 'gone')
+        with pytest.raises(OwnerUnavailable):
+            await other.forward('gone', 'client', 'client', {'command': 'update_state'})
+        return other.owns('client'), await broker.claim('client', 'another')
+
+    assert run(scenario()) == (True, 'other')
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from lotse.app.guidance_engine.scheduler import Scheduler
+from lotse.app.main import StateVectorUpdate, update_state
+from tests.conftest import run
+
+
+def test_pop_due_returns_keys_earliest_first():
+    scheduler = Scheduler()
+    now = time.time()
+    scheduler.schedule('b', now - 1)
+    scheduler.schedule('a', now - 2)
+    scheduler.schedule('c', now + 60)
+    assert scheduler.pop_due(now) == ['a', 'b']
+    assert len(scheduler) == 1
+
+
+def test_schedule_replaces_and_removes_deadlines():
+    scheduler = Scheduler()
+    now = time.time()
+    scheduler.schedule('a', now - 1)
+    scheduler.schedule('a', now + 60)
+    assert scheduler.pop_due(now) == []
+    scheduler.schedule('a', None)
+    assert scheduler.next_due() is None
+
+
+def test_earlier_deadline_wakes_waiting_loop():
+    async def scenario():
+        scheduler = Scheduler()
+        scheduler.schedule('late', time.time() + 60)
+        waiting = asyncio.ensure_future(scheduler.wait())
+        await asyncio.sleep(0.01)
+        scheduler.notify('early')
+        await asyncio.wait_for(waiting, 1)
+        return scheduler.pop_due()
+
+    assert run(scenario()) == ['early']
+
+
+def _count_passes(engine):
+    passes = []
+    generate = engine.generate_suggestions
+
+    async def counted():
+        passes.append(time.time())
+        return await generate()
+
+    engine.generate_suggestions = counted
+    return passes
+
+
+def test_debounced_updates_are_evaluated_once_by_the_scheduler(guidance_app, setup_path):
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, update_debounce=0.3, guidance_loop_timeout=60)
+        passes = _count_passes(guidance_app.lotse_engine)
+        guidance_app.start()
+        await asyncio.sleep(0.1)
+        before = len(passes)
+        for value in range(10):
+            await update_state(update=StateVectorUpdate(updates={'value_0': value}))
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0.5)
+        return len(passes) - before
+
+    assert 1 <= run(scenario()) <= 2
+
+
+def test_updates_without_re_evaluation_wait_for_the_next_regular_pass(guidance_app, setup_path):
+    async def scenario():
+        guidance_app.setup_engine(*setup_path, strategy_cache=False, guidance_loop_timeout=0.3)
+        passes = _count_passes(guidance_app.lotse_engine)
+        guidance_app.start()
+        await asyncio.sleep(0.1)
+        before = len(passes)
+        await update_state(update=StateVectorUpdate(updates={'value_0': 1}, re_evaluate_actions=False))
+        await asyncio.sleep(0.1)
+        immediate = len(passes) - before
+        await asyncio.sleep(0.4)
+        return immediate, len(passes) - before
+
+    assert run(scenario()) == (0, 1)
@@ -0,0 +1,66 @@
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+from lotse.app.guidance_engine.sessions import SessionManager
+from tests.conftest import engine, run, suggest
+
+
+def test_sessions_have_isolated_engines(setup_path):
+    template = engine(setup_path)
+    sessions = SessionManager(template)
+    first, second = sessions.get('first'), sessions.get('second')
+    assert first is not template and first is sessions.get('first')
+    assert run(suggest(first, value_0=1000)) == ['action_0_0']
+    assert second.current_state.value_0 == template.current_state.value_0 == 0
+    assert len(second.suggestions) == 0
+    # strategies are copied rather than parsed again
+    assert first.strategies[0] is not template.strategies[0]
+    assert template.loader.misses == first.loader.misses
+
+
+def test_sessions_start_from_the_initialized_template(setup_path):
+    with open(os.path.join(setup_path[1], 'vector.yaml'), 'a') as f:
+        f.write("initialize:\n  type: function\n  args: []\n  load: |\n"
+                "    self.initialized = getattr(self, 'initialized', 0) + 1\n")
+    template = engine(setup_path)
+    template.update_state({'value_0': 5})
+    session = SessionManager(template).get('client')
+    assert session.current_state.initialized == 1
+    assert session.current_state.value_0 == 5
+
+
+def test_sessions_are_evicted_least_recently_used_first(setup_path):
+    sessions = SessionManager(engine(setup_path), max_sessions=2)
+    removed = []
+    sessions.on_remove = removed.append
+    sessions.connect('connected')
+    sessions.get('idle')
+    sessions.get('new')
+    assert removed == ['idle']
+    assert 'connected' in sessions and len(sessions) == 2
+
+
+def test_idle_sessions_are_evicted(setup_path):
+    sessions = SessionManager(engine(setup_path), max_idle=0.01)
+    sessions.get('idle')
+    sessions.connect('connected')
+    time.sleep(0.02)
+    sessions.evict()
+    assert [session.client_id for session in sessions] == ['connected']
+    sessions.disconnect('connected')
+    time.sleep(0.02)
+    sessions.evict()
+    assert len(sessions) == 0
+
+
+def test_state_updates_without_a_client_are_rejected(guidance_app, setup_path):
+    guidance_app.setup_engine(*setup_path, strategy_cache=False, isolate_sessions=True)
+    body = {'updates': {'value_0': 5}, 're_evaluate_actions': False}
+    with TestClient(guidance_app) as client:
+        rejected = client.post('/state/update', json=body)
+        accepted = client.post('/state/update', json=body, params={'client_id': 'client'})
+    assert rejected.status_code == 400 and accepted.status_code == 200
+    assert guidance_app.lotse_engine.current_state.value_0 == 0
+    assert guidance_app.get_engine('client').current_state.value_0 == 5
@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+from lotse.app.guidance_engine.socket_manager import ConnectionManager
+from tests.conftest import run, suggestion
+
+
+class Websocket:
+    """
+    Stands in for a client reading its messages only once `read` is set.
+    """
+
+    def __init__(self):
+        self.read = asyncio.Event()
+        self.received = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        await self.read.wait()
+        self.received.append(json.loads(text)['suggestion'])
+
+    async def close(self):
+        self.closed = True
+
+
+async def _fill(policy: str, *suggestions):
+    """
+    Broadcasts the suggestions to a client that reads nothing before all of them were queued.
+
+    :return: The manager, the websocket and the connection of the client
+    """
+    manager = ConnectionManager(max_queue_size=2, slow_consumer_policy=policy)
+    websocket = Websocket()
+    await manager.connect(websocket)
+    client = manager.clients[websocket]
+    for queued in suggestions:
+        await manager.broadcast(queued)
+    return manager, websocket, client
+
+
+async def _read(websocket: Websocket):
+    websocket.read.set()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    return [(received['id'], received['event']['value']) for received in websocket.received]
+
+
+def test_the_oldest_queued_message_is_dropped():
+    async def scenario():
+        # the first message is taken from the queue and waits to be sent
+        _, websocket, client = await _fill('drop_oldest', *(suggestion(str(i)) for i in range(4)))
+        assert client.dropped == 1
+        return await _read(websocket)
+
+    assert run(scenario()) == [('0', '0'), ('2', '2'), ('3', '3')]
+
+
+def test_queued_messages_with_the_same_key_are_coalesced():
+    async def scenario():
+        _, websocket, client = await _fill('coalesce', suggestion('0'), suggestion('a', value='first'),
+                                           suggestion('b'), suggestion('a', value='second'))
+        assert [key for key, _, _ in client.queue] == ['b', 'a'] and client.dropped == 1
+        return await _read(websocket)
+
+    assert run(scenario()) == [('0', '0'), ('b', 'b'), ('a', 'second')]
+
+
+def test_slow_clients_are_disconnected():
+    async def scenario():
+        manager, websocket, client = await _fill('disconnect', *(suggestion(str(i)) for i in range(3)))
+        assert websocket in manager.clients and not websocket.closed
+        await manager.broadcast(suggestion('3'))
+        await asyncio.sleep(0)
+        assert websocket not in manager.clients and websocket not in manager.connections
+        assert websocket.closed and client.task.cancelled()
+        assert await _read(websocket) == []
+
+    run(scenario())
@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.generate import generate
+from lotse.data import AppendedRows, ColumnStore
+from tests.conftest import engine
+
+
+def _row(i):
+    return {'station': f'station_{i % 2}', 'date': '2030-01-01', 'humidity': float(i), 'pressure': 1000}
+
+
+@pytest.fixture
+def columnar_path(tmp_path):
+    generate(str(tmp_path), strategies=1, actions=1, attributes=3, rows=20, columnar=True)
+    return os.path.join(str(tmp_path), 'strategies'), os.path.join(str(tmp_path), 'state')
+
+
+def test_appended_rows_are_indexed_and_reported_in_the_delta(columnar_path):
+    lotse = engine(columnar_path)
+    assert lotse.append_rows('data', [_row(0), _row(1)]) == 20
+    assert lotse.append_rows('data', [_row(2)]) == 22
+    data = lotse.current_state.data
+    assert isinstance(data, ColumnStore) and len(data) == 23
+    assert data.equal('date', '2030-01-01').tolist() == [20, 21, 22]
+    delta = lotse.last_delta['data']
+    # appends between two passes are reported together
+    assert isinstance(delta, AppendedRows) and delta.start == 20 and len(delta) == 3
+
+
+def test_appending_to_a_list_of_records(setup_path):
+    lotse = engine(setup_path)
+    assert lotse.append_rows('data', [_row(0)]) == 20
+    assert lotse.current_state.data[-1] == _row(0)
+    with pytest.raises(TypeError):
+        lotse.append_rows('value_0', [_row(1)])
+
+
+def test_streamed_rows_are_appended_in_chunks(guidance_app, columnar_path):
+    guidance_app.setup_engine(*columnar_path, strategy_cache=False)
+    appended = []
+    append = guidance_app.lotse_engine.append_rows
+    guidance_app.lotse_engine.append_rows = lambda attribute, rows: appended.append(len(rows)) or append(attribute,
+                                                                                                      rows)
+    body = '\n'.join(json.dumps(_row(i)) for i in range(5)) + '\n'
+    with TestClient(guidance_app) as client:
+        response = client.post('/state/stream/data', params={'chunk_size': 2, 're_evaluate_actions': False},
+                               content=body)
+    assert response.status_code == 200
+    assert response.json() == {'start': 20, 'count': 5}
+    assert appended == [2, 2, 1]
+    assert len(guidance_app.lotse_engine.current_state.data) == 25
+
+
+def test_appended_rows_are_restored_from_the_journal(guidance_app, columnar_path, tmp_path):
+    journal_path = os.path.join(str(tmp_path), 'journal')
+    guidance_app.setup_engine(*columnar_path, strategy_cache=False, journal_path=journal_path)
+    guidance_app.lotse_engine.append_rows('data', [_row(0), _row(1)])
+    guidance_app.shutdown()
+    guidance_app.setup_engine(*columnar_path, strategy_cache=False, journal_path=journal_path)
+    data = guidance_app.lotse_engine.current_state.data
+    assert len(data) == 22
+    assert data.equal('date', '2030-01-01').tolist() == [20, 21]
@@ -0,0 +1,32 @@
+from lotse.app.guidance_engine.suggestion_store import SuggestionPolicy, SuggestionStore
+from tests.conftest import Action, suggestion
+
+
+def test_oldest_suggestions_beyond_the_limits_are_removed():
+    action = Action(max_suggestions=2)
+    store = SuggestionStore(policy=SuggestionPolicy(max_per_strategy=3))
+    removed = [s.suggestion.id for i in range(3) for s in store.add(suggestion(str(i), action))]
+    assert removed == ['0']
+    removed = store.add(suggestion('other', Action())) + store.add(suggestion('another', Action()))
+    assert [s.suggestion.id for s in removed] == ['1']
+    assert len(store) == 3
+
+
+def test_suggestions_expire_after_their_ttl():
+    store = SuggestionStore(policy=SuggestionPolicy(ttl=10))
+    store.add(suggestion('a'), now=0)
+    store.add(suggestion('b', Action(suggestion_ttl=5)), now=0)
+    assert store.next_expiry() == 5
+    assert [s.suggestion.id for s in store.expired(now=7)] == ['b']
+    store.remove('a')
+    assert store.next_expiry() is None
+
+
+def test_duplicates_are_detected_by_action_and_content():
+    action = Action()
+    store = SuggestionStore([suggestion('a', action, value=1)])
+    assert store.duplicate(suggestion('b', action, value=1)).suggestion.id == 'a'
+    assert store.duplicate(suggestion('c', action, value=2)) is None
+    assert store.duplicate(suggestion('d', Action(), value=1)) is None
+    assert SuggestionStore([suggestion('a', action, value=1)], SuggestionPolicy(deduplicate=False)).duplicate(
+        suggestion('b', action, value=1)) is None
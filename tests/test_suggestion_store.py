@@ -0,0 +1,21 @@
+from lotse.app.guidance_engine.suggestion_store import SuggestionStore
+from tests.conftest import Action, suggestion
+
+
+def test_suggestions_are_indexed_by_id_action_and_strategy():
+    action = Action()
+    store = SuggestionStore([suggestion('a', action), suggestion('b', action, strategy='other')])
+    assert store.get('a').suggestion.id == 'a'
+    assert [s.suggestion.id for s in store.for_action(action)] == ['a', 'b']
+    assert [s.suggestion.id for s in store.for_strategy('other')] == ['b']
+    assert store.remove('a').suggestion.id == 'a'
+    assert 'a' not in store and store.remove('a') is None
+    assert [s.suggestion.id for s in store] == ['b']
+
+
+def test_replaced_actions_keep_their_suggestions():
+    old, new = Action(), Action()
+    store = SuggestionStore([suggestion('a', old)])
+    store.replace_action(old, new)
+    assert store.for_action(old) == [] and store.get('a').action is new
+    assert store.duplicate(suggestion('b', new, value='a')).suggestion.id == 'a'